@@ -0,0 +1,324 @@
+"""
+Autotune - Benchmark llama.cpp settings on this host and save the fastest profile
+
+Loads the GGUF model with candidate settings (threads, batch threads, n_batch, n_ctx, KV cache
+type / flash attention, mlock and, on SMT machines, pinning to one thread per physical core),
+measures prompt evaluation and generation speed and writes the best settings to a profile
+file. chat_server.py loads the profile at startup (LLAMA_PROFILE, default: next to the model).
+
+The search starts from the settings the chat server uses without a profile and tunes one
+parameter at a time, keeping a candidate only if it is faster by more than --min-gain. Each
+candidate runs in a fresh process, so a combination llama.cpp rejects cannot take the run down.
+A profile is only applied on the host (CPU count, CPU model) and the model file it was tuned for.
+
+    python autotune.py
+    python autotune.py --model models/other.gguf --prompt-tokens 256 --gen-tokens 64
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import statistics
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_VERSION = 1
+DEFAULT_MODEL_PATH = "./models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf"
+
+# Settings used without a profile (the chat server's previous hard-coded values)
+DEFAULT_SETTINGS: Dict[str, Any] = {
+    "n_threads": 6,
+    "n_threads_batch": None,  # None = n_threads
+    "n_batch": 512,
+    "n_ctx": 4096,
+    "use_mlock": False,
+    "kv_cache": "f16",
+    "flash_attn": False,
+    "cpu_affinity": "all",  # "all" or "physical" (one logical CPU per physical core)
+}
+# KV cache types (GGML_TYPE_* names), quantized V cache requires flash attention
+KV_CACHE_TYPES = ("f16", "q8_0", "q4_0")
+# Sentence repeated to build the benchmark prompt
+_PROMPT_TEXT = ("Thought: The user wants to add 12 and 30, then multiply the result by 4. "
+                "Action: add_numbers Action Input: {\"a\": 12, \"b\": 30} Observation: 42 ")
+
+
+def default_profile_path(model_path: str) -> str:
+    """Profile file next to the model (models/ is a volume, so it survives image rebuilds)"""
+    return os.path.splitext(model_path)[0] + ".profile.json"
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def physical_cpus() -> List[int]:
+    """One logical CPU per physical core (from sysfs, all CPUs if the topology is unknown)"""
+    chosen, seen = [], set()
+    for cpu in available_cpus():
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as siblings:
+                core = siblings.read().strip()
+        except OSError:
+            return available_cpus()
+        if core not in seen:
+            seen.add(core)
+            chosen.append(cpu)
+    return chosen
+
+
+def host_info() -> Dict[str, Any]:
+    processor = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            processor = next((line.split(":", 1)[1].strip() for line in cpuinfo if line.startswith("model name")),
+                             processor)
+    except OSError:
+        pass
+    return {
+        "cpus": len(available_cpus()),
+        "physical_cores": len(physical_cpus()),
+        "machine": platform.machine(),
+        "processor": processor,
+    }
+
+
+def model_info(model_path: str) -> Dict[str, Any]:
+    return {"file": os.path.basename(model_path), "size": os.path.getsize(model_path)}
+
+
+def llama_kwargs(settings: Dict[str, Any]) -> Dict[str, Any]:
+    """llama_cpp.Llama keyword arguments for a settings dict"""
+    import llama_cpp
+
+    kv_type = None if settings["kv_cache"] == "f16" else getattr(llama_cpp, f"GGML_TYPE_{settings['kv_cache'].upper()}")
+    kwargs = {
+        "n_threads": settings["n_threads"],
+        "n_threads_batch": settings["n_threads_batch"] or settings["n_threads"],
+        "n_batch": settings["n_batch"],
+        "n_ubatch": settings["n_batch"],
+        "n_ctx": settings["n_ctx"],
+        "use_mlock": settings["use_mlock"],
+        "flash_attn": settings["flash_attn"],
+    }
+    if kv_type is not None:
+        kwargs["type_k"] = kwargs["type_v"] = kv_type
+    return kwargs
+
+
+def pin_process(settings: Dict[str, Any]):
+    """Apply the profile's CPU affinity to every thread of this process (threads started later inherit it)"""
+    if settings.get("cpu_affinity") != "physical" or not hasattr(os, "sched_setaffinity"):
+        return
+    cpus = physical_cpus()
+    for task in os.listdir("/proc/self/task"):
+        try:
+            os.sched_setaffinity(int(task), cpus)
+        except OSError:
+            pass
+    logger.info(f"Pinned to {len(cpus)} CPUs, one per physical core: {cpus}")
+
+
+def load_profile(path: str, model_path: str) -> Dict[str, Any]:
+    """Settings from a profile file, {} if there is none or it was tuned for another host or model"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as profile_file:
+            profile = json.load(profile_file)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"llama.cpp profile {path} not readable ({e}), using defaults")
+        return {}
+    if profile.get("version") != PROFILE_VERSION:
+        logger.warning(f"llama.cpp profile {path} has version {profile.get('version')}, expected {PROFILE_VERSION}, "
+                       f"run autotune.py again")
+        return {}
+    host = host_info()
+    if {key: profile.get("host", {}).get(key) for key in ("cpus", "processor")} != \
+            {key: host[key] for key in ("cpus", "processor")}:
+        logger.warning(f"llama.cpp profile {path} was tuned on another host ({profile.get('host')}), "
+                       f"using defaults, run autotune.py on this host")
+        return {}
+    if profile.get("model") != model_info(model_path):
+        logger.warning(f"llama.cpp profile {path} was tuned for another model ({profile.get('model')}), using defaults")
+        return {}
+    settings = {key: value for key, value in profile.get("settings", {}).items() if key in DEFAULT_SETTINGS}
+    logger.info(f"Loaded llama.cpp profile {path}: {settings}")
+    return settings
+
+
+def _measure_worker(model_path: str, settings: Dict[str, Any], prompt_tokens: int, gen_tokens: int,
+                    repeats: int, conn):
+    """Candidate process: load the model, evaluate a prompt and generate tokens `repeats` times"""
+    try:
+        pin_process(settings)
+        from llama_cpp import Llama
+
+        started = time.perf_counter()
+        model = Llama(model_path=model_path, verbose=False, **llama_kwargs(settings))
+        load_seconds = time.perf_counter() - started
+        text = _PROMPT_TEXT * (prompt_tokens // 8 + 1)
+        tokens = model.tokenize(text.encode("utf-8"), add_bos=True)[:prompt_tokens]
+        model.eval(tokens[:8])  # Warm-up
+        prompt_speeds, gen_speeds = [], []
+        for _ in range(repeats):
+            model.reset()
+            started = time.perf_counter()
+            model.eval(tokens)
+            prompt_speeds.append(len(tokens) / (time.perf_counter() - started))
+            # Generation speed does not depend on which tokens are decoded, one token per step like sampling
+            started = time.perf_counter()
+            for index in range(gen_tokens):
+                model.eval([tokens[index % len(tokens)]])
+            gen_speeds.append(gen_tokens / (time.perf_counter() - started))
+        conn.send(("done", {
+            "prompt_tokens_per_second": round(statistics.median(prompt_speeds), 2),
+            "generated_tokens_per_second": round(statistics.median(gen_speeds), 2),
+            "load_seconds": round(load_seconds, 2),
+        }))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class Autotuner:
+    """Coordinate search over llama.cpp settings, scored by the time of one representative request"""
+
+    def __init__(self, model_path: str, prompt_tokens: int = 512, gen_tokens: int = 128, repeats: int = 3,
+                 min_ctx: int = 4096, min_gain: float = 0.03, timeout: float = 600):
+        self.model_path = model_path
+        self.prompt_tokens = prompt_tokens
+        self.gen_tokens = gen_tokens
+        self.repeats = repeats
+        self.min_ctx = max(min_ctx, prompt_tokens + gen_tokens)
+        self.min_gain = min_gain
+        self.timeout = timeout
+        self.trials: List[Dict[str, Any]] = []
+
+    def measure(self, settings: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Speeds of one candidate (in a spawned process), None if llama.cpp failed or timed out"""
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_measure_worker,
+            args=(self.model_path, settings, self.prompt_tokens, self.gen_tokens, self.repeats, child_conn),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        result = None
+        if conn.poll(self.timeout):
+            try:
+                kind, payload = conn.recv()
+            except EOFError:
+                kind, payload = "error", f"process exited with code {process.exitcode}"
+        else:
+            kind, payload = "error", f"no result within {self.timeout:g}s"
+        process.kill()
+        process.join()
+        if kind == "done":
+            result = payload
+            result["seconds_per_request"] = round(self.score(result), 4)
+        self.trials.append({"settings": dict(settings), "result": result, "error": None if result else payload})
+        speeds = (f"prompt {result['prompt_tokens_per_second']:.1f} tok/s, generation "
+                  f"{result['generated_tokens_per_second']:.1f} tok/s, {result['seconds_per_request']:.3f}s/request"
+                  if result else f"failed ({payload})")
+        logger.info(f"{_describe(settings)}: {speeds}")
+        return result
+
+    def score(self, result: Dict[str, Any]) -> float:
+        """Seconds for one request of prompt_tokens + gen_tokens (lower is better)"""
+        return (self.prompt_tokens / result["prompt_tokens_per_second"]
+                + self.gen_tokens / result["generated_tokens_per_second"])
+
+    def search_space(self) -> List[Tuple[str, List[Any]]]:
+        """Parameters in tuning order with their candidates (first candidate of each is preferred on ties)"""
+        cpus, physical = len(available_cpus()), len(physical_cpus())
+        threads = sorted({n for n in (1, 2, 4, 8, 12, 16, 24, 32, 48, 64) if n <= cpus} | {physical, cpus})
+        space = [
+            ("n_threads", threads),
+            ("n_threads_batch", [None] + threads),
+            ("n_batch", [n for n in (512, 128, 256, 1024, 2048) if n <= self.min_ctx]),
+            ("kv_cache", [("f16", False), ("f16", True), ("q8_0", True), ("q4_0", True)]),
+            ("use_mlock", [False, True]),
+            ("n_ctx", [self.min_ctx, self.min_ctx * 2]),
+        ]
+        if physical < cpus:
+            space.append(("cpu_affinity", ["all", "physical"]))
+        return space
+
+    def run(self) -> Dict[str, Any]:
+        """Tune and return the profile (best settings, baseline and best results, all trials)"""
+        best = dict(DEFAULT_SETTINGS, n_threads=min(DEFAULT_SETTINGS["n_threads"], len(available_cpus())),
+                    n_ctx=self.min_ctx)
+        baseline = best_result = self.measure(best)
+        if baseline is None:
+            raise RuntimeError(f"The model does not load with the default settings: {self.trials[-1]['error']}")
+        for name, candidates in self.search_space():
+            for candidate in candidates:
+                settings = dict(best)
+                if name == "kv_cache":
+                    settings["kv_cache"], settings["flash_attn"] = candidate
+                else:
+                    settings[name] = candidate
+                if settings == best:
+                    continue
+                result = self.measure(settings)
+                if result and result["seconds_per_request"] < best_result["seconds_per_request"] * (1 - self.min_gain):
+                    best, best_result = settings, result
+        logger.info(f"Best: {_describe(best)}, {best_result['seconds_per_request']:.3f}s/request "
+                    f"(defaults: {baseline['seconds_per_request']:.3f}s/request)")
+        return {
+            "version": PROFILE_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "host": host_info(),
+            "model": model_info(self.model_path),
+            "workload": {"prompt_tokens": self.prompt_tokens, "gen_tokens": self.gen_tokens, "repeats": self.repeats},
+            "settings": best,
+            "result": best_result,
+            "baseline": {"settings": self.trials[0]["settings"], "result": baseline},
+            "trials": self.trials,
+        }
+
+
+def _describe(settings: Dict[str, Any]) -> str:
+    return ", ".join(f"{key}={value}" for key, value in settings.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark llama.cpp settings on this host and save the fastest profile")
+    parser.add_argument("--model", default=os.getenv("LLAMA_MODEL_PATH", DEFAULT_MODEL_PATH), help="GGUF model file")
+    parser.add_argument("--output", help="Profile file (default: next to the model, <model>.profile.json)")
+    parser.add_argument("--prompt-tokens", type=int, default=512, help="Prompt tokens evaluated per measurement")
+    parser.add_argument("--gen-tokens", type=int, default=128, help="Tokens generated per measurement")
+    parser.add_argument("--repeats", type=int, default=3, help="Measurements per candidate (median is used)")
+    parser.add_argument("--min-ctx", type=int, default=4096,
+                        help="Smallest context window (the agent needs room for history and answers)")
+    parser.add_argument("--min-gain", type=float, default=0.03,
+                        help="Relative improvement a candidate needs to replace the current best")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds per candidate")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if not os.path.exists(args.model):
+        parser.error(f"Model file does not exist: {args.model}")
+    tuner = Autotuner(args.model, prompt_tokens=args.prompt_tokens, gen_tokens=args.gen_tokens, repeats=args.repeats,
+                      min_ctx=args.min_ctx, min_gain=args.min_gain, timeout=args.timeout)
+    profile = tuner.run()
+    output = args.output or default_profile_path(args.model)
+    with open(output, "w", encoding="utf-8") as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    baseline, best = profile["baseline"]["result"], profile["result"]
+    print(f"Profile written to {output} ({len(tuner.trials)} candidates)")
+    for label, result in (("defaults", baseline), ("tuned", best)):
+        print(f"  {label:8s} prompt {result['prompt_tokens_per_second']:8.1f} tok/s  "
+              f"generation {result['generated_tokens_per_second']:7.1f} tok/s  {result['seconds_per_request']:.3f}s/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+Benchmark - End-to-end load and latency benchmark for the chat and MCP servers
+
+Starts mcp_server.py and chat_server.py (with the deterministic StubLlamaCPP, no model file
+needed), replays a JSONL prompt corpus plus synthetic request mixes at a fixed concurrency
+and writes p50/p95/p99 latency, throughput and error rate per scenario to a JSON file.
+
+    python benchmarks/bench.py --concurrency 8 --requests 200
+    python benchmarks/bench.py --baseline benchmarks/results/previous.json
+    python benchmarks/bench.py --mcp-transport streamable-http --mcp-workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Synthetic request mixes, each exercises a different path through /chat
+SYNTHETIC_MIXES = {
+    # Answered by precheck_message, no agent
+    "chat_non_math": lambda rng: rng.choice(["hello", "how are you today?", "tell me a joke", "good morning"]),
+    # Plain arithmetic, answered by the fast path with one MCP tools/call
+    "chat_fast_path": lambda rng: f"{rng.randint(1, 999)} {rng.choice('+-*/')} {rng.randint(1, 999)}",
+    # Full agent run (stub LLM + tool call); random numbers keep the response cache cold
+    "chat_agent": lambda rng: (
+        f"I bought {rng.randint(2, 50)} boxes, each box costs {rng.randint(2, 99)} dollars, "
+        f"please calculate {rng.randint(2, 50)} * {rng.randint(2, 99)} + {rng.randint(1, 20)}"
+    ),
+    # The same few agent questions over and over, served by the response cache after the first miss
+    "chat_cached": lambda rng: f"I have some apples, please calculate {rng.randint(1, 4)} * 12 + 3",
+}
+
+# Per agent run metrics on the chat server's /metrics (histogram sum / number of runs)
+AGENT_METRICS = {
+    "iterations": "chat_agent_iterations",
+    "tool_calls": "chat_agent_tool_calls",
+    "generated_tokens": "chat_agent_generated_tokens",
+}
+# How budgeted ReAct steps ended (chat_agent_step_endings_total reasons)
+STEP_ENDINGS = ("line_complete", "max_tokens", "model")
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load_corpus(path: str) -> List[str]:
+    """Messages from a JSONL file (objects with a "message" field, other lines are skipped)"""
+    messages = []
+    with open(path, encoding="utf-8") as corpus:
+        for line in corpus:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and isinstance(entry.get("message"), str):
+                messages.append(entry["message"])
+    if not messages:
+        raise ValueError(f"Corpus {path} has no lines with a \"message\" field")
+    return messages
+
+
+async def run_scenario(name: str, endpoint: str, make_call: Callable[[int], Awaitable[bool]],
+                       total: int, concurrency: int) -> dict:
+    """Run `total` calls with `concurrency` in flight, make_call returns False for errors"""
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for index in counter:
+            started = time.perf_counter()
+            try:
+                ok = await make_call(index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "endpoint": endpoint,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+    }
+    print(f"{name:<18} {endpoint:<16} {result['throughput_rps']:>8.1f} req/s  "
+          f"p50 {result['latency_ms']['p50']:>8.1f} ms  p95 {result['latency_ms']['p95']:>8.1f} ms  "
+          f"p99 {result['latency_ms']['p99']:>8.1f} ms  errors {errors}")
+    return result
+
+
+def chat_call(client: httpx.AsyncClient, messages: List[str]):
+    async def call(index: int) -> bool:
+        response = await client.post("/chat", json={"message": messages[index % len(messages)]})
+        return response.status_code == 200 and not response.json()["raw_response"].startswith(("Timeout", "Error"))
+    return call
+
+
+async def scrape_metrics(client: httpx.AsyncClient) -> Dict[str, float]:
+    """Samples of the chat server's /metrics (counter totals, histogram sums and counts), labelled as name{k=v,...}"""
+    text = (await client.get("/metrics")).text
+    return {
+        sample.name + (
+            "{" + ",".join(f"{key}={value}" for key, value in sorted(sample.labels.items())) + "}"
+            if sample.labels else ""
+        ): sample.value
+        for family in text_string_to_metric_families(text)
+        for sample in family.samples
+    }
+
+
+def agent_summary(before: Dict[str, float], after: Dict[str, float]) -> dict:
+    """Agent runs during the benchmark and their mean iterations, tool calls and generated tokens"""
+    def delta(name: str) -> float:
+        return after.get(name, 0.0) - before.get(name, 0.0)
+
+    runs = delta("chat_agent_iterations_count")
+    summary = {"runs": int(runs), "parse_failures": int(delta("chat_agent_parse_failures_total"))}
+    for key, metric in AGENT_METRICS.items():
+        summary[f"mean_{key}"] = round(delta(f"{metric}_sum") / runs, 2) if runs else 0.0
+    # line_complete on answer steps shows the early stop after the Answer line works
+    summary["answer_step_endings"] = {
+        reason: int(delta(f"chat_agent_step_endings_total{{reason={reason},step=answer}}")) for reason in STEP_ENDINGS
+    }
+    print(f"Agent runs: {summary['runs']}  iterations/run {summary['mean_iterations']:.2f}  "
+          f"tool calls/run {summary['mean_tool_calls']:.2f}  tokens/run {summary['mean_generated_tokens']:.1f}  "
+          f"parse failures {summary['parse_failures']}")
+    print("Answer steps: " + "  ".join(f"{reason} {count}" for reason, count in summary["answer_step_endings"].items()))
+    return summary
+
+
+def get_call(client: httpx.AsyncClient, path: str):
+    async def call(index: int) -> bool:
+        return (await client.get(path)).status_code == 200
+    return call
+
+
+async def run_mcp_scenarios(mcp_url: str, transport: str, total: int, concurrency: int,
+                            rng: random.Random) -> Dict[str, dict]:
+    """Direct MCP tools/call over one persistent session, bypassing the chat server"""
+    from mcp import ClientSession
+    from mcp.client.sse import sse_client
+    from mcp.client.streamable_http import streamablehttp_client
+
+    results = {}
+    if transport == "streamable-http":
+        client = streamablehttp_client(f"{mcp_url}/mcp")
+    else:
+        client = sse_client(f"{mcp_url}/sse")
+    async with client as streams:
+        async with ClientSession(streams[0], streams[1]) as session:
+            await session.initialize()
+            expressions = [f"{rng.randint(1, 99)}*({rng.randint(1, 99)}+{rng.randint(1, 99)})" for _ in range(64)]
+
+            async def call_expression(index: int) -> bool:
+                result = await session.call_tool("calculate_expression", {"expression": expressions[index % 64]})
+                return not result.isError
+
+            async def call_add(index: int) -> bool:
+                result = await session.call_tool("add_numbers", {"a": index, "b": 1.5})
+                return not result.isError
+
+            results["mcp_add_numbers"] = await run_scenario(
+                "mcp_add_numbers", "tools/call", call_add, total, concurrency)
+            results["mcp_calculate"] = await run_scenario(
+                "mcp_calculate", "tools/call", call_expression, total, concurrency)
+    return results
+
+
+def start_process(args: List[str], env: dict, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen([sys.executable] + args, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_port(host: str, port: int, timeout: float):
+    """Wait until a TCP port accepts connections (the MCP /sse endpoint never finishes a GET)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"{host}:{port} did not accept connections within {timeout:.0f}s")
+
+
+async def wait_ready(url: str, timeout: float, check: Optional[Callable[[httpx.Response], bool]] = None):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(url)
+                if response.status_code < 500 and (check is None or check(response)):
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+
+async def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    # Before starting the servers, so a bad corpus fails at once
+    corpus = load_corpus(args.corpus) if args.corpus else []
+    print(f"Corpus: {len(corpus)} messages from {args.corpus or '(none)'}")
+    mcp_url = "http://127.0.0.1:8100"
+    chat_url = f"http://127.0.0.1:{args.chat_port}"
+    log_dir = os.path.join(BENCH_DIR, "results")
+    os.makedirs(log_dir, exist_ok=True)
+
+    env = dict(os.environ)
+    env.update({
+        "MCP_SERVER_URL": mcp_url,
+        "MCP_TRANSPORT": args.mcp_transport,
+        "MCP_WORKERS": str(args.mcp_workers),
+        "CHAT_CACHE_PATH": "",
+        "BENCH_STUB_PROMPT_MS": str(args.prompt_ms),
+        "BENCH_STUB_TOKEN_MS": str(args.token_ms),
+        "PYTHONUNBUFFERED": "1",
+    })
+    processes = []
+    try:
+        if not args.external:
+            processes.append(start_process(["mcp_server.py"], env, os.path.join(log_dir, "mcp_server.log")))
+            await wait_port("127.0.0.1", 8100, 30)
+            processes.append(start_process(
+                [os.path.join(BENCH_DIR, "stub_chat_server.py"), "--port", str(args.chat_port)],
+                env, os.path.join(log_dir, "chat_server.log"),
+            ))
+        await wait_ready(f"{chat_url}/readyz", 60, check=lambda r: r.json().get("tools_count", 0) > 0)
+
+        scenarios: Dict[str, dict] = {}
+        async with httpx.AsyncClient(base_url=chat_url, timeout=args.timeout) as client:
+            metrics_before = await scrape_metrics(client)
+            if corpus:
+                scenarios["chat_corpus"] = await run_scenario(
+                    "chat_corpus", "/chat", chat_call(client, corpus), args.requests, args.concurrency)
+            for name, make_message in SYNTHETIC_MIXES.items():
+                messages = [make_message(rng) for _ in range(args.requests)]
+                scenarios[name] = await run_scenario(
+                    name, "/chat", chat_call(client, messages), args.requests, args.concurrency)
+            scenarios["tools"] = await run_scenario(
+                "tools", "/tools", get_call(client, "/tools"), args.requests, args.concurrency)
+            scenarios["health"] = await run_scenario(
+                "health", "/health", get_call(client, "/health"), args.requests, args.concurrency)
+            server_stats = (await client.get("/stats")).json()
+            agent = agent_summary(metrics_before, await scrape_metrics(client))
+        scenarios.update(await run_mcp_scenarios(mcp_url, args.mcp_transport, args.requests, args.concurrency, rng))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "concurrency": args.concurrency,
+            "requests_per_scenario": args.requests,
+            "stub_prompt_ms": args.prompt_ms,
+            "stub_token_ms": args.token_ms,
+            "seed": args.seed,
+            "mcp_transport": args.mcp_transport,
+            "mcp_workers": args.mcp_workers,
+            "agent_mode": os.getenv("AGENT_MODE", "react"),
+        },
+        "scenarios": scenarios,
+        "agent": agent,
+        "server_stats": server_stats,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline: dict, current: dict):
+    """Print latency/throughput change per scenario against a previous result file"""
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    for name, result in current["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        changes = []
+        for key in ("p50", "p95", "p99"):
+            before, after = previous["latency_ms"][key], result["latency_ms"][key]
+            change = (after - before) / before * 100 if before else 0.0
+            changes.append(f"{key} {change:+6.1f}%")
+        before, after = previous["throughput_rps"], result["throughput_rps"]
+        changes.append(f"throughput {((after - before) / before * 100 if before else 0.0):+6.1f}%")
+        print(f"  {name:<18} " + "  ".join(changes))
+    previous_agent = baseline.get("agent")
+    if previous_agent:
+        changes = []
+        for key in ("mean_iterations", "mean_generated_tokens"):
+            before, after = previous_agent[key], current["agent"][key]
+            changes.append(f"{key} {before:.2f} -> {after:.2f}")
+        print(f"  {'agent':<18} " + "  ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load and latency benchmark (stub LLM)")
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus.jsonl"),
+                        help="JSONL prompt corpus, lines with a \"message\" field are replayed (\"\" = none)")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--prompt-ms", type=float, default=20, help="Stub LLM prompt evaluation time per step")
+    parser.add_argument("--token-ms", type=float, default=5, help="Stub LLM time per generated token")
+    parser.add_argument("--chat-port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--mcp-transport", choices=["sse", "streamable-http"], default="sse",
+                        help="MCP transport used by the MCP server, the chat server and the tools/call scenarios")
+    parser.add_argument("--mcp-workers", type=int, default=1, help="MCP server worker processes (streamable-http)")
+    parser.add_argument("--external", action="store_true",
+                        help="Benchmark already running servers instead of starting them")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/bench-<commit>-<time>.json)")
+    parser.add_argument("--baseline", help="Previous result file to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"bench-{results['meta']['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    with open(output, "w", encoding="utf-8") as result_file:
+        json.dump(results, result_file, indent=2)
+    print(f"\nResults written to {output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            compare(json.load(baseline_file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Stub Chat Server - Run chat_server.py with StubLlamaCPP instead of the real model
+
+Used by bench.py so the whole pipeline (FastAPI, scheduler, cache, fast path, MCP pool and
+ReActAgent) can be benchmarked on machines without a model file.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Replicas would start real llama.cpp processes
+os.environ["LLAMA_REPLICAS"] = "1"
+
+import uvicorn  # noqa: E402
+
+import chat_server  # noqa: E402
+from stub_llm import StubLlamaCPP  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    # init_agent fingerprints the model file, so give it a small real file
+    model_file = tempfile.NamedTemporaryFile(prefix="stub-model-", suffix=".gguf", delete=False)
+    model_file.write(b"stub")
+    model_file.close()
+    chat_server.find_model_file = lambda: model_file.name
+    chat_server.LocalLlamaCPP = StubLlamaCPP
+    try:
+        uvicorn.run(chat_server.app, host=args.host, port=args.port, log_level="warning")
+    finally:
+        os.unlink(model_file.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Stub LLM - Deterministic stand-in for LocalLlamaCPP used by the benchmarks
+
+Follows the ReAct format the agent expects: the first step calls calculate_expression with
+the arithmetic found in the user message (or answers directly when there is none), the step
+after an observation answers with the tool result. For the plan agent (AGENT_MODE=plan) it
+returns the equivalent one-call JSON plan. Prompt evaluation and token generation
+are simulated with blocking sleeps, like llama.cpp blocks its calling thread; per-call
+max_tokens and stop (the agent's token budgets) end the generation like they do in llama.cpp.
+"""
+import json
+import os
+import re
+import time
+from typing import Any, Optional, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+# Simulated cost (milliseconds)
+PROMPT_MS = float(os.getenv("BENCH_STUB_PROMPT_MS", "20"))
+TOKEN_MS = float(os.getenv("BENCH_STUB_TOKEN_MS", "5"))
+
+_EXPRESSION = re.compile(r"[-(]*\d+(?:\.\d+)?(?:\s*[-+*/]\s*[(]*\s*\d+(?:\.\d+)?\s*[)]*)+")
+
+
+class StubLlamaCPP(CustomLLM):
+    """Accepts the LlamaCPP constructor arguments used by init_agent and generates deterministic ReAct steps"""
+
+    model_path: str = ""
+    temperature: float = 0.1
+    max_new_tokens: int = 256
+    context_window: int = 4096
+
+    def __init__(self, model_path: str = "", temperature: float = 0.1, max_new_tokens: int = 256,
+                 context_window: int = 4096, **kwargs: Any):
+        # verbose, model_kwargs, generate_kwargs... only matter for the real model
+        super().__init__(model_path=model_path, temperature=temperature,
+                         max_new_tokens=max_new_tokens, context_window=context_window)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLlamaCPP"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=self.context_window, num_output=self.max_new_tokens,
+                           model_name=self.model_path)
+
+    # Same hooks as LocalLlamaCPP, nothing to snapshot or constrain
+    def build_prefix_snapshot(self, prompts) -> Optional[int]:
+        return None
+
+    def prefix_stats(self) -> dict:
+        return {"enabled": False}
+
+    def set_grammar(self, grammar: Optional[str]):
+        pass
+
+    def _respond(self, messages: Sequence[ChatMessage]) -> str:
+        last = messages[-1].content or ""
+        if last.startswith("Observation:"):
+            observation = last[len("Observation:"):].strip()
+            # MCP tool output is a CallToolResult repr, answer with its text content
+            text = re.search(r"text='([^']*)'", observation)
+            if text:
+                observation = text.group(1)
+            return f"Thought: I can answer without using any more tools.\nAnswer: The answer is {observation}"
+        user = next((m.content or "" for m in reversed(messages) if m.role == MessageRole.USER), "")
+        match = _EXPRESSION.search(user)
+        if "JSON plan" in (messages[0].content or ""):
+            if match is None:
+                return json.dumps({"calls": [], "answer": "Hello! I can help you with calculations."})
+            return json.dumps({
+                "calls": [{"tool": "calculate_expression", "args": {"expression": match.group(0).strip()}}],
+                "answer": "The answer is {0}",
+            })
+        if match is None:
+            return "Thought: No calculation is needed.\nAnswer: Hello! I can help you with calculations."
+        arguments = json.dumps({"expression": match.group(0).strip()})
+        return (
+            "Thought: The user wants a calculation, I need to use a tool.\n"
+            f"Action: calculate_expression\nAction Input: {arguments}"
+        )
+
+    def _generate(self, text: str, kwargs: dict):
+        for stop in kwargs.get("stop") or []:
+            if stop in text:
+                text = text[:text.index(stop)]
+        time.sleep(PROMPT_MS / 1000)
+        generated = ""
+        for token in re.findall(r"\S+\s*|\s+", text)[:kwargs.get("max_tokens") or None]:
+            time.sleep(TOKEN_MS / 1000)
+            generated += token
+            yield token, generated
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        text = ""
+        for _, text in self._generate(self._respond(messages), kwargs):
+            pass
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text))
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        response = self._respond(messages)
+
+        def gen() -> ChatResponseGen:
+            for delta, text in self._generate(response, kwargs):
+                yield ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text), delta=delta)
+
+        return gen()
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(
+            text=self.chat([ChatMessage(role=MessageRole.USER, content=prompt)], **kwargs).message.content
+        )
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            for response in self.stream_chat([ChatMessage(role=MessageRole.USER, content=prompt)], **kwargs):
+                yield CompletionResponse(text=response.message.content, delta=response.delta)
+
+        return gen()
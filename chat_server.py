@@ -2,18 +2,61 @@
 FastAPI Chat Server - Uses LlamaIndex to automatically handle tool calls
 """
 import asyncio
+import hashlib
+import json
 import logging
 import os
+import time
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from llama_index.core.agent import ReActAgent
-from llama_index.llms.llama_cpp import LlamaCPP
-from llama_index.tools.mcp import BasicMCPClient, McpToolSpec
+from llama_index.core.agent.workflow import AgentOutput, AgentStream, ToolCall, ToolCallResult
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.llms import ChatMessage
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.workflow import Context
+from llama_index.core.workflow.errors import WorkflowRuntimeError
+from llama_index.tools.mcp import McpToolSpec
 from pydantic import BaseModel
 
+from autotune import DEFAULT_SETTINGS, default_profile_path, llama_kwargs, load_profile, pin_process
+from inference_queue import (
+    DeadlineExceededError,
+    InferenceScheduler,
+    QueueFullError,
+    SchedulerUnavailableError,
+)
+from intent_router import IntentRouter
+from llm_backend import LLMMetricsHandler, LocalLlamaCPP
+from llm_batch import BatchEngine, BatchLlamaCPP
+from llm_pool import ReplicaLLM, ReplicaPool
+from mcp_pool import MCPSessionPool
+from mcp_router import MCPRouter
+from plan_agent import PlanAgent
+from react_grammar import build_react_grammar
+from token_budget import BudgetedReActAgent, BudgetUsage, current_usage
+from metrics import (
+    AGENT_GENERATED_TOKENS,
+    AGENT_ITERATIONS,
+    AGENT_PARSE_FAILURES,
+    AGENT_PLANS,
+    AGENT_TOOL_CALLS,
+    CHAT_OUTCOMES,
+    CHAT_REGISTRY,
+    CHAT_STAGE_SECONDS,
+    HTTP_REQUEST_SECONDS,
+    MCP_CONNECT_ATTEMPTS,
+    STARTUP_STAGE_SECONDS,
+    render,
+    timed,
+)
+from response_cache import ResponseCache
+from session_store import SessionStore, current_session
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -26,16 +69,33 @@ async def lifespan(app: FastAPI):
     """Application lifecycle management: startup and shutdown"""
     # Initialize on startup
     try:
-        await init_agent()
-        logger.info("Chat server started successfully")
+        # Persistent MCP sessions shared by /chat, /tools and /health (connect in the background)
+        await mcp_pool.start()
+        await inference_scheduler.start()
     except Exception as e:
         logger.error(f"Startup failed: {e}")
         raise
+    # Model load and agent creation continue in the background, /readyz reports when they are done
+    background_tasks = [
+        asyncio.create_task(init_agent()),
+        asyncio.create_task(watch_tool_catalog()),
+    ]
+    logger.info("Chat server started, loading agent (see /readyz)")
     
     yield  # Application running
     
     # Cleanup resources on shutdown
     logger.info("Chat server is shutting down...")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await inference_scheduler.stop()
+    await mcp_pool.close()
+    response_cache.close()
+    if llm_pool is not None:
+        llm_pool.close()
+    if batch_llm is not None:
+        batch_llm.engine.close()
 
 app = FastAPI(title="FastMCP Chat Server", lifespan=lifespan)
 
@@ -48,90 +108,236 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Request latency histogram per route (until response start, streams are still running)"""
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.labels(
+        path=route.path if route is not None else "unmatched",
+        method=request.method,
+        status=str(response.status_code),
+    ).observe(time.perf_counter() - started)
+    return response
+
+# LLM time to first token, tokens and tokens/s from LlamaIndex instrumentation events
+get_dispatcher().add_event_handler(LLMMetricsHandler())
+
 # Global Agent instance
 agent: Optional[ReActAgent] = None
+# "react": ReAct loop (tool choice and answer are separate LLM calls), "plan": one LLM call for a
+# plan of tool calls, answer rendered from its template, ReAct only when the plan is not usable
+agent_mode = os.getenv("AGENT_MODE", "react")
+plan_agent: Optional[PlanAgent] = None
 # MCP server URL
 mcp_server_url = os.getenv("MCP_SERVER_URL", "http://localhost:8100")
-# SSE endpoint URL (FastMCP uses SSE protocol)
-mcp_sse_url = f"{mcp_server_url}/sse"
+# Several MCP servers (comma separated): tool catalogs are merged, calls go to the least loaded healthy server
+mcp_server_urls = [url.strip().rstrip("/") for url in os.getenv("MCP_SERVER_URLS", mcp_server_url).split(",") if url.strip()]
+# MCP transport, must match the server's MCP_TRANSPORT ("sse" or "streamable-http")
+mcp_transport = os.getenv("MCP_TRANSPORT", "sse")
+# Pooled MCP sessions and tool catalog cache per server (refreshed on tools/list_changed or TTL),
+# endpoint /sse for the SSE transport, /mcp for streamable HTTP
+mcp_pool = MCPRouter(
+    [
+        MCPSessionPool(
+            url=f"{url}/mcp" if mcp_transport == "streamable-http" else f"{url}/sse",
+            transport=mcp_transport,
+            size=int(os.getenv("MCP_POOL_SIZE", "1")),
+            timeout=10,
+            catalog_ttl=float(os.getenv("MCP_TOOLS_CACHE_TTL", "300")),
+        )
+        for url in mcp_server_urls
+    ],
+    # Health prober: ping every server every interval, open its circuit after consecutive failures
+    # and send it no calls until the reset time has passed and a probe or call succeeds again
+    probe_interval=float(os.getenv("MCP_HEALTH_INTERVAL", "5")),
+    probe_timeout=float(os.getenv("MCP_HEALTH_TIMEOUT", "2")),
+    failure_threshold=int(os.getenv("MCP_BREAKER_FAILURES", "3")),
+    reset_timeout=float(os.getenv("MCP_BREAKER_RESET", "15")),
+    call_timeout=float(os.getenv("MCP_CALL_TIMEOUT", "30")),  # 0 = no limit
+)
+# Model replicas in separate processes, each pinned to its own cores (1 = in-process LlamaCPP)
+llama_replicas = max(1, int(os.getenv("LLAMA_REPLICAS", "1")))
+llama_threads_per_replica = int(os.getenv("LLAMA_THREADS_PER_REPLICA", "0")) or None  # Default: cores / replicas
+llm_pool: Optional[ReplicaPool] = None
+# llama.cpp settings measured on this host by autotune.py (default: <model>.profile.json next to the model),
+# explicit environment settings such as LLAMA_THREADS_PER_REPLICA take precedence
+llama_profile_path = os.getenv("LLAMA_PROFILE", "")
+llama_settings: Dict[str, Any] = dict(DEFAULT_SETTINGS)  # Set by load_llm
+# Admission queue in front of the agent (one worker per model replica unless overridden)
+inference_scheduler = InferenceScheduler(
+    workers=int(os.getenv("CHAT_WORKERS", str(llama_replicas))),
+    max_queue=int(os.getenv("CHAT_QUEUE_SIZE", "16")),
+    default_timeout=float(os.getenv("CHAT_TIMEOUT", "120")),
+)
+# Deterministic fast path: plain arithmetic is sent straight to the MCP tool, bypassing the LLM
+fast_path_enabled = os.getenv("FAST_PATH_ENABLED", "1") == "1"
+intent_router = IntentRouter()
+# Response cache for repeated questions (answers are effectively deterministic at temperature=0.1)
+response_cache_enabled = os.getenv("CHAT_CACHE_ENABLED", "1") == "1"
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("CHAT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "3600")),
+    path=os.getenv("CHAT_CACHE_PATH") or None,
+)
+# Fingerprint of model, generation parameters and system prompt (set by init_agent)
+agent_fingerprint = ""
+# Tool catalog version the agent's tools were built from (0 = no tools)
+agent_catalog_version = 0
+# Set when model loading or agent creation failed, /livez then reports the replica as dead
+startup_error: Optional[str] = None
+# Seconds to wait for MCP after the model is loaded before starting without tools
+mcp_startup_wait = float(os.getenv("MCP_STARTUP_WAIT", "10"))
+# Seconds between checks for tool catalog changes (attaches tools when MCP becomes reachable)
+mcp_tools_watch_interval = float(os.getenv("MCP_TOOLS_WATCH_INTERVAL", "5"))
+# MCP tools not given to the agent (batch and administrative tools the system prompt does not
+# describe, they only lengthen the prompt, prefix snapshot and grammar), comma separated
+agent_excluded_tools = {name.strip() for name in os.getenv(
+    "AGENT_EXCLUDED_TOOLS", "add_numbers_batch,multiply_numbers_batch,evaluate_expression_batch,tool_cache_admin"
+).split(",") if name.strip()}
+# Evaluate the fixed system prompt + tool description prefix once and restore its KV state per request
+prefix_cache_enabled = os.getenv("LLAMA_PREFIX_CACHE", "1") == "1"
+# Constrain agent steps with a GBNF grammar built from the tool schemas (valid ReAct output only)
+react_grammar_enabled = os.getenv("LLAMA_REACT_GRAMMAR", "0") == "1"
+# Per-step generation limits (token_budget.py): short budgets for tool selection and final answers,
+# sized to the message or tool result the step repeats, streamed steps end once their line is complete
+agent_token_budgets = os.getenv("AGENT_TOKEN_BUDGETS", "1") == "1"
+agent_action_max_tokens = int(os.getenv("AGENT_ACTION_MAX_TOKENS", "96"))
+agent_answer_max_tokens = int(os.getenv("AGENT_ANSWER_MAX_TOKENS", "64"))
+# /chat/batch: separate llama.cpp context decoding up to CHAT_BATCH_SLOTS sequences per step (loaded on first use)
+batch_slots = max(1, int(os.getenv("CHAT_BATCH_SLOTS", "4")))
+batch_context = int(os.getenv("CHAT_BATCH_CONTEXT", "2048"))  # Tokens per slot
+batch_threads = int(os.getenv("CHAT_BATCH_THREADS", "0")) or None  # Default: same as the main model
+batch_max_messages = int(os.getenv("CHAT_BATCH_MAX_MESSAGES", "1000"))
+batch_llm: Optional[BatchLlamaCPP] = None
+batch_agent: Optional[ReActAgent] = None
+batch_agent_source: Optional[ReActAgent] = None  # Main agent the batch agent's tools were copied from
+batch_plan_agent: Optional[PlanAgent] = None
+batch_lock = asyncio.Lock()
+# Multi-turn conversations (ChatRequest.session_id): history + llama.cpp KV state per session
+session_store = SessionStore(
+    max_sessions=int(os.getenv("CHAT_SESSION_MAX", "1000")),
+    max_bytes=int(float(os.getenv("CHAT_SESSION_MEMORY_MB", "1024")) * 1024 * 1024),
+    ttl=float(os.getenv("CHAT_SESSION_TTL", "1800")),
+    token_limit=3000,
+)
 
 # Request models
 class ChatRequest(BaseModel):
     message: str
+    priority: int = 0  # Higher priority requests are served first when queued
+    deadline: Optional[float] = None  # Seconds, defaults to CHAT_TIMEOUT
+    session_id: Optional[str] = None  # Continue this conversation (history kept server-side)
 
 class ChatResponse(BaseModel):
     raw_response: str  # Raw complete response
     tools_available: List[str]
+    session_id: Optional[str] = None
+
+class BatchChatRequest(BaseModel):
+    messages: List[str]
+    deadline: Optional[float] = None  # Seconds per message, defaults to CHAT_TIMEOUT
 
 async def init_agent():
-    """Initialize LlamaIndex Agent"""
-    global agent
+    """Initialize LlamaIndex Agent (model load and MCP connection run concurrently)"""
+    global startup_error
+    try:
+        # 1. Load Llama model in a worker thread, the event loop keeps serving /livez, /readyz
+        #    while the MCP sessions connect in the background (exponential backoff, see mcp_pool.py)
+        model_path = find_model_file()
+        load_started = time.perf_counter()
+        llm = await asyncio.to_thread(load_llm, model_path)
+        STARTUP_STAGE_SECONDS.labels(stage="model_load").set(time.perf_counter() - load_started)
+        logger.info("Model loaded successfully")
+        
+        # 2. Get MCP tools, if the server is not reachable yet the agent starts without tools and
+        #    watch_tool_catalog() attaches them as soon as it is
+        logger.info(f"Connecting to MCP servers: {', '.join(server.pool.url for server in mcp_pool.servers)}")
+        connect_started = time.perf_counter()
+        tools, catalog_version = await load_mcp_tools(wait=mcp_startup_wait)
+        STARTUP_STAGE_SECONDS.labels(stage="mcp_connect").set(time.perf_counter() - connect_started)
+        
+        # 3. Create ReActAgent (automatically handles tool calls)
+        await create_agent(llm, tools, catalog_version, model_path)
+        logger.info("Agent initialization complete, tool calls will be automatically handled by LlamaIndex")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        startup_error = f"{type(e).__name__}: {str(e)}"
+        logger.error(f"Startup failed: {startup_error}", exc_info=True)
+
+def load_llm(model_path: str):
+    """Load the model (in-process LlamaCPP or replica processes), blocking"""
+    global llm_pool, llama_settings
+    
+    llama_settings = {**DEFAULT_SETTINGS, **load_profile(llama_profile_path or default_profile_path(model_path), model_path)}
+    if llama_threads_per_replica:
+        llama_settings["n_threads"] = llama_threads_per_replica
+    model_kwargs = llama_kwargs(llama_settings)
+    n_ctx = model_kwargs.pop("n_ctx")
     
-    # 1. Load Llama model
-    model_path = find_model_file()
+    if llama_replicas > 1:
+        # Replicas map the same GGUF file (mmap), only the KV cache is per process; threads follow
+        # the replica's core set, the other profile settings apply to every replica
+        logger.info(f"Loading model: {model_path} ({llama_replicas} replicas)")
+        del model_kwargs["n_threads"], model_kwargs["n_threads_batch"]
+        llm_pool = ReplicaPool(
+            model_path=model_path,
+            replicas=llama_replicas,
+            threads_per_replica=llama_threads_per_replica,
+            model_kwargs={**model_kwargs, "n_ctx": n_ctx, "verbose": False},
+        )
+        llm_pool.start()
+        logger.info(f"Context length: {n_ctx}, CPU cores per replica: {[len(cores) for cores in llm_pool.core_sets]}")
+        return ReplicaLLM(
+            pool=llm_pool,
+            model_path=model_path,
+            temperature=0.1,
+            max_new_tokens=256,
+            context_window=n_ctx,
+        )
     
     logger.info(f"Loading model: {model_path}")
-    logger.info(f"Context length: 4096, CPU threads: 6")
+    logger.info(f"Context length: {n_ctx}, CPU threads: {model_kwargs['n_threads']} "
+                f"(prompt: {model_kwargs['n_threads_batch']}), n_batch: {model_kwargs['n_batch']}")
+    pin_process(llama_settings)
     
-    # Use LlamaIndex's LlamaCPP wrapper
+    # Use LlamaIndex's LlamaCPP wrapper (LocalLlamaCPP adds the prompt prefix snapshot)
     # LlamaCPP automatically wraps the underlying llama-cpp-python
-    llm = LlamaCPP(
+    return LocalLlamaCPP(
         model_path=model_path,
         temperature=0.1,
         max_new_tokens=256,  # Increase generation length to ensure complete response
-        context_window=4096,
+        context_window=n_ctx,
         verbose=False,
         # Underlying llama-cpp-python parameters passed through model_kwargs
         model_kwargs={
-            "n_threads": 6,
+            **model_kwargs,
             "n_predict": 256,  # Increase predicted token count to ensure complete response
         },
     )
-    logger.info("Model loaded successfully")
-    
-    # 2. Connect to FastMCP server to get tools
-    logger.info(f"Connecting to MCP server: {mcp_sse_url}")
-    tools = []
-    
-    # Wait for MCP server to start (retry logic)
-    max_retries = 15
-    retry_delay = 2  # seconds
+
+async def load_mcp_tools(wait: float):
+    """Build LlamaIndex tools from the pooled MCP catalog: (tools, catalog version), ([], 0) if unreachable"""
+    if not await mcp_pool.wait_connected(wait):
+        logger.warning(f"MCP server not reachable after {wait:.0f}s ({mcp_pool.last_error}), "
+                       f"starting without tools, they are attached once it is reachable")
+        return [], 0
+    try:
+        # McpToolSpec works on the pooled sessions (no new SSE handshake per call)
+        tools = await McpToolSpec(client=mcp_pool).to_tool_list_async()
+    except Exception as e:
+        logger.warning(f"Failed to load MCP tools: {type(e).__name__}: {str(e)}")
+        return [], 0
+    tools = [tool for tool in tools if tool.metadata.name not in agent_excluded_tools]
+    logger.info(f"MCP server connected successfully, found {len(tools)} tools: {[t.metadata.name for t in tools]}")
+    return tools, mcp_pool.catalog_version
+
+async def create_agent(llm, tools, catalog_version: int, model_path: str):
+    """Create the ReActAgent for a tool list and snapshot its prompt prefix (in a worker thread)"""
+    global agent, plan_agent, agent_fingerprint, agent_catalog_version
     
-    for attempt in range(max_retries):
-        try:
-            # Use BasicMCPClient to create client (supports SSE URL)
-            # BasicMCPClient automatically detects SSE endpoint (URL ends with /sse)
-            logger.debug(f"Attempting to create MCP client connection to: {mcp_sse_url}")
-            client = BasicMCPClient(command_or_url=mcp_sse_url, timeout=10)
-            # Create McpToolSpec
-            tool_spec = McpToolSpec(client=client)
-            # Use async method to get tool list in async environment
-            logger.debug("Getting tool list...")
-            tools = await tool_spec.to_tool_list_async()
-            logger.info(f"MCP server connected successfully, found {len(tools)} tools: {[t.metadata.name for t in tools]}")
-            break  # Successfully connected, exit retry loop
-            
-        except Exception as e:
-            # Handle exceptions (including ExceptionGroup)
-            error_msg = f"{type(e).__name__}: {str(e)}"
-            # If ExceptionGroup, extract all exception information
-            if hasattr(e, 'exceptions'):
-                errors = []
-                for exc in e.exceptions:
-                    errors.append(f"{type(exc).__name__}: {str(exc)}")
-                error_msg = "; ".join(errors)
-            
-            if attempt < max_retries - 1:
-                logger.info(f"Waiting for MCP server to start... (attempt {attempt + 1}/{max_retries}, error: {error_msg})")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.warning(f"MCP server connection failed: {error_msg}, will try to continue startup (tools may be unavailable)")
-                import traceback
-                logger.error(f"MCP connection detailed error:\n{traceback.format_exc()}")
-                tools = []
-
-    # 3. Create ReActAgent (automatically handles tool calls)
     # System prompt clearly guides Agent on when to use tools
     # Note: For non-mathematical questions (like greetings), reply directly without using any tools
     system_prompt = """You are a friendly math calculation assistant.
@@ -164,14 +370,168 @@ Correct examples (these are just explanations, do not execute):
 - Continuing iteration after getting tool result
 - Calling multiple tools for the same calculation problem"""
     
-    agent = ReActAgent(
-        tools=tools if tools else None,
-        llm=llm,
+    new_agent = new_react_agent(
+        llm,
+        tools,
+        system_prompt,
         verbose=True,  # Enable verbose logging to view tool call process
-        system_prompt=system_prompt
     )
     
-    logger.info("Agent initialization complete, tool calls will be automatically handled by LlamaIndex")
+    if react_grammar_enabled:
+        llm.set_grammar(build_react_grammar(tools))
+    new_plan_agent = PlanAgent(llm, tools, mcp_pool.call_tool) if agent_mode == "plan" else None
+    
+    if prefix_cache_enabled:
+        snapshot_started = time.perf_counter()
+        # Evaluates the prefix on the model, the event loop keeps serving meanwhile
+        await to_thread_uncancelled(build_prefix_snapshot, new_agent, llm, tools, new_plan_agent)
+        STARTUP_STAGE_SECONDS.labels(stage="prefix_snapshot").set(time.perf_counter() - snapshot_started)
+    
+    # Anything that changes answers must change the response cache fingerprint
+    # (the tool catalog is part of the cache key separately, see get_cached_response)
+    agent_fingerprint = hashlib.sha256(json.dumps({
+        "model": os.path.basename(model_path),
+        "model_size": os.path.getsize(model_path),
+        "temperature": llm.temperature,
+        "max_new_tokens": llm.max_new_tokens,
+        "context_window": llm.context_window,
+        # Quantized KV cache and flash attention change the logits slightly
+        "kv_cache": llama_settings["kv_cache"],
+        "flash_attn": llama_settings["flash_attn"],
+        "system_prompt": system_prompt,
+        "max_iterations": 3,
+        "react_grammar": react_grammar_enabled,
+        "agent_mode": agent_mode,
+        # Budgets can cut answers short
+        "token_budgets": [agent_action_max_tokens, agent_answer_max_tokens] if agent_token_budgets else None,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    # Runs already in progress keep the agent they started with
+    agent, plan_agent = new_agent, new_plan_agent
+    agent_catalog_version = catalog_version
+
+def new_react_agent(llm, tools, system_prompt: str, verbose: bool) -> ReActAgent:
+    """ReActAgent with per-step token budgets (plain ReActAgent when AGENT_TOKEN_BUDGETS=0)"""
+    if agent_token_budgets:
+        return BudgetedReActAgent(
+            tools=tools if tools else None,
+            llm=llm,
+            verbose=verbose,
+            system_prompt=system_prompt,
+            action_max_tokens=agent_action_max_tokens,
+            answer_max_tokens=agent_answer_max_tokens,
+            single_line_answers=react_grammar_enabled,
+        )
+    return ReActAgent(tools=tools if tools else None, llm=llm, verbose=verbose, system_prompt=system_prompt)
+
+async def watch_tool_catalog():
+    """Attach MCP tools to the agent whenever the tool catalog changes (e.g. MCP came up after startup)"""
+    while True:
+        await asyncio.sleep(mcp_tools_watch_interval)
+        if agent is None or not mcp_pool.connected:
+            continue
+        try:
+            # Served from the catalog cache unless its TTL expired or the server reported a change
+            await mcp_pool.list_tools()
+        except Exception:
+            continue
+        if mcp_pool.catalog_version == agent_catalog_version:
+            continue
+        tools, catalog_version = await load_mcp_tools(wait=0)
+        if not tools:
+            continue
+        logger.info(f"Tool catalog changed (version {catalog_version}), rebuilding agent")
+        llm = agent.llm
+        
+        async def rebuild():
+            await create_agent(llm, tools, catalog_version, llm.model_path)
+        
+        try:
+            # Through the inference queue, so the prefix snapshot is not rebuilt under a running generation
+            await inference_scheduler.submit(rebuild, priority=100)
+        except Exception as e:
+            logger.warning(f"Agent rebuild failed, will retry: {type(e).__name__}: {str(e)}")
+
+async def to_thread_uncancelled(fn, *args):
+    """asyncio.to_thread that waits for the thread even when cancelled, then re-raises the cancellation
+
+    A thread cannot be stopped: an inference worker whose job timed out (or a caller that went away)
+    must not be released, and start the next generation on the same llama.cpp context, while it runs.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait({future})
+            except asyncio.CancelledError:
+                pass
+        raise
+
+def build_prefix_snapshot(react_agent, llm, tools, planner: Optional[PlanAgent] = None):
+    """Snapshot the KV state of the prompt prefix shared by all requests (system prompt + tools)"""
+    # Render the prompt exactly like ReActAgent.take_step (or the plan agent, whose prompt is
+    # the one every request starts with in plan mode) does for two different user messages,
+    # the tokens they share are the part that is identical for every request
+    prompts = []
+    for probe in ("1 + 1", "Calculate 12 * 34"):
+        if planner is not None:
+            messages = planner.format_messages(probe)
+        else:
+            messages = react_agent.formatter.format(
+                tools,
+                chat_history=[ChatMessage(role="user", content=probe)],
+                current_reasoning=[],
+            )
+        prompts.append(llm.messages_to_prompt(messages))
+    try:
+        llm.build_prefix_snapshot(prompts)
+    except Exception as e:
+        logger.warning(f"Prompt prefix snapshot failed, prompts will be evaluated in full: {e}")
+
+def load_batch_llm(llm):
+    """Load the batched-decoding LLM used by /chat/batch, blocking (same model file and prompt format as llm)"""
+    n_threads = batch_threads or llama_settings["n_threads"]
+    engine = BatchEngine(
+        model_path=llm.model_path,
+        slots=batch_slots,
+        context_per_slot=batch_context,
+        n_batch=llama_settings["n_batch"],
+        n_threads=n_threads,
+    )
+    engine.start()
+    return BatchLlamaCPP(
+        engine=engine,
+        model_path=llm.model_path,
+        temperature=llm.temperature,
+        max_new_tokens=llm.max_new_tokens,
+        context_window=batch_context,
+        messages_to_prompt=llm.messages_to_prompt,
+        completion_to_prompt=llm.completion_to_prompt,
+    )
+
+async def get_batch_agent() -> ReActAgent:
+    """ReActAgent on the batched LLM with the main agent's tools and system prompt (rebuilt when those change)
+
+    In plan mode batch_plan_agent is rebuilt alongside it.
+    """
+    global batch_llm, batch_agent, batch_agent_source, batch_plan_agent
+    async with batch_lock:
+        if batch_llm is None:
+            logger.info(f"Loading batch engine: {batch_slots} slots x {batch_context} tokens")
+            batch_llm = await asyncio.to_thread(load_batch_llm, agent.llm)
+        if batch_agent_source is not agent:
+            source = agent
+            tools = source.tools or []
+            new_agent = new_react_agent(batch_llm, tools, source.system_prompt, verbose=False)
+            if react_grammar_enabled:
+                batch_llm.set_grammar(build_react_grammar(tools))
+            new_plan_agent = PlanAgent(batch_llm, tools, mcp_pool.call_tool) if agent_mode == "plan" else None
+            if prefix_cache_enabled:
+                await to_thread_uncancelled(build_prefix_snapshot, new_agent, batch_llm, tools, new_plan_agent)
+            batch_agent, batch_agent_source, batch_plan_agent = new_agent, source, new_plan_agent
+        return batch_agent
 
 def find_model_file() -> str:
     """Get model file path"""
@@ -206,111 +566,301 @@ def find_model_file() -> str:
     )
 
 async def get_tool_names() -> List[str]:
-    """Get list of available tool names"""
-    # Prefer getting tool list from Agent (avoid duplicate MCP connections)
-    if agent is not None and hasattr(agent, 'tools') and agent.tools:
-        return [tool.metadata.name if hasattr(tool, 'metadata') else str(tool) for tool in agent.tools]
-    
-    # If Agent has no tools, try to get from MCP
-    try:
-        client = BasicMCPClient(command_or_url=mcp_sse_url)
-        tool_spec = McpToolSpec(client=client)
-        tools = await tool_spec.to_tool_list_async()
-        return [t.metadata.name for t in tools]
-    except Exception as e:
-        logger.warning(f"Failed to get tool list: {e}")
-        return []
+    """Get list of available tool names (served from the pooled tool catalog cache)"""
+    with timed(CHAT_STAGE_SECONDS, stage="tool_catalog"):
+        return await mcp_pool.get_tool_names()
+
+@app.get("/livez")
+async def livez():
+    """Liveness probe: the process is serving requests and startup has not failed"""
+    if startup_error is not None:
+        return Response(
+            content=json.dumps({"status": "failed", "error": startup_error}),
+            status_code=503,
+            media_type="application/json",
+        )
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness probe: model loaded, agent created and inference queue running (no network calls)"""
+    tools_count = len(agent.tools or []) if agent is not None else 0
+    ready = agent is not None and inference_scheduler.running
+    body = {
+        "status": "ready" if ready else "starting",
+        "agent_loaded": agent is not None,
+        "mcp_connected": mcp_pool.connected,
+        "tools_count": tools_count,
+    }
+    if startup_error is not None:
+        body["status"] = "failed"
+        body["error"] = startup_error
+    return Response(
+        content=json.dumps(body),
+        status_code=200 if ready else 503,
+        media_type="application/json",
+    )
 
 @app.get("/health")
 async def health():
-    """Health check"""
-    try:
-        tool_names = await get_tool_names()
-        mcp_available = len(tool_names) > 0
-    except:
-        mcp_available = False
-        tool_names = []
+    """Health check (MCP state from the background prober and the cached catalog, no network calls)"""
+    tool_names = mcp_pool.cached_tool_names()
+    mcp_available = mcp_pool.connected and len(tool_names) > 0
     
     return {
         "status": "healthy",
         "agent_loaded": agent is not None,
         "mcp_available": mcp_available,
-        "tools_count": len(tool_names)
+        "tools_count": len(tool_names),
+        "mcp_servers": mcp_pool.health(),
+    }
+
+def start_agent(message: str, react_agent: Optional[ReActAgent] = None, memory: Optional[ChatMemoryBuffer] = None):
+    """Start the agent workflow for one message and return its handler (default: the main agent)"""
+    # Use LlamaIndex Agent to process request (automatically handles tool calls)
+    # ReActAgent is based on Workflow, need to use run() method
+    # Without a session memory, create new memory and context so each request is independent
+    # ChatMemoryBuffer needs to set token_limit
+    react_agent = react_agent or agent
+    if memory is None:
+        memory = ChatMemoryBuffer(token_limit=3000)
+    ctx = Context(react_agent)
+    
+    # Set maximum iteration count (reduce iterations to avoid long wait times)
+    return react_agent.run(
+        user_msg=message, 
+        memory=memory, 
+        ctx=ctx,
+        max_iterations=3  # Reduced to 3, simple calculations usually only need 1 iteration
+    )
+
+async def run_agent(message: str, enqueued_at: Optional[float] = None, on_event=None,
+                    react_agent: Optional[ReActAgent] = None, session=None, planner: Optional[PlanAgent] = None):
+    """Run the agent workflow for one message (executed by an inference scheduler worker or /chat/batch)
+
+    The plan agent (planner, default: the main one in plan mode) answers first, the ReActAgent
+    only runs when its plan is not usable.
+    """
+    if enqueued_at is not None:
+        CHAT_STAGE_SECONDS.labels(stage="queue_wait").observe(time.perf_counter() - enqueued_at)
+    if planner is None and react_agent is None:
+        planner = plan_agent
+    iterations = tool_calls = tokens = parse_failures = 0
+    
+    def observe(event):
+        nonlocal iterations, tool_calls, tokens, parse_failures
+        if isinstance(event, AgentStream):
+            if event.delta:
+                tokens += 1  # llama.cpp streams one token per chunk
+        elif isinstance(event, AgentOutput):
+            iterations += 1
+            if event.retry_messages:
+                parse_failures += 1
+        elif isinstance(event, ToolCallResult):
+            tool_calls += 1
+        if on_event is not None:
+            on_event(event)
+    
+    mode = "react"
+    memory = session.memory if session is not None else None
+    # The workflow's tasks inherit the session, so the LLM saves/restores its KV state,
+    # and the budget usage the agent's steps add to
+    session_token = current_session.set(session)
+    usage = BudgetUsage()
+    usage_token = current_usage.set(usage)
+    started = time.perf_counter()
+    with timed(CHAT_STAGE_SECONDS, stage="agent_run"):
+        try:
+            result = None
+            if planner is not None:
+                result = await planner.run(message, memory, on_event=observe)
+                if result is not None:
+                    mode = "plan"
+                    AGENT_PLANS.labels(outcome="executed").inc()
+                else:
+                    mode = "plan, react fallback"
+                    iterations += 1  # The plan's LLM call
+                    AGENT_PLANS.labels(outcome="invalid" if tool_calls == 0 else "tool_error").inc()
+            if result is None:
+                handler = start_agent(message, react_agent, memory)
+                try:
+                    async for event in handler.stream_events():
+                        observe(event)
+                    result = await handler
+                except asyncio.CancelledError:
+                    # Deadline or client disconnect: stop the workflow so generation releases the CPU
+                    await handler.cancel_run()
+                    raise
+        finally:
+            current_session.reset(session_token)
+            current_usage.reset(usage_token)
+    seconds = time.perf_counter() - started
+    if session is not None:
+        session.turns += 1
+    AGENT_ITERATIONS.observe(iterations)
+    AGENT_TOOL_CALLS.observe(tool_calls)
+    AGENT_GENERATED_TOKENS.observe(tokens)
+    AGENT_PARSE_FAILURES.inc(parse_failures)
+    budget = ""
+    if usage.steps:
+        budget = (f", token budget {usage.budget} of {usage.unbudgeted} "
+                  f"({usage.early_stops} steps ended early, {usage.truncated} at the limit)")
+    logger.info(f"Agent run finished ({mode}): {iterations} iterations, {tool_calls} tool calls, "
+                f"{tokens} tokens in {seconds:.2f}s, {parse_failures} parse failures{budget}")
+    return result
+
+async def get_cached_response(message: str) -> Optional[str]:
+    """Look up a cached agent answer (None on miss or when the cache is disabled)"""
+    if not response_cache_enabled:
+        return None
+    # Refreshes the tool catalog if its TTL expired, so catalog changes invalidate the cache
+    await get_tool_names()
+    response_cache.set_fingerprint(f"{agent_fingerprint}:{mcp_pool.catalog_hash}")
+    return await response_cache.aget(message)
+
+def store_cached_response(message: str, raw_response: str):
+    if response_cache_enabled:
+        response_cache.set(message, raw_response)
+
+def remember_exchange(session, message: str, reply: str):
+    """Add a turn answered without the agent to the session history"""
+    if session is not None:
+        session.memory.put(ChatMessage(role="user", content=message))
+        session.memory.put(ChatMessage(role="assistant", content=reply))
+        session.turns += 1
+
+def get_response_text(result) -> str:
+    """Get raw response text from agent result"""
+    if hasattr(result, 'response') and hasattr(result.response, 'content'):
+        return result.response.content or ""
+    return str(result)
+
+async def try_fast_path(message: str) -> Optional[str]:
+    """Answer plainly parseable requests by calling the MCP tool directly, None to use the Agent"""
+    if not fast_path_enabled:
+        return None
+    tool_names = await get_tool_names()
+    if not tool_names:
+        return None
+    return await intent_router.try_handle(message, mcp_pool.call_tool, available_tools=tool_names)
+
+def precheck_message(message: str) -> Optional[str]:
+    """Return a direct reply for messages that don't need the Agent, None otherwise"""
+    # Input validation: check if message is empty or too short
+    if not message or len(message) < 2:
+        return "Input message is too short or empty"
+    
+    # Use whitelist: only call LLM if contains "addition/subtraction/multiplication/division/calculation"
+    user_message_lower = message.lower()
+    # Math keywords in both Chinese and English for detection
+    math_keywords = ['计算', '算', '加', '减', '乘', '除', '等于', '等于多少', '+', '-', '*', '/', 'calculate', 'compute', 'add', 'multiply', 'divide']
+    has_math_content = any(keyword in user_message_lower for keyword in math_keywords) or \
+                      any(char.isdigit() for char in user_message_lower)
+    
+    # If no math content, reply friendly directly without calling Agent
+    if not has_math_content:
+        logger.info("No mathematical calculation content detected, replying directly without calling Agent")
+        return "Non-mathematical question - direct reply, Agent not called"
+    return None
+
+@app.get("/stats")
+async def stats():
+    """Runtime statistics (inference queue, fast path, response cache and prompt prefix cache)"""
+    return {
+        "queue": inference_scheduler.stats(),
+        "fast_path": intent_router.stats(),
+        "response_cache": response_cache.stats(),
+        "prefix_cache": agent.llm.prefix_stats() if agent is not None else None,
+        "llm_replicas": llm_pool.stats() if llm_pool is not None else None,
+        "batch": batch_llm.engine.stats() if batch_llm is not None else None,
+        "sessions": session_store.stats(),
+        "plan": plan_agent.stats() if plan_agent is not None else None,
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, response: Response):
     """Chat endpoint"""
     if agent is None:
-        raise HTTPException(status_code=500, detail="Agent not initialized")
+        raise HTTPException(status_code=503, detail="Agent is not ready yet", headers={"Retry-After": "5"})
     
+    # Turns of one session run one after another
+    session = session_store.get(request.session_id) if request.session_id else None
+    if session is not None:
+        await session.lock.acquire()
     try:
         logger.info(f"Received message: {request.message}")
         
-        # Input validation: check if message is empty or too short
+        # Short and non-mathematical messages are answered without calling Agent
         message = request.message.strip()
-        if not message or len(message) < 2:
+        with timed(CHAT_STAGE_SECONDS, stage="precheck"):
+            direct_reply = precheck_message(message)
+        outcome = "direct"
+        if direct_reply is None:
+            with timed(CHAT_STAGE_SECONDS, stage="fast_path"):
+                direct_reply = await try_fast_path(message)
+            outcome = "fast_path"
+        if direct_reply is not None:
+            CHAT_OUTCOMES.labels(endpoint="chat", outcome=outcome).inc()
+            remember_exchange(session, message, direct_reply)
             tool_names = await get_tool_names()
-            raw_response = "Input message is too short or empty"
             return ChatResponse(
-                raw_response=raw_response,
-                tools_available=tool_names
+                raw_response=direct_reply,
+                tools_available=tool_names,
+                session_id=request.session_id,
             )
         
-        # Use whitelist: only call LLM if contains "addition/subtraction/multiplication/division/calculation"
-        user_message_lower = message.lower()
-        # Math keywords in both Chinese and English for detection
-        math_keywords = ['计算', '算', '加', '减', '乘', '除', '等于', '等于多少', '+', '-', '*', '/', 'calculate', 'compute', 'add', 'multiply', 'divide']
-        has_math_content = any(keyword in user_message_lower for keyword in math_keywords) or \
-                          any(char.isdigit() for char in user_message_lower)
-        
-        # If no math content, reply friendly directly without calling Agent
-        if not has_math_content:
-            logger.info("No mathematical calculation content detected, replying directly without calling Agent")
+        # Repeated questions are answered from the response cache
+        # (not within a session, there the answer depends on the conversation history)
+        cached_response = None
+        if session is None:
+            with timed(CHAT_STAGE_SECONDS, stage="cache_lookup"):
+                cached_response = await get_cached_response(message)
+        if cached_response is not None:
+            CHAT_OUTCOMES.labels(endpoint="chat", outcome="cache_hit").inc()
+            response.headers["X-Cache"] = "HIT"
             tool_names = await get_tool_names()
-            raw_response = "Non-mathematical question - direct reply, Agent not called"
             return ChatResponse(
-                raw_response=raw_response,
-                tools_available=tool_names
+                raw_response=cached_response,
+                tools_available=tool_names,
+                session_id=request.session_id,
             )
+        response.headers["X-Cache"] = "MISS"
         
-        # Use LlamaIndex Agent to process request (automatically handles tool calls)
-        # ReActAgent is based on Workflow, need to use run() method
-        # Use new Context to ensure each request is independent, no history retained
-        from llama_index.core.workflow import Context
-        from llama_index.core.memory import ChatMemoryBuffer
-        from llama_index.core.workflow.errors import WorkflowRuntimeError
-        
-        # Create new memory and context, ensure each request is independent
-        # ChatMemoryBuffer needs to set token_limit
-        memory = ChatMemoryBuffer(token_limit=3000)
-        ctx = Context(agent)
-        
-        # Set maximum iteration count (reduce iterations to avoid long wait times)
-        handler = agent.run(
-            user_msg=message, 
-            memory=memory, 
-            ctx=ctx,
-            max_iterations=3  # Reduced to 3, simple calculations usually only need 1 iteration
-        )
-        
-        # Wait for workflow to complete and get result (add timeout)
+        # Queue the agent run: bounded queue, fixed worker count, per-request deadline
+        timeout = request.deadline or inference_scheduler.default_timeout
+        enqueued_at = time.perf_counter()
         try:
-            result = await asyncio.wait_for(handler, timeout=120.0)  # Increased to 120 seconds timeout, as generating more tokens takes longer
-        except asyncio.TimeoutError:
-            logger.warning("Agent processing timeout (120 seconds)")
+            result = await inference_scheduler.submit(
+                lambda: run_agent(message, enqueued_at, session=session),
+                priority=request.priority,
+                timeout=timeout,
+            )
+        except QueueFullError as e:
+            logger.warning(f"Request rejected: {e}")
+            CHAT_OUTCOMES.labels(endpoint="chat", outcome="rejected").inc()
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+        except SchedulerUnavailableError as e:
+            logger.warning(f"Request rejected: {e}")
+            CHAT_OUTCOMES.labels(endpoint="chat", outcome="rejected").inc()
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+        except DeadlineExceededError as e:
+            logger.warning(f"Agent processing timeout: {e}")
+            CHAT_OUTCOMES.labels(endpoint="chat", outcome="timeout").inc()
             tool_names = await get_tool_names()
-            raw_response = "Timeout error: Agent processing exceeded 120 seconds"
+            raw_response = f"Timeout error: Agent processing exceeded {timeout:.0f} seconds"
             return ChatResponse(
                 raw_response=raw_response,
-                tools_available=tool_names
+                tools_available=tool_names,
+                session_id=request.session_id,
             )
+        finally:
+            response.headers["X-Queue-Depth"] = str(inference_scheduler.depth)
         
         # Get raw response text
-        if hasattr(result, 'response') and hasattr(result.response, 'content'):
-            raw_response = result.response.content or ""
-        else:
-            raw_response = str(result)
+        raw_response = get_response_text(result)
+        if session is None:
+            store_cached_response(message, raw_response)
+        CHAT_OUTCOMES.labels(endpoint="chat", outcome="agent").inc()
         
         # Use raw response directly, no extraction processing
         # Get available tool list
@@ -318,47 +868,319 @@ async def chat(request: ChatRequest):
         
         return ChatResponse(
             raw_response=raw_response,
-            tools_available=tool_names
+            tools_available=tool_names,
+            session_id=request.session_id,
         )
+    except HTTPException:
+        raise
     except WorkflowRuntimeError as e:
         # Handle error when maximum iteration count reached
         error_msg = str(e)
         logger.warning(f"Agent reached maximum iteration count: {error_msg}")
+        CHAT_OUTCOMES.labels(endpoint="chat", outcome="max_iterations").inc()
         tool_names = await get_tool_names()
         raw_response = f"Error: {error_msg}"
         return ChatResponse(
             raw_response=raw_response,
-            tools_available=tool_names
+            tools_available=tool_names,
+            session_id=request.session_id,
         )
     except Exception as e:
         logger.error(f"Error processing request: {e}", exc_info=True)
+        CHAT_OUTCOMES.labels(endpoint="chat", outcome="error").inc()
         tool_names = await get_tool_names()
         raw_response = f"Error details: {str(e)}"
         return ChatResponse(
             raw_response=raw_response,
-            tools_available=tool_names
+            tools_available=tool_names,
+            session_id=request.session_id,
         )
+    finally:
+        if session is not None:
+            session.lock.release()
+
+def format_sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def workflow_event_to_sse(event) -> Optional[str]:
+    """Map LlamaIndex workflow events to SSE events (token, thought, tool_call, tool_result)"""
+    if isinstance(event, AgentStream):
+        if event.delta:
+            return format_sse("token", {"delta": event.delta})
+    elif isinstance(event, ToolCallResult):
+        return format_sse("tool_result", {
+            "tool_name": event.tool_name,
+            "tool_kwargs": event.tool_kwargs,
+            "output": str(event.tool_output.content),
+            "is_error": bool(getattr(event.tool_output, "is_error", False)),
+        })
+    elif isinstance(event, ToolCall):
+        return format_sse("tool_call", {"tool_name": event.tool_name, "tool_kwargs": event.tool_kwargs})
+    elif isinstance(event, AgentOutput):
+        if event.tool_calls:
+            return format_sse("thought", {"content": event.response.content or ""})
+    return None
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Streaming chat endpoint: agent events are sent as Server-Sent Events as soon as they are produced"""
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent is not ready yet", headers={"Retry-After": "5"})
+    
+    logger.info(f"Received streaming message: {request.message}")
+    message = request.message.strip()
+    # Turns of one session run one after another, the lock is released when this turn's run ends
+    session = session_store.get(request.session_id) if request.session_id else None
+    if session is not None:
+        await session.lock.acquire()
+    future = None
+    try:
+        with timed(CHAT_STAGE_SECONDS, stage="precheck"):
+            direct_reply = precheck_message(message)
+        outcome = "direct"
+        if direct_reply is None:
+            with timed(CHAT_STAGE_SECONDS, stage="fast_path"):
+                direct_reply = await try_fast_path(message)
+            outcome = "fast_path"
+        cache_status = None
+        if direct_reply is None and response_cache_enabled and session is None:
+            with timed(CHAT_STAGE_SECONDS, stage="cache_lookup"):
+                direct_reply = await get_cached_response(message)
+            cache_status = "HIT" if direct_reply is not None else "MISS"
+            outcome = "cache_hit"
+        
+        events: asyncio.Queue = asyncio.Queue()
+        
+        def forward_event(event):
+            sse = workflow_event_to_sse(event)
+            if sse is not None:
+                events.put_nowait(sse)
+        
+        if direct_reply is None:
+            timeout = request.deadline or inference_scheduler.default_timeout
+            enqueued_at = time.perf_counter()
+            try:
+                # Admission happens before the stream starts, so rejections are plain 429/503 responses
+                future = inference_scheduler.enqueue(
+                    lambda: run_agent(message, enqueued_at, on_event=forward_event, session=session),
+                    priority=request.priority,
+                    timeout=timeout,
+                )
+            except QueueFullError as e:
+                logger.warning(f"Request rejected: {e}")
+                CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome="rejected").inc()
+                raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+            except SchedulerUnavailableError as e:
+                logger.warning(f"Request rejected: {e}")
+                CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome="rejected").inc()
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+            if session is not None:
+                # The run owns the lock from here on
+                future.add_done_callback(lambda _: session.lock.release())
+        else:
+            CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome=outcome).inc()
+            remember_exchange(session, message, direct_reply)
+    finally:
+        # Released here unless the agent run was queued and took it over
+        if session is not None and future is None:
+            session.lock.release()
+    
+    async def event_source():
+        if future is None:
+            yield format_sse("final", {"raw_response": direct_reply, "tools_available": await get_tool_names()})
+            return
+        # Send something immediately so the client sees the first byte before inference starts
+        yield format_sse("queued", {"queue_depth": inference_scheduler.depth})
+        get_event = None
+        try:
+            while True:
+                get_event = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({get_event, future}, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
+                if get_event in done:
+                    yield get_event.result()
+                    continue
+                get_event.cancel()
+                if future.done():
+                    while not events.empty():
+                        yield events.get_nowait()
+                    try:
+                        raw_response = get_response_text(future.result())
+                        if session is None:
+                            store_cached_response(message, raw_response)
+                        CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome="agent").inc()
+                        yield format_sse("final", {
+                            "raw_response": raw_response,
+                            "tools_available": await get_tool_names(),
+                        })
+                    except DeadlineExceededError as e:
+                        logger.warning(f"Agent processing timeout: {e}")
+                        CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome="timeout").inc()
+                        yield format_sse("error", {"detail": f"Timeout error: {e}"})
+                    except Exception as e:
+                        logger.error(f"Error processing streaming request: {e}", exc_info=True)
+                        CHAT_OUTCOMES.labels(endpoint="chat_stream", outcome="error").inc()
+                        yield format_sse("error", {"detail": f"Error details: {str(e)}"})
+                    return
+                if await http_request.is_disconnected():
+                    logger.info("Client disconnected, cancelling agent run")
+                    return
+        finally:
+            # Covers client disconnect (generator closed/cancelled) and early return
+            if get_event is not None:
+                get_event.cancel()
+            if not future.done():
+                future.cancel()
+    
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if cache_status is not None:
+        headers["X-Cache"] = cache_status
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers=headers,
+    )
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest):
+    """Batch chat endpoint: agent runs of all messages share llama.cpp decode steps (multi-sequence batches)
+
+    Streams one JSON line per message as soon as it completes (completion order, see "index"),
+    followed by a summary line with the aggregate generation speed.
+    """
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent is not ready yet", headers={"Retry-After": "5"})
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messages must not be empty")
+    if len(request.messages) > batch_max_messages:
+        raise HTTPException(status_code=413, detail=f"At most {batch_max_messages} messages per batch")
+    
+    logger.info(f"Received batch of {len(request.messages)} messages")
+    try:
+        react_agent = await get_batch_agent()
+    except Exception as e:
+        logger.error(f"Batch engine failed to load: {e}", exc_info=True)
+        raise HTTPException(status_code=503, detail=f"Batch engine is not available: {str(e)}")
+    engine = batch_llm.engine
+    timeout = request.deadline or inference_scheduler.default_timeout
+    # Enough concurrent agent runs to keep every slot decoding while others format prompts or call tools
+    running = asyncio.Semaphore(2 * engine.slots)
+    
+    async def answer(index: int, message: str) -> dict:
+        started = time.perf_counter()
+        tokens = 0
+        
+        def count_tokens(event):
+            nonlocal tokens
+            if isinstance(event, AgentStream) and event.delta:
+                tokens += 1
+        
+        message = message.strip()
+        raw_response = precheck_message(message)
+        outcome = "direct"
+        if raw_response is None:
+            raw_response = await try_fast_path(message)
+            outcome = "fast_path"
+        if raw_response is None:
+            raw_response = await get_cached_response(message)
+            outcome = "cache_hit"
+        if raw_response is None:
+            try:
+                async with running:
+                    result = await asyncio.wait_for(
+                        run_agent(message, on_event=count_tokens, react_agent=react_agent,
+                                  planner=batch_plan_agent),
+                        timeout=timeout,
+                    )
+                raw_response = get_response_text(result)
+                store_cached_response(message, raw_response)
+                outcome = "agent"
+            except asyncio.TimeoutError:
+                raw_response = f"Timeout error: Agent processing exceeded {timeout:.0f} seconds"
+                outcome = "timeout"
+            except WorkflowRuntimeError as e:
+                raw_response = f"Error: {str(e)}"
+                outcome = "max_iterations"
+            except Exception as e:
+                logger.error(f"Error processing batch message {index}: {e}", exc_info=True)
+                raw_response = f"Error details: {str(e)}"
+                outcome = "error"
+        CHAT_OUTCOMES.labels(endpoint="chat_batch", outcome=outcome).inc()
+        return {
+            "index": index,
+            "raw_response": raw_response,
+            "outcome": outcome,
+            "tokens": tokens,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+    
+    async def results():
+        started = time.perf_counter()
+        generated_before = engine.generated_tokens
+        steps_before, sequences_before = engine.decode_steps, engine.decode_sequences
+        tasks = [asyncio.create_task(answer(index, message)) for index, message in enumerate(request.messages)]
+        outcomes = {}
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                item = await next_result
+                outcomes[item["outcome"]] = outcomes.get(item["outcome"], 0) + 1
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            elapsed = time.perf_counter() - started
+            # Engine-wide count, includes tokens of other batches running at the same time
+            generated = engine.generated_tokens - generated_before
+            steps = engine.decode_steps - steps_before
+            yield json.dumps({
+                "summary": {
+                    "messages": len(tasks),
+                    "outcomes": outcomes,
+                    "seconds": round(elapsed, 3),
+                    "generated_tokens": generated,
+                    "tokens_per_second": round(generated / elapsed, 1) if elapsed > 0 else 0.0,
+                    "mean_sequences_per_step": round((engine.decode_sequences - sequences_before) / steps, 2) if steps else 0.0,
+                },
+            }) + "\n"
+        finally:
+            # Client disconnected: stop the remaining agent runs (frees their engine slots)
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """End a conversation and free its history and KV state"""
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Unknown session")
+    return {"status": "deleted", "session_id": session_id}
 
 @app.get("/tools")
 async def list_tools():
     """List available tools"""
     try:
-        client = BasicMCPClient(command_or_url=mcp_sse_url)
-        tool_spec = McpToolSpec(client=client)
-        tools = await tool_spec.to_tool_list_async()
+        result = await mcp_pool.list_tools()
         
         tools_list = []
-        for tool in tools:
+        for tool in result.tools:
             tools_list.append({
-                "name": tool.metadata.name,
-                "description": tool.metadata.description,
-                "parameters": tool.metadata.parameters_schema if hasattr(tool.metadata, 'parameters_schema') else {}
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.inputSchema or {}
             })
         return {"tools": tools_list}
     except Exception as e:
         logger.error(f"Failed to get tool list: {e}")
         return {"tools": []}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics (latency histograms per stage, LLM token rates, outcomes)"""
+    body, content_type = render(CHAT_REGISTRY)
+    return Response(content=body, media_type=content_type)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
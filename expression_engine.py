@@ -0,0 +1,280 @@
+"""
+Expression Engine - Safe arithmetic evaluation for calculate_expression
+
+Expressions are parsed once into a restricted AST (numbers, + - * / // **, parentheses),
+compiled into a tree of small closures and kept in an LRU cache keyed on the normalised
+expression text. Cost limits (length, node count, exponent size, result magnitude) make sure
+no single input can keep the server busy.
+
+Batch mode compiles the same tree with NumPy kernels, so one expression can be evaluated
+over many variable bindings at once; per-item failures are reported as error codes. That
+includes failures of constant subexpressions (x + 1/0), which are left unfolded so they are
+flagged on every item like the same failure in a variable term, only an invalid expression
+rejects the whole batch.
+"""
+import ast
+import functools
+import math
+import operator
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Cost limits (override through environment variables)
+MAX_EXPRESSION_LENGTH = int(os.getenv("EXPR_MAX_LENGTH", "256"))
+MAX_NODES = int(os.getenv("EXPR_MAX_NODES", "100"))
+MAX_EXPONENT = float(os.getenv("EXPR_MAX_EXPONENT", "64"))
+MAX_RESULT_MAGNITUDE = float(os.getenv("EXPR_MAX_RESULT", "1e100"))
+CACHE_SIZE = int(os.getenv("EXPR_CACHE_SIZE", "1024"))
+
+# Per-item error codes used by batch evaluation (0 means success)
+DIVISION_BY_ZERO, EXPONENT_LIMIT, MAGNITUDE_LIMIT, NOT_REAL, MISSING_VARIABLE = 1, 2, 3, 4, 5
+ERROR_MESSAGES = {
+    DIVISION_BY_ZERO: "Division by zero",
+    EXPONENT_LIMIT: f"Exponent exceeds limit ({MAX_EXPONENT:g})",
+    MAGNITUDE_LIMIT: f"Result magnitude exceeds limit ({MAX_RESULT_MAGNITUDE:g})",
+    NOT_REAL: "Result is not a real number",
+    MISSING_VARIABLE: "Missing variable binding",
+}
+
+
+class ExpressionError(ValueError):
+    """Expression is invalid or exceeds a cost limit"""
+
+
+# ---- Scalar kernels ----
+
+def _checked(value):
+    # Integers stay exact (like eval), the magnitude and exponent limits keep them small
+    if isinstance(value, float) and math.isnan(value) or abs(value) > MAX_RESULT_MAGNITUDE:
+        raise ExpressionError(ERROR_MESSAGES[MAGNITUDE_LIMIT])
+    return value
+
+
+def _divide(a: float, b: float) -> float:
+    if b == 0:
+        raise ExpressionError(ERROR_MESSAGES[DIVISION_BY_ZERO])
+    return a / b
+
+
+def _floor_divide(a: float, b: float) -> float:
+    if b == 0:
+        raise ExpressionError(ERROR_MESSAGES[DIVISION_BY_ZERO])
+    return a // b
+
+
+def _power(a: float, b: float) -> float:
+    if abs(b) > MAX_EXPONENT:
+        raise ExpressionError(f"Exponent {b:g} exceeds limit ({MAX_EXPONENT:g})")
+    try:
+        result = a ** b
+    except ZeroDivisionError:
+        raise ExpressionError(ERROR_MESSAGES[DIVISION_BY_ZERO])
+    except OverflowError:
+        raise ExpressionError(ERROR_MESSAGES[MAGNITUDE_LIMIT])
+    if isinstance(result, complex):
+        raise ExpressionError(ERROR_MESSAGES[NOT_REAL])
+    return result
+
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: _divide,
+    ast.FloorDiv: _floor_divide,
+    ast.Pow: _power,
+}
+
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+# ---- Vectorised kernels (errors: int array of per-item error codes, first error wins) ----
+
+def _flag(errors: np.ndarray, mask, code: int):
+    np.putmask(errors, mask & (errors == 0), code)
+
+
+def _vchecked(values: np.ndarray, errors: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore"):
+        _flag(errors, ~np.isfinite(values) | (np.abs(values) > MAX_RESULT_MAGNITUDE), MAGNITUDE_LIMIT)
+    return values
+
+
+def _vdivide(a, b, errors):
+    zero = np.asarray(b) == 0
+    _flag(errors, zero, DIVISION_BY_ZERO)
+    with np.errstate(all="ignore"):
+        return np.divide(a, np.where(zero, 1.0, b))
+
+
+def _vfloor_divide(a, b, errors):
+    zero = np.asarray(b) == 0
+    _flag(errors, zero, DIVISION_BY_ZERO)
+    with np.errstate(all="ignore"):
+        return np.floor_divide(a, np.where(zero, 1.0, b))
+
+
+def _vpower(a, b, errors):
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    too_large = np.abs(b) > MAX_EXPONENT
+    _flag(errors, too_large, EXPONENT_LIMIT)
+    _flag(errors, (a == 0) & (b < 0), DIVISION_BY_ZERO)
+    _flag(errors, (a < 0) & (b != np.floor(b)), NOT_REAL)
+    with np.errstate(all="ignore"):
+        return np.power(a, np.where(too_large, 0.0, b))
+
+
+_VECTOR_BINARY_OPERATORS = {
+    ast.Add: lambda a, b, errors: np.add(a, b),
+    ast.Sub: lambda a, b, errors: np.subtract(a, b),
+    ast.Mult: lambda a, b, errors: np.multiply(a, b),
+    ast.Div: _vdivide,
+    ast.FloorDiv: _vfloor_divide,
+    ast.Pow: _vpower,
+}
+
+
+class _Constant:
+    """Closure for a constant (sub)expression, lets the compiler fold it ahead of time"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, env) -> float:
+        return self.value
+
+
+class CompiledExpression:
+    """A validated expression compiled into a callable evaluator"""
+
+    def __init__(self, text: str, evaluator, node_count: int, variables: Tuple[str, ...] = ()):
+        self.text = text
+        self.node_count = node_count
+        self.variables = variables
+        self._evaluator = evaluator
+
+    def evaluate(self) -> float:
+        return float(self._evaluator(None))
+
+    def evaluate_batch(self, columns: Dict[str, np.ndarray], size: int,
+                       errors: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Evaluate over variable columns, returns (values, per-item error codes)"""
+        if errors is None:
+            errors = np.zeros(size, dtype=np.int8)
+        env = dict(columns)
+        env["__errors__"] = errors
+        values = np.broadcast_to(np.asarray(self._evaluator(env), dtype=np.float64), (size,))
+        _vchecked(values, errors)
+        return values, errors
+
+
+def normalise_expression(expression: str) -> str:
+    """Cache key: expression text without whitespace"""
+    return "".join(expression.split())
+
+
+def _compile_node(node, vectorised: bool):
+    """Compile an AST node into a closure taking the variable environment, folding constant subtrees"""
+    if isinstance(node, ast.Constant):
+        if type(node.value) not in (int, float):
+            raise ExpressionError("Expression contains invalid characters")
+        if not vectorised:
+            return _Constant(_checked(node.value))  # Integer literals stay exact
+        value = float(node.value)  # NumPy kernels work on float64
+        if abs(value) > MAX_RESULT_MAGNITUDE:
+            return lambda env: _vchecked(np.float64(value), env["__errors__"])
+        return _Constant(value)
+
+    if isinstance(node, ast.Name) and vectorised:
+        name = node.id
+        return lambda env: env[name]
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left = _compile_node(node.left, vectorised)
+        right = _compile_node(node.right, vectorised)
+        if isinstance(left, _Constant) and isinstance(right, _Constant):
+            op = _BINARY_OPERATORS[type(node.op)]
+            try:
+                return _Constant(_checked(op(left.value, right.value)))
+            except ExpressionError:
+                if not vectorised:
+                    raise
+                # Not folded, the vectorised kernels below flag the error on every item
+        if vectorised:
+            vop = _VECTOR_BINARY_OPERATORS[type(node.op)]
+            return lambda env: _vchecked(vop(left(env), right(env), env["__errors__"]), env["__errors__"])
+        op = _BINARY_OPERATORS[type(node.op)]
+        return lambda env: _checked(op(left(env), right(env)))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        op = _UNARY_OPERATORS[type(node.op)]
+        operand = _compile_node(node.operand, vectorised)
+        if isinstance(operand, _Constant):
+            return _Constant(op(operand.value))
+        return lambda env: op(operand(env))
+
+    raise ExpressionError("Expression contains invalid characters")
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile_normalised(text: str, vectorised: bool = False) -> CompiledExpression:
+    if not text:
+        raise ExpressionError("Expression is empty")
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError(f"Expression is longer than {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError:
+        raise ExpressionError("Invalid expression syntax")
+    nodes = list(ast.walk(tree.body))
+    if len(nodes) > MAX_NODES:
+        raise ExpressionError(f"Expression has {len(nodes)} nodes, limit is {MAX_NODES}")
+    variables = ()
+    if vectorised:
+        variables = tuple(sorted({node.id for node in nodes if isinstance(node, ast.Name)}))
+        if any(name.startswith("_") for name in variables):
+            raise ExpressionError("Variable names must not start with '_'")
+    try:
+        evaluator = _compile_node(tree.body, vectorised)
+    except OverflowError:
+        raise ExpressionError(ERROR_MESSAGES[MAGNITUDE_LIMIT])
+    return CompiledExpression(text, evaluator, len(nodes), variables)
+
+
+def compile_expression(expression: str) -> CompiledExpression:
+    """Parse and compile an expression (cached by normalised text)"""
+    return _compile_normalised(normalise_expression(expression))
+
+
+def evaluate_expression(expression: str) -> float:
+    """Evaluate an arithmetic expression, raises ExpressionError on invalid input or exceeded limits"""
+    return compile_expression(expression).evaluate()
+
+
+def evaluate_batch(expression: str,
+                   bindings: List[Dict[str, float]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluate one expression (with variables) over many bindings using NumPy kernels
+
+    Returns (values, error codes); see ERROR_MESSAGES for the codes.
+    """
+    compiled = _compile_normalised(normalise_expression(expression), True)
+    size = len(bindings)
+    errors = np.zeros(size, dtype=np.int8)
+    columns = {}
+    for name in compiled.variables:
+        column = np.array([binding.get(name, np.nan) for binding in bindings], dtype=np.float64)
+        _flag(errors, np.isnan(column), MISSING_VARIABLE)
+        columns[name] = column
+    return compiled.evaluate_batch(columns, size, errors)
+
+
+def cache_info():
+    """LRU cache statistics of compiled expressions"""
+    return _compile_normalised.cache_info()
@@ -0,0 +1,205 @@
+"""
+Inference Scheduler - Bounded admission queue in front of the agent
+
+All LLM work shares the same CPU threads, so running many generations at once only makes
+all of them slow. The scheduler admits requests into a bounded priority queue, runs them on
+a fixed number of workers, and rejects early (queue full / deadline cannot be met) instead of
+letting every request pile up until it times out.
+"""
+import asyncio
+import itertools
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Admission queue is full (maps to HTTP 429)"""
+
+
+class SchedulerUnavailableError(Exception):
+    """Scheduler is not running or deadline cannot be met (maps to HTTP 503)"""
+
+
+class DeadlineExceededError(Exception):
+    """Request deadline expired while waiting in queue or while running"""
+
+
+class _Job:
+    def __init__(self, fn: Callable[[], Awaitable[Any]], deadline: float, future: asyncio.Future):
+        self.fn = fn
+        self.deadline = deadline
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.wait_time = 0.0
+
+
+class InferenceScheduler:
+    """Bounded priority queue with a fixed worker count (higher priority runs first)"""
+
+    def __init__(self, workers: int = 1, max_queue: int = 16, default_timeout: float = 120.0):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.default_timeout = default_timeout
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._worker_tasks = []
+        self._sequence = itertools.count()
+        self._running_jobs = 0
+        # Recent queue wait and service times (seconds) for stats and admission estimates
+        self._wait_times = deque(maxlen=256)
+        self._service_times = deque(maxlen=64)
+        self.completed = 0
+        self.rejected_full = 0
+        self.rejected_deadline = 0
+        self.expired = 0
+
+    async def start(self):
+        """Start worker tasks"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        for index in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"Inference scheduler started: workers={self.workers}, max_queue={self.max_queue}")
+
+    async def stop(self):
+        """Stop workers and fail queued requests"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.set_exception(SchedulerUnavailableError("Server is shutting down"))
+        self._queue = None
+
+    @property
+    def running(self) -> bool:
+        return self._queue is not None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def estimated_wait(self) -> float:
+        """Rough wait estimate for a new request: jobs ahead * mean service time / workers"""
+        if not self._service_times:
+            return 0.0
+        jobs_ahead = self.depth + max(0, self._running_jobs - self.workers + 1)
+        return jobs_ahead * statistics.fmean(self._service_times) / self.workers
+
+    def enqueue(self, fn: Callable[[], Awaitable[Any]], priority: int = 0,
+                timeout: Optional[float] = None) -> asyncio.Future:
+        """Queue a coroutine factory and return a future for its result
+
+        Admission errors (QueueFullError, SchedulerUnavailableError) are raised immediately,
+        the future may fail with DeadlineExceededError. Cancelling the future cancels the job.
+        """
+        if self._queue is None:
+            raise SchedulerUnavailableError("Inference scheduler is not running")
+        timeout = timeout if timeout is not None else self.default_timeout
+        if self.depth >= self.max_queue:
+            self.rejected_full += 1
+            raise QueueFullError(f"Inference queue is full ({self.max_queue} requests waiting)")
+        estimated_wait = self.estimated_wait()
+        if estimated_wait >= timeout:
+            self.rejected_deadline += 1
+            raise SchedulerUnavailableError(
+                f"Estimated queue wait {estimated_wait:.1f}s exceeds request deadline {timeout:.1f}s"
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(fn, time.monotonic() + timeout, future)
+        # PriorityQueue pops smallest first: negate priority, sequence keeps FIFO within a priority
+        try:
+            self._queue.put_nowait((-priority, next(self._sequence), job))
+        except asyncio.QueueFull:
+            self.rejected_full += 1
+            raise QueueFullError(f"Inference queue is full ({self.max_queue} requests waiting)")
+        return future
+
+    async def submit(self, fn: Callable[[], Awaitable[Any]], priority: int = 0,
+                     timeout: Optional[float] = None) -> Any:
+        """Queue a coroutine factory and wait for its result"""
+        # If the caller goes away (client disconnect), the future is cancelled and the job skipped
+        return await self.enqueue(fn, priority=priority, timeout=timeout)
+
+    async def _worker(self, index: int):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run_job(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job: _Job):
+        if job.future.done():
+            # Caller cancelled while waiting in queue
+            return
+        started = time.monotonic()
+        job.wait_time = started - job.enqueued_at
+        self._wait_times.append(job.wait_time)
+        remaining = job.deadline - started
+        if remaining <= 0:
+            self.expired += 1
+            job.future.set_exception(DeadlineExceededError(
+                f"Request deadline expired after waiting {job.wait_time:.1f}s in queue"
+            ))
+            return
+
+        self._running_jobs += 1
+        task = asyncio.create_task(job.fn())
+        # Propagate caller cancellation to the running job so the CPU is released
+        job.future.add_done_callback(lambda f: task.cancel() if f.cancelled() else None)
+        try:
+            result = await asyncio.wait_for(task, timeout=remaining)
+            if not job.future.done():
+                job.future.set_result(result)
+        except asyncio.TimeoutError:
+            self.expired += 1
+            if not job.future.done():
+                job.future.set_exception(DeadlineExceededError(
+                    f"Request deadline exceeded ({job.deadline - job.enqueued_at:.0f} seconds)"
+                ))
+        except asyncio.CancelledError:
+            if not job.future.cancelled():
+                # Worker itself is being stopped (caller cancellation is swallowed)
+                job.future.cancel()
+                raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._running_jobs -= 1
+            self.completed += 1
+            self._service_times.append(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """Queue depth, wait times and rejection counters"""
+        waits = sorted(self._wait_times)
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.depth,
+            "running": self._running_jobs,
+            "completed": self.completed,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_deadline": self.rejected_deadline,
+            "expired": self.expired,
+            "wait_ms_p50": round(_percentile(waits, 0.50) * 1000, 1),
+            "wait_ms_p95": round(_percentile(waits, 0.95) * 1000, 1),
+            "estimated_wait_ms": round(self.estimated_wait() * 1000, 1),
+        }
+
+
+def _percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,209 @@
+"""
+Intent Router - Deterministic fast path that answers simple requests without the LLM
+
+Each intent handler inspects the user message and returns a tool call only when it can
+parse the message with confidence. The router executes that tool call directly over MCP
+and renders a templated answer; anything ambiguous falls back to the agent.
+"""
+import ast
+import logging
+import re
+import unicodedata
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Signature of the MCP call function used by the router: (tool_name, arguments) -> CallToolResult
+CallTool = Callable[[str, Dict[str, Any]], Awaitable[Any]]
+
+
+class IntentMatch:
+    """A tool call the router can execute directly"""
+
+    def __init__(self, tool_name: str, arguments: Dict[str, Any], description: str):
+        self.tool_name = tool_name
+        self.arguments = arguments
+        self.description = description  # Human readable form, e.g. '12*(3+4)'
+
+
+class IntentHandler:
+    """Base class for fast path handlers, subclasses implement match() and may override render()"""
+
+    name = "intent"
+
+    def match(self, message: str) -> Optional[IntentMatch]:
+        raise NotImplementedError
+
+    def render(self, match: IntentMatch, result: str) -> str:
+        return f"The answer is {result}"
+
+
+class ArithmeticIntent(IntentHandler):
+    """Recognise messages that are plainly an arithmetic expression (English and Chinese forms)"""
+
+    name = "arithmetic"
+
+    # Leading / trailing filler words that don't change the meaning of the expression
+    _prefixes = [
+        "please", "calculate", "compute", "evaluate", "what is", "what's", "whats", "solve",
+        "请帮我计算", "请帮我算", "帮我计算", "帮我算", "请计算", "请算", "计算一下", "算一下", "算算", "计算", "求",
+    ]
+    _suffixes = [
+        "等于多少", "等于几", "是多少", "得多少", "等于", "=", "?", "？", ".", "。", "!", "！", "please",
+    ]
+    # Word operators, longest first so '乘以' wins over '乘'
+    _word_operators = [
+        ("multiplied by", "*"), ("divided by", "/"), ("plus", "+"), ("minus", "-"), ("times", "*"),
+        ("加上", "+"), ("减去", "-"), ("乘以", "*"), ("除以", "/"), ("加", "+"), ("减", "-"), ("乘", "*"),
+        ("×", "*"), ("÷", "/"),
+    ]
+    # Explicit verb forms: "add 3 and 5", "multiply 4 by 7"
+    _number = r"(-?\d+(?:\.\d+)?)"
+    _verb_patterns = [
+        (re.compile(rf"^add {_number} (?:and|to) {_number}$"), "+"),
+        (re.compile(rf"^multiply {_number} (?:and|by|with) {_number}$"), "*"),
+        (re.compile(rf"^divide {_number} by {_number}$"), "/"),
+        (re.compile(rf"^subtract {_number} from {_number}$"), "-r"),
+    ]
+    _expression_chars = re.compile(r"^[0-9+\-*/(). ]+$")
+
+    def _normalise(self, message: str) -> str:
+        # NFKC folds full-width digits and operators (１２＋３) into ASCII
+        text = unicodedata.normalize("NFKC", message).strip().lower()
+        changed = True
+        while changed:
+            changed = False
+            for prefix in self._prefixes:
+                if text.startswith(prefix):
+                    text = text[len(prefix):].lstrip(" :,：，")
+                    changed = True
+            for suffix in self._suffixes:
+                if text.endswith(suffix):
+                    text = text[:-len(suffix)].rstrip()
+                    changed = True
+        return text
+
+    def match(self, message: str) -> Optional[IntentMatch]:
+        text = self._normalise(message)
+        if not text:
+            return None
+
+        for pattern, operator in self._verb_patterns:
+            verb_match = pattern.match(text)
+            if verb_match:
+                left, right = verb_match.group(1), verb_match.group(2)
+                if operator == "-r":
+                    left, right, operator = right, left, "-"
+                text = f"{left} {operator} {right}"
+                break
+        else:
+            # '除' on its own is ambiguous in Chinese ('6除3' can mean 3/6), leave it to the agent
+            if "除" in text.replace("除以", ""):
+                return None
+            for word, operator in self._word_operators:
+                text = text.replace(word, f" {operator} ")
+
+        if not self._expression_chars.match(text):
+            return None
+        expression = " ".join(text.split())
+        try:
+            tree = ast.parse(expression, mode="eval").body
+        except SyntaxError:
+            return None
+        if not isinstance(tree, ast.BinOp) or not _is_arithmetic(tree):
+            # Single numbers and anything outside plain arithmetic are not confident matches
+            return None
+
+        # Prefer the dedicated two-operand tools, same choice the agent is instructed to make
+        if _is_number(tree.left) and _is_number(tree.right):
+            if isinstance(tree.op, ast.Add):
+                return IntentMatch("add_numbers", {"a": _number_value(tree.left), "b": _number_value(tree.right)}, expression)
+            if isinstance(tree.op, ast.Mult):
+                return IntentMatch("multiply_numbers", {"a": _number_value(tree.left), "b": _number_value(tree.right)}, expression)
+        return IntentMatch("calculate_expression", {"expression": expression}, expression)
+
+
+class IntentRouter:
+    """Runs intent handlers in order and executes the first confident match over MCP"""
+
+    def __init__(self, handlers: Optional[List[IntentHandler]] = None):
+        self.handlers: List[IntentHandler] = list(handlers) if handlers is not None else [ArithmeticIntent()]
+        self.total = 0
+        self.hits = 0
+        self.fallbacks = 0  # Matched, but tool call failed, so the agent handled it
+
+    def register(self, handler: IntentHandler):
+        """Add a handler (checked after the existing ones)"""
+        self.handlers.append(handler)
+
+    async def try_handle(self, message: str, call_tool: CallTool,
+                         available_tools: Optional[List[str]] = None) -> Optional[str]:
+        """Return a templated answer, or None if the message should go to the agent"""
+        self.total += 1
+        for handler in self.handlers:
+            match = handler.match(message)
+            if match is None:
+                continue
+            if available_tools is not None and match.tool_name not in available_tools:
+                continue
+            try:
+                result = await call_tool(match.tool_name, match.arguments)
+            except Exception as e:
+                logger.warning(f"Fast path tool call failed, falling back to agent: {e}")
+                self.fallbacks += 1
+                return None
+            if getattr(result, "isError", False):
+                logger.info(f"Fast path tool returned error for '{match.description}', falling back to agent")
+                self.fallbacks += 1
+                return None
+            self.hits += 1
+            logger.info(f"Fast path ({handler.name}): {match.tool_name}({match.arguments})")
+            return handler.render(match, result_text(result))
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.total,
+            "hits": self.hits,
+            "fallbacks": self.fallbacks,
+            "hit_rate": round(self.hits / self.total, 4) if self.total else 0.0,
+        }
+
+
+_ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+
+def _is_arithmetic(node) -> bool:
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, _ALLOWED_OPERATORS) and _is_arithmetic(node.left) and _is_arithmetic(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, _ALLOWED_OPERATORS) and _is_arithmetic(node.operand)
+    return _is_number(node)
+
+
+def _is_number(node) -> bool:
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return _is_number(node.operand)
+    return isinstance(node, ast.Constant) and type(node.value) in (int, float)
+
+
+def _number_value(node) -> float:
+    if isinstance(node, ast.UnaryOp):
+        return -_number_value(node.operand)
+    return float(node.value)
+
+
+def result_text(result) -> str:
+    """Extract the tool result text and format whole numbers without '.0'"""
+    text = ""
+    for content in getattr(result, "content", None) or []:
+        if getattr(content, "type", None) == "text":
+            text = content.text
+            break
+    try:
+        value = float(text)
+    except ValueError:
+        return text
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
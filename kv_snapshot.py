@@ -0,0 +1,107 @@
+"""
+KV Snapshot - Reusable llama.cpp state for the fixed prompt prefix
+
+Every agent request starts with the same tokens: the ReAct system header, the system prompt
+and the tool descriptions. The prefix is evaluated once and its llama.cpp state is saved;
+before each completion the snapshot is restored if the live context does not already hold
+that prefix, so prompt processing only covers the per-request part of the prompt.
+Only depends on a llama_cpp.Llama instance, so model replica processes can use it too.
+"""
+import logging
+import threading
+import time
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def common_token_prefix(token_lists: List[List[int]]) -> List[int]:
+    """Longest token prefix shared by all token lists"""
+    if not token_lists:
+        return []
+    prefix = token_lists[0]
+    for tokens in token_lists[1:]:
+        length = 0
+        for a, b in zip(prefix, tokens):
+            if a != b:
+                break
+            length += 1
+        prefix = prefix[:length]
+    return list(prefix)
+
+
+class PrefixSnapshot:
+    """Saved llama.cpp state after evaluating a fixed token prefix"""
+
+    def __init__(self):
+        self.tokens: List[int] = []
+        self.state = None
+        self.build_seconds = 0.0
+        # Counters
+        self.requests = 0
+        self.hits = 0  # Prompt started with the prefix
+        self.restores = 0  # Hits where the snapshot had to be loaded (live context had diverged)
+        self.tokens_saved = 0  # Prefix tokens not evaluated again thanks to the snapshot/live context
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.state is not None
+
+    def build(self, model, tokens: List[int]):
+        """Evaluate the prefix on a fresh context and save the resulting state"""
+        started = time.perf_counter()
+        with self._lock:
+            model.reset()
+            model.eval(tokens)
+            self.state = model.save_state()
+            self.tokens = list(tokens)
+        self.build_seconds = time.perf_counter() - started
+        logger.info(f"Prompt prefix snapshot built: {len(tokens)} tokens in {self.build_seconds:.2f}s")
+
+    def build_from_prompts(self, model, prompts: List[str], max_tokens: int, min_tokens: int = 32) -> Optional[int]:
+        """Snapshot the token prefix shared by the given (fully formatted) prompts
+
+        Returns the prefix length, or None if the prompts share too little to be worth it.
+        """
+        prefix = common_token_prefix([
+            model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True) for prompt in prompts
+        ])
+        if len(prefix) < min_tokens:
+            logger.info(f"Prompt prefix too short to snapshot ({len(prefix)} tokens)")
+            return None
+        # Leave room for the request itself
+        if len(prefix) >= max_tokens:
+            logger.warning(f"Prompt prefix ({len(prefix)} tokens) does not fit the context window, not snapshotted")
+            return None
+        self.build(model, prefix)
+        return len(prefix)
+
+    def prepare(self, model, prompt: str):
+        """Make sure the model context starts with the prefix before generating for this prompt"""
+        if not self.ready:
+            return
+        prompt_tokens = model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        size = len(self.tokens)
+        with self._lock:
+            self.requests += 1
+            if prompt_tokens[:size] != self.tokens:
+                return
+            self.hits += 1
+            self.tokens_saved += size
+            live_prefix = model.longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), self.tokens)
+            if live_prefix < size:
+                # llama.cpp reuses the longest matching prefix of the live context when generating
+                model.load_state(self.state)
+                self.restores += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.ready,
+            "prefix_tokens": len(self.tokens),
+            "build_seconds": round(self.build_seconds, 3),
+            "requests": self.requests,
+            "hits": self.hits,
+            "restores": self.restores,
+            "prefix_tokens_saved": self.tokens_saved,
+        }
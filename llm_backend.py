@@ -0,0 +1,184 @@
+"""
+LLM Backend - In-process LlamaCPP with the prompt prefix KV snapshot (see kv_snapshot.py),
+per-session KV state (see session_store.py) and LLM call metrics collected from LlamaIndex
+instrumentation events
+"""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.base.llms.types import CompletionResponse, CompletionResponseGen
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.exception import ExceptionEvent
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMChatInProgressEvent,
+    LLMChatStartEvent,
+)
+from llama_cpp import LlamaGrammar
+from llama_index.llms.llama_cpp import LlamaCPP
+from pydantic import PrivateAttr
+
+from kv_snapshot import PrefixSnapshot
+from metrics import (
+    LLM_GENERATION_SECONDS,
+    LLM_TIME_TO_FIRST_TOKEN,
+    LLM_TOKENS_GENERATED,
+    LLM_TOKENS_PER_SECOND,
+)
+from session_store import current_session
+
+# Generation settings that can be given per call (e.g. the agent's per-step token budget, see token_budget.py)
+CALL_KWARGS = ("grammar", "max_tokens", "stop")
+
+
+class LocalLlamaCPP(LlamaCPP):
+    """LlamaCPP that restores the session's KV state or the prompt prefix snapshot before each completion"""
+
+    _prefix_snapshot: PrefixSnapshot = PrivateAttr(default_factory=PrefixSnapshot)
+    _grammars: Dict[str, LlamaGrammar] = PrivateAttr(default_factory=dict)  # Parsed GBNF by grammar text
+
+    @property
+    def prefix_snapshot(self) -> PrefixSnapshot:
+        return self._prefix_snapshot
+
+    def prefix_stats(self) -> dict:
+        return self._prefix_snapshot.stats()
+
+    def build_prefix_snapshot(self, prompts: List[str]) -> Optional[int]:
+        """Snapshot the token prefix shared by the given (fully formatted) prompts"""
+        return self._prefix_snapshot.build_from_prompts(
+            self._model, prompts, max_tokens=self.context_window - self.max_new_tokens
+        )
+
+    def set_grammar(self, grammar: Optional[str]):
+        """Constrain every completion with a GBNF grammar (None removes it)"""
+        if grammar is None:
+            self.generate_kwargs.pop("grammar", None)
+        else:
+            self.generate_kwargs["grammar"] = self._parse_grammar(grammar)
+
+    def _parse_grammar(self, grammar: str) -> LlamaGrammar:
+        parsed = self._grammars.get(grammar)
+        if parsed is None:
+            if len(self._grammars) >= 8:
+                self._grammars.clear()  # Old tool catalogs
+            parsed = self._grammars[grammar] = LlamaGrammar.from_string(grammar, verbose=False)
+        return parsed
+
+    @contextmanager
+    def _call_kwargs(self, kwargs: Dict[str, Any]):
+        """Apply the per-call grammar, max_tokens and stop (complete(..., max_tokens=...)) to one completion,
+        LlamaCPP only reads generate_kwargs"""
+        overrides = {key: kwargs.pop(key, None) for key in CALL_KWARGS}
+        overrides = {key: value for key, value in overrides.items() if value is not None}
+        if "grammar" in overrides:
+            overrides["grammar"] = self._parse_grammar(overrides["grammar"])
+        saved = {key: self.generate_kwargs[key] for key in overrides if key in self.generate_kwargs}
+        self.generate_kwargs.update(overrides)
+        try:
+            yield
+        finally:
+            for key in overrides:
+                if key in saved:
+                    self.generate_kwargs[key] = saved[key]
+                else:
+                    self.generate_kwargs.pop(key, None)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        if formatted:
+            self._prepare(prompt)
+        with self._call_kwargs(kwargs):
+            response = super().complete(prompt, formatted=formatted, **kwargs)
+        session = current_session.get()
+        if session is not None:
+            session.save_kv(self._model)
+        return response
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        if formatted:
+            self._prepare(prompt)
+        # The generator is created (and its arguments bound) inside the call
+        with self._call_kwargs(kwargs):
+            response = super().stream_complete(prompt, formatted=formatted, **kwargs)
+        session = current_session.get()
+        if session is None:
+            return response
+
+        def gen() -> CompletionResponseGen:
+            try:
+                yield from response
+            finally:
+                # Also when the agent closes the stream early (token budgets), the state is valid up to there
+                session.save_kv(self._model)
+
+        return gen()
+
+    def _prepare(self, prompt: str):
+        """Make the live context start with the longest saved state the prompt begins with"""
+        session = current_session.get()
+        if session is not None:
+            prompt_tokens = self._model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+            if session.restore_kv(self._model, prompt_tokens, min_tokens=len(self._prefix_snapshot.tokens)):
+                return
+        self._prefix_snapshot.prepare(self._model, prompt)
+
+
+class LLMMetricsHandler(BaseEventHandler):
+    """Time to first token, duration, tokens and tokens/s of the agent's LLM calls"""
+
+    # The agent calls achat/astream_chat; the sync chat/complete spans nested inside them are skipped
+    _agent_spans = (".astream_chat-", ".achat-")
+    _max_open_calls = 1024
+    _calls: Dict[str, list] = PrivateAttr(default_factory=dict)  # span_id -> [started, first_token, tokens]
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LLMMetricsHandler"
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> None:
+        span_id = event.span_id or ""
+        if not any(marker in span_id for marker in self._agent_spans):
+            return
+        now = time.perf_counter()
+        if isinstance(event, LLMChatStartEvent):
+            if len(self._calls) >= self._max_open_calls:
+                # Abandoned streams never send an end event
+                self._calls.pop(next(iter(self._calls)))
+            self._calls[span_id] = [now, None, 0]
+        elif isinstance(event, LLMChatInProgressEvent):
+            call = self._calls.get(span_id)
+            if call is not None:
+                if call[1] is None:
+                    call[1] = now
+                    LLM_TIME_TO_FIRST_TOKEN.observe(now - call[0])
+                call[2] += 1  # llama.cpp streams one token per chunk
+        elif isinstance(event, LLMChatEndEvent):
+            call = self._calls.pop(span_id, None)
+            if call is not None:
+                self._observe(call, now, event.response)
+        elif isinstance(event, ExceptionEvent):
+            call = self._calls.pop(span_id, None)
+            if call is not None and isinstance(event.exception, GeneratorExit):
+                # Stream closed by the consumer (a budgeted agent step that ended early), not a failure
+                self._observe(call, now)
+
+    @staticmethod
+    def _observe(call: list, now: float, response=None):
+        started, first_token, tokens = call
+        LLM_GENERATION_SECONDS.observe(now - started)
+        if not tokens:
+            tokens = _usage_tokens(response)
+        if tokens:
+            LLM_TOKENS_GENERATED.observe(tokens)
+        if first_token is not None and tokens > 1 and now > first_token:
+            LLM_TOKENS_PER_SECOND.observe((tokens - 1) / (now - first_token))
+
+
+def _usage_tokens(response) -> int:
+    """Completion tokens reported by llama-cpp-python in a non-streamed response"""
+    raw = getattr(response, "raw", None)
+    if isinstance(raw, dict):
+        return int((raw.get("usage") or {}).get("completion_tokens") or 0)
+    return 0
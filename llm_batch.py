@@ -0,0 +1,581 @@
+"""
+LLM Batch Engine - Continuous batched decoding of many sequences in one llama.cpp context
+
+llama_decode accepts tokens of several sequences at once (one KV cache, sequences told apart
+by seq_id). On CPU a decode step is dominated by reading the weights, so one step for 8
+sequences costs little more than for one. The engine owns a llama.cpp context with `slots`
+sequences, admits a new prompt whenever a slot is free, decodes all active sequences together
+and streams each sequence's text back as it is sampled. The prompt prefix shared by all agent
+prompts (system prompt + tools) is evaluated once into a reserved sequence and shared with
+each new sequence through the KV cache (llama_memory_seq_cp), so only the rest is evaluated.
+
+BatchLlamaCPP is the LlamaIndex LLM used for /chat/batch agent runs.
+"""
+import asyncio
+import codecs
+import ctypes
+import itertools
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import llama_cpp
+from llama_cpp import LlamaGrammar
+from llama_cpp._internals import LlamaBatch, LlamaContext, LlamaModel, LlamaSampler
+from llama_index.core.base.llms.generic_utils import (
+    astream_completion_response_to_chat_response,
+    completion_response_to_chat_response,
+    stream_completion_response_to_chat_response,
+)
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from pydantic import Field, PrivateAttr
+
+from kv_snapshot import common_token_prefix
+from llm_backend import CALL_KWARGS
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEngineError(RuntimeError):
+    """The batch engine failed to load, was closed or could not generate a sequence"""
+
+
+class _Sequence:
+    """One generation request: prompt tokens, sampling state and the caller's result queue"""
+
+    def __init__(self, request_id: int, prompt: str, generate_kwargs: Dict[str, Any], stream: bool,
+                 loop: Optional[asyncio.AbstractEventLoop]):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.generate_kwargs = generate_kwargs
+        self.stream = stream
+        self.loop = loop
+        self.queue = asyncio.Queue() if loop is not None else queue.Queue()
+        self.seq_id = -1
+        self.tokens: List[int] = []
+        self.n_prompt = 0
+        self.n_past = 0
+        self.generated = 0
+        self.max_tokens = 0
+        self.stop: List[str] = []
+        self.sampler: Optional[LlamaSampler] = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""
+        self.sent = 0  # Characters of text already sent as deltas
+        self.cancelled = False
+        self.finished = False
+
+    def put(self, item):
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+            except RuntimeError:
+                pass  # Requesting event loop is gone, nobody is waiting for this result
+        else:
+            self.queue.put(item)
+
+
+def _held_back(text: str, stops: List[str]) -> int:
+    """Characters at the end of text that could be the start of a stop sequence"""
+    held = 0
+    for stop in stops:
+        for length in range(min(len(stop) - 1, len(text)), held, -1):
+            if text.endswith(stop[:length]):
+                held = length
+                break
+    return held
+
+
+class BatchEngine:
+    """llama.cpp context decoding up to `slots` sequences per step on a background thread"""
+
+    def __init__(self, model_path: str, slots: int = 4, context_per_slot: int = 2048, n_batch: int = 512,
+                 n_threads: Optional[int] = None, prefix_tokens: int = 2048):
+        self.model_path = model_path
+        self.slots = max(1, slots)
+        self.context_per_slot = context_per_slot
+        self.n_batch = n_batch
+        self.n_threads = n_threads
+        self.prefix_budget = prefix_tokens
+        self._model: Optional[LlamaModel] = None
+        self._ctx: Optional[LlamaContext] = None
+        self._batch: Optional[LlamaBatch] = None
+        self._requests: "queue.Queue" = queue.Queue()
+        self._ids = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+        self._prefix: List[int] = []
+        # Reserved sequence id holding the shared prompt prefix (slots use 0..slots-1)
+        self._prefix_seq = self.slots
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.prefix_tokens_saved = 0
+        self.generated_tokens = 0
+        self.decode_steps = 0
+        self.decode_sequences = 0
+        self.busy_seconds = 0.0
+
+    def start(self):
+        """Load the model and create the multi-sequence context (blocking)"""
+        model_params = LlamaModel.default_params()
+        model_params.use_mmap = True
+        self._model = LlamaModel(path_model=self.model_path, params=model_params, verbose=False)
+        ctx_params = LlamaContext.default_params()
+        # Unified KV cache: the prefix cells are shared by every sequence instead of copied
+        ctx_params.n_ctx = self.prefix_budget + self.slots * self.context_per_slot
+        ctx_params.n_batch = self.n_batch
+        ctx_params.n_ubatch = self.n_batch
+        ctx_params.n_seq_max = self.slots + 1
+        ctx_params.kv_unified = True
+        if self.n_threads:
+            ctx_params.n_threads = self.n_threads
+            ctx_params.n_threads_batch = self.n_threads
+        self._ctx = LlamaContext(model=self._model, params=ctx_params, verbose=False)
+        self._batch = LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=False)
+        self._thread = threading.Thread(target=self._run, name="llm-batch-engine", daemon=True)
+        self._thread.start()
+        logger.info(f"Batch engine started: {self.slots} slots x {self.context_per_slot} tokens, "
+                    f"n_batch={self.n_batch}, threads={self.n_threads or 'default'}")
+
+    def close(self):
+        if self._thread is not None:
+            self._requests.put(None)
+            self._thread.join(timeout=30)
+            self._thread = None
+        for resource in (self._batch, self._ctx, self._model):
+            if resource is not None:
+                resource.close()
+        self._batch = self._ctx = self._model = None
+
+    def submit(self, prompt: str, generate_kwargs: Dict[str, Any], stream: bool,
+               loop: Optional[asyncio.AbstractEventLoop] = None) -> _Sequence:
+        """Queue a completion, messages arrive on the returned sequence's queue (delta/done/error)"""
+        if self._thread is None:
+            raise BatchEngineError("Batch engine is not running")
+        sequence = _Sequence(next(self._ids), prompt, generate_kwargs, stream, loop)
+        self._requests.put(("complete", sequence))
+        return sequence
+
+    def cancel(self, sequence: _Sequence):
+        """Stop generating for an abandoned request (checked before every decode step)"""
+        if not sequence.finished:
+            sequence.cancelled = True
+
+    def build_prefix_snapshot(self, prompts: List[str], max_tokens: int) -> Optional[int]:
+        """Evaluate the prefix shared by `prompts` into the reserved sequence (blocking)"""
+        done: "queue.Queue" = queue.Queue()
+        self._requests.put(("prefix", (prompts, min(max_tokens, self.prefix_budget), done)))
+        kind, payload = done.get()
+        if kind == "error":
+            raise BatchEngineError(payload)
+        return payload
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "context_per_slot": self.context_per_slot,
+            "active": self.active,
+            "queued": self._requests.qsize(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "prefix_tokens": len(self._prefix),
+            "prompt_tokens": self.prompt_tokens,
+            "prefix_tokens_saved": self.prefix_tokens_saved,
+            "generated_tokens": self.generated_tokens,
+            "decode_steps": self.decode_steps,
+            "mean_sequences_per_step": round(self.decode_sequences / self.decode_steps, 2) if self.decode_steps else 0.0,
+            "tokens_per_second": round(self.generated_tokens / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+        }
+
+    # ---- Engine thread ----
+
+    def _run(self):
+        free = list(range(self.slots))
+        active: List[_Sequence] = []
+        while True:
+            # Admit new requests into free slots, block only when there is nothing to decode
+            while free:
+                try:
+                    item = self._requests.get(block=not active)
+                except queue.Empty:
+                    break
+                if item is None:
+                    for sequence in active:
+                        sequence.put(("error", "Batch engine closed"))
+                    return
+                kind, payload = item
+                if kind == "prefix":
+                    self._build_prefix(*payload)
+                    continue
+                if self._admit(payload, free.pop()):
+                    active.append(payload)
+                    self.active = len(active)
+                else:
+                    free.append(payload.seq_id)
+            if not active:
+                continue
+
+            for sequence in [s for s in active if s.cancelled]:
+                self._finish(sequence, active, free, completed=False)
+            if not active:
+                continue
+
+            started = time.perf_counter()
+            try:
+                outputs = self._decode_step(active)
+            except Exception as e:
+                logger.error(f"Batch decode failed: {e}")
+                for sequence in list(active):
+                    sequence.put(("error", f"{type(e).__name__}: {e}"))
+                    self.failed += 1
+                    self._finish(sequence, active, free, completed=False)
+                continue
+            for index, sequence in outputs:
+                self._sample(index, sequence, active, free)
+            self.busy_seconds += time.perf_counter() - started
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self._model.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+
+    def _piece(self, token: int) -> bytes:
+        buf = ctypes.create_string_buffer(64)
+        n = llama_cpp.llama_token_to_piece(self._model.vocab, token, buf, len(buf), 0, False)
+        if n < 0:
+            buf = ctypes.create_string_buffer(-n)
+            n = llama_cpp.llama_token_to_piece(self._model.vocab, token, buf, len(buf), 0, False)
+        return buf.raw[:n]
+
+    def _build_prefix(self, prompts: List[str], max_tokens: int, done: "queue.Queue"):
+        try:
+            prefix = common_token_prefix([self._tokenize(prompt) for prompt in prompts])[:max_tokens]
+            self._ctx.kv_cache_seq_rm(self._prefix_seq, -1, -1)
+            self._prefix = []
+            if len(prefix) >= 32:
+                for start in range(0, len(prefix), self.n_batch):
+                    chunk = prefix[start:start + self.n_batch]
+                    self._batch.reset()
+                    for offset, token in enumerate(chunk):
+                        self._add(token, start + offset, self._prefix_seq, False)
+                    self._ctx.decode(self._batch)
+                self._prefix = prefix
+            logger.info(f"Batch engine prompt prefix: {len(self._prefix)} tokens")
+            done.put(("done", len(self._prefix) or None))
+        except Exception as e:
+            done.put(("error", f"{type(e).__name__}: {e}"))
+
+    def _admit(self, sequence: _Sequence, seq_id: int) -> bool:
+        """Tokenize the prompt and set up the sequence in `seq_id`, False if it cannot run"""
+        sequence.seq_id = seq_id
+        kwargs = sequence.generate_kwargs
+        try:
+            tokens = self._tokenize(sequence.prompt)
+        except Exception as e:
+            sequence.put(("error", f"{type(e).__name__}: {e}"))
+            self.failed += 1
+            return False
+        room = self.context_per_slot - len(tokens)
+        if room <= 0:
+            sequence.put(("error", f"Prompt of {len(tokens)} tokens exceeds the batch slot context "
+                                   f"({self.context_per_slot} tokens)"))
+            self.failed += 1
+            return False
+        sequence.tokens = tokens
+        sequence.n_prompt = len(tokens)
+        sequence.max_tokens = min(int(kwargs.get("max_tokens") or room), room)
+        stop = kwargs.get("stop") or []
+        sequence.stop = [stop] if isinstance(stop, str) else list(stop)
+        try:
+            sequence.sampler = self._make_sampler(kwargs, tokens[-64:])
+        except Exception as e:
+            sequence.put(("error", f"{type(e).__name__}: {e}"))
+            self.failed += 1
+            return False
+
+        # Share the KV cells of the common prompt prefix instead of evaluating it again
+        shared = 0
+        if self._prefix:
+            limit = min(len(self._prefix), len(tokens) - 1)
+            while shared < limit and tokens[shared] == self._prefix[shared]:
+                shared += 1
+            if shared < 32:
+                shared = 0
+        self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        if shared:
+            self._ctx.kv_cache_seq_cp(self._prefix_seq, seq_id, 0, shared)
+        sequence.n_past = shared
+        self.prompt_tokens += len(tokens)
+        self.prefix_tokens_saved += shared
+        return True
+
+    def _make_sampler(self, kwargs: Dict[str, Any], history: List[int]) -> LlamaSampler:
+        """Sampler chain with llama-cpp-python's completion defaults (per sequence state)
+
+        history: last prompt tokens, seen by the repetition penalties (but not by the grammar).
+        """
+        sampler = LlamaSampler()
+        temperature = float(kwargs.get("temperature", 0.8))
+        sampler.add_penalties(
+            n_vocab=self._model.n_vocab(),
+            penalty_last_n=64,
+            penalty_repeat=float(kwargs.get("repeat_penalty", 1.0)),
+            penalty_freq=float(kwargs.get("frequency_penalty", 0.0)),
+            penalty_present=float(kwargs.get("presence_penalty", 0.0)),
+        )
+        for token in history:
+            sampler.accept(token)
+        if kwargs.get("grammar") is not None:
+            sampler.add_grammar(self._model, LlamaGrammar.from_string(kwargs["grammar"], verbose=False))
+        if temperature <= 0:
+            sampler.add_greedy()
+            return sampler
+        sampler.add_top_k(int(kwargs.get("top_k", 40)))
+        sampler.add_top_p(float(kwargs.get("top_p", 0.95)), 1)
+        sampler.add_min_p(float(kwargs.get("min_p", 0.05)), 1)
+        sampler.add_temp(temperature)
+        sampler.add_dist(int(kwargs.get("seed") or llama_cpp.LLAMA_DEFAULT_SEED))
+        return sampler
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        batch = self._batch.batch
+        index = batch.n_tokens
+        batch.token[index] = token
+        batch.pos[index] = pos
+        batch.n_seq_id[index] = 1
+        batch.seq_id[index][0] = seq_id
+        batch.logits[index] = logits
+        batch.n_tokens = index + 1
+
+    def _decode_step(self, active: List[_Sequence]):
+        """One llama_decode: the next token of every generating sequence, then prompt chunks
+
+        Returns (batch index, sequence) for every sequence that has logits to sample from.
+        """
+        self._batch.reset()
+        outputs = []
+        advanced = []
+        for sequence in active:
+            if sequence.n_past >= sequence.n_prompt:
+                outputs.append((self._batch.n_tokens(), sequence))
+                self._add(sequence.tokens[-1], sequence.n_past, sequence.seq_id, True)
+                advanced.append((sequence, 1))
+        for sequence in active:
+            room = self.n_batch - self._batch.n_tokens()
+            if room <= 0:
+                break
+            if sequence.n_past >= sequence.n_prompt:
+                continue
+            chunk = sequence.tokens[sequence.n_past:min(sequence.n_prompt, sequence.n_past + room)]
+            for offset, token in enumerate(chunk):
+                position = sequence.n_past + offset
+                last = position == sequence.n_prompt - 1
+                if last:
+                    outputs.append((self._batch.n_tokens(), sequence))
+                self._add(token, position, sequence.seq_id, last)
+            advanced.append((sequence, len(chunk)))
+        self._ctx.decode(self._batch)
+        for sequence, count in advanced:
+            sequence.n_past += count
+        self.decode_steps += 1
+        self.decode_sequences += len(outputs)
+        return outputs
+
+    def _sample(self, index: int, sequence: _Sequence, active: List[_Sequence], free: List[int]):
+        token = sequence.sampler.sample(self._ctx, index)
+        self.generated_tokens += 1
+        sequence.generated += 1
+        if llama_cpp.llama_vocab_is_eog(self._model.vocab, token):
+            self._finish(sequence, active, free)
+            return
+        sequence.tokens.append(token)
+        sequence.text += sequence.decoder.decode(self._piece(token))
+        for stop in sequence.stop:
+            position = sequence.text.find(stop, max(0, sequence.sent - len(stop)))
+            if position >= 0:
+                sequence.text = sequence.text[:position]
+                self._finish(sequence, active, free)
+                return
+        if sequence.generated >= sequence.max_tokens:
+            self._finish(sequence, active, free)
+            return
+        if sequence.stream:
+            # Don't send text that may turn out to be the start of a stop sequence
+            ready = len(sequence.text) - _held_back(sequence.text, sequence.stop)
+            if ready > sequence.sent:
+                sequence.put(("delta", sequence.text[sequence.sent:ready]))
+                sequence.sent = ready
+
+    def _finish(self, sequence: _Sequence, active: List[_Sequence], free: List[int], completed: bool = True):
+        active.remove(sequence)
+        self.active = len(active)
+        self._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+        free.append(sequence.seq_id)
+        sequence.finished = True
+        if sequence.sampler is not None:
+            sequence.sampler.close()
+            sequence.sampler = None
+        if not completed:
+            return
+        self.completed += 1
+        if sequence.stream and len(sequence.text) > sequence.sent:
+            sequence.put(("delta", sequence.text[sequence.sent:]))
+        sequence.put(("done", {"text": sequence.text, "prompt_tokens": sequence.n_prompt,
+                               "tokens": sequence.generated}))
+
+
+class BatchLlamaCPP(CustomLLM):
+    """LlamaIndex LLM whose completions are decoded together with other requests by a BatchEngine"""
+
+    model_path: str = Field(description="Path of the GGUF model loaded by the engine.")
+    temperature: float = Field(default=0.1, description="The temperature to use for sampling.")
+    max_new_tokens: int = Field(default=256, description="The maximum number of tokens to generate.")
+    context_window: int = Field(default=2048, description="Context window of each engine slot.")
+    generate_kwargs: Dict[str, Any] = Field(default_factory=dict, description="Kwargs used for generation.")
+
+    _engine: BatchEngine = PrivateAttr()
+
+    def __init__(self, engine: BatchEngine, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._engine = engine
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BatchLlamaCPP"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_new_tokens,
+            model_name=self.model_path,
+        )
+
+    @property
+    def engine(self) -> BatchEngine:
+        return self._engine
+
+    def build_prefix_snapshot(self, prompts: List[str]) -> Optional[int]:
+        return self._engine.build_prefix_snapshot(prompts, max_tokens=self.context_window - self.max_new_tokens)
+
+    def set_grammar(self, grammar: Optional[str]):
+        """Constrain every completion with a GBNF grammar (None removes it)"""
+        if grammar is None:
+            self.generate_kwargs.pop("grammar", None)
+        else:
+            self.generate_kwargs["grammar"] = grammar
+
+    def prefix_stats(self) -> dict:
+        stats = self._engine.stats()
+        return {"enabled": stats["prefix_tokens"] > 0, "prefix_tokens": stats["prefix_tokens"],
+                "prefix_tokens_saved": stats["prefix_tokens_saved"]}
+
+    def _submit(self, prompt: str, formatted: bool, stream: bool, kwargs: Dict[str, Any],
+                loop: Optional[asyncio.AbstractEventLoop] = None) -> _Sequence:
+        if not formatted:
+            prompt = self.completion_to_prompt(prompt)
+        generate_kwargs = {**self.generate_kwargs, "temperature": self.temperature, "max_tokens": self.max_new_tokens}
+        for key in CALL_KWARGS:
+            if kwargs.get(key) is not None:
+                generate_kwargs[key] = kwargs[key]  # This call only
+        return self._engine.submit(prompt, generate_kwargs, stream, loop=loop)
+
+    # ---- Blocking API (waits on the calling thread) ----
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        sequence = self._submit(prompt, formatted, False, kwargs)
+        kind, payload = sequence.queue.get()
+        if kind == "error":
+            raise BatchEngineError(payload)
+        return CompletionResponse(text=payload["text"])
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        sequence = self._submit(prompt, formatted, True, kwargs)
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            try:
+                while True:
+                    kind, payload = sequence.queue.get()
+                    if kind == "error":
+                        raise BatchEngineError(payload)
+                    if kind == "done":
+                        return
+                    text += payload
+                    yield CompletionResponse(delta=payload, text=text)
+            finally:
+                self._engine.cancel(sequence)
+
+        return gen()
+
+    # ---- Async API (the agent's path, keeps the event loop free while the engine decodes) ----
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        sequence = self._submit(prompt, formatted, False, kwargs, loop=asyncio.get_running_loop())
+        try:
+            kind, payload = await sequence.queue.get()
+        finally:
+            self._engine.cancel(sequence)
+        if kind == "error":
+            raise BatchEngineError(payload)
+        return CompletionResponse(text=payload["text"])
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False,
+                               **kwargs: Any) -> CompletionResponseAsyncGen:
+        sequence = self._submit(prompt, formatted, True, kwargs, loop=asyncio.get_running_loop())
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            try:
+                while True:
+                    kind, payload = await sequence.queue.get()
+                    if kind == "error":
+                        raise BatchEngineError(payload)
+                    if kind == "done":
+                        return
+                    text += payload
+                    yield CompletionResponse(delta=payload, text=text)
+            finally:
+                self._engine.cancel(sequence)
+
+        return gen()
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(
+            self.complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return stream_completion_response_to_chat_response(
+            self.stream_complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(
+            await self.acomplete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return astream_completion_response_to_chat_response(
+            await self.astream_complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
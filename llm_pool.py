@@ -0,0 +1,409 @@
+"""
+LLM Replica Pool - Serve generations from several llama.cpp processes pinned to CPU cores
+
+One llama.cpp context generates one sequence at a time, so a single model instance leaves
+most cores of a large machine idle. The pool starts N worker processes, pins each one to its
+own subset of cores and loads the GGUF model there with mmap, so the weights live once in the
+page cache and only the KV cache is per replica. ReplicaLLM is a LlamaIndex LLM that sends
+each completion to the least-loaded replica.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index.core.base.llms.generic_utils import (
+    astream_completion_response_to_chat_response,
+    completion_response_to_chat_response,
+    stream_completion_response_to_chat_response,
+)
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from pydantic import Field, PrivateAttr
+
+from llm_backend import CALL_KWARGS
+from llm_replica import replica_main
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaError(RuntimeError):
+    """A replica failed to load, crashed or returned an error"""
+
+
+def split_cores(replicas: int, threads_per_replica: Optional[int] = None) -> List[List[int]]:
+    """Assign disjoint core sets to replicas (from the cores this process may run on)"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    threads = threads_per_replica or max(1, len(cores) // replicas)
+    if threads * replicas > len(cores):
+        logger.warning(
+            f"{replicas} replicas x {threads} threads exceeds {len(cores)} available cores, replicas will share cores"
+        )
+    return [[cores[(index * threads + offset) % len(cores)] for offset in range(threads)]
+            for index in range(replicas)]
+
+
+class _Replica:
+    def __init__(self, index: int, cores: List[int], process, requests, cancelled):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.requests = requests
+        self.cancelled = cancelled
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = False
+        self.prefix_stats: Dict[str, Any] = {}
+
+
+class _Pending:
+    """Receives replica messages for one request, on an event loop or a blocking thread"""
+
+    def __init__(self, replica: _Replica, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.replica = replica
+        self.loop = loop
+        self.queue = asyncio.Queue() if loop is not None else queue.Queue()
+
+    def put(self, item):
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+            except RuntimeError:
+                pass  # Requesting event loop is gone, nobody is waiting for this result
+        else:
+            self.queue.put(item)
+
+
+class ReplicaPool:
+    """Worker processes each running one llama.cpp model replica"""
+
+    def __init__(self, model_path: str, replicas: int = 2, threads_per_replica: Optional[int] = None,
+                 model_kwargs: Optional[Dict[str, Any]] = None, start_timeout: float = 600):
+        self.model_path = model_path
+        self.replicas = max(1, replicas)
+        self.core_sets = split_cores(self.replicas, threads_per_replica)
+        self.model_kwargs = model_kwargs or {}
+        self.start_timeout = start_timeout
+        self._replicas: List[_Replica] = []
+        self._pending: Dict[int, _Pending] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._responses = None
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start replica processes and wait until every model is loaded"""
+        # spawn: llama.cpp state and threads must not be inherited through fork
+        context = multiprocessing.get_context("spawn")
+        self._responses = context.Queue()
+        for index, cores in enumerate(self.core_sets):
+            requests = context.Queue()
+            cancelled = context.Queue()  # Ids of abandoned requests
+            process = context.Process(
+                target=replica_main,
+                args=(index, self.model_path, self.model_kwargs, cores, requests, self._responses, cancelled),
+                name=f"llm-replica-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._replicas.append(_Replica(index, cores, process, requests, cancelled))
+            logger.info(f"Started LLM replica {index} (pid {process.pid}) on cores {cores}")
+
+        deadline = time.monotonic() + self.start_timeout
+        waiting = set(range(self.replicas))
+        while waiting:
+            try:
+                index, _, kind, payload = self._responses.get(timeout=1)
+            except queue.Empty:
+                dead = [index for index in waiting if not self._replicas[index].process.is_alive()]
+                if dead or time.monotonic() > deadline:
+                    self.close()
+                    reason = "exited while loading" if dead else f"did not load within {self.start_timeout:.0f}s"
+                    raise ReplicaError(f"LLM replicas {dead or sorted(waiting)} {reason}")
+                continue
+            if kind == "failed":
+                self.close()
+                raise ReplicaError(f"LLM replica {index} failed to load model: {payload}")
+            waiting.discard(index)
+            logger.info(f"LLM replica {index} loaded model")
+
+        self._reader = threading.Thread(target=self._read_responses, name="llm-replica-reader", daemon=True)
+        self._reader.start()
+
+    def close(self):
+        """Stop replica processes"""
+        for replica in self._replicas:
+            if replica.process.is_alive():
+                replica.requests.put(None)
+        for replica in self._replicas:
+            replica.process.join(timeout=5)
+            if replica.process.is_alive():
+                replica.process.terminate()
+        if self._reader is not None:
+            self._responses.put(None)
+            self._reader.join(timeout=5)
+            self._reader = None
+        self._fail_pending(lambda pending: True, "LLM replica pool is shutting down")
+        self._replicas = []
+
+    def _read_responses(self):
+        """Route replica messages to waiting requests and detect crashed replicas"""
+        while True:
+            try:
+                message = self._responses.get(timeout=1)
+            except queue.Empty:
+                self._check_replicas()
+                continue
+            if message is None:
+                return
+            index, request_id, kind, payload = message
+            with self._lock:
+                pending = self._pending.get(request_id)
+                if kind in ("done", "error"):
+                    self._pending.pop(request_id, None)
+                    replica = self._replicas[index]
+                    replica.in_flight -= 1
+                    replica.completed += 1
+                    if isinstance(payload, dict) and "prefix" in payload:
+                        replica.prefix_stats = payload["prefix"]
+            if pending is not None:
+                pending.put((kind, payload))
+
+    def _check_replicas(self):
+        for replica in self._replicas:
+            if not replica.failed and not replica.process.is_alive():
+                replica.failed = True
+                logger.error(f"LLM replica {replica.index} exited (code {replica.process.exitcode})")
+                self._fail_pending(lambda pending: pending.replica is replica,
+                                   f"LLM replica {replica.index} exited")
+
+    def _fail_pending(self, predicate, reason: str):
+        with self._lock:
+            failed = [(request_id, pending) for request_id, pending in self._pending.items() if predicate(pending)]
+            for request_id, pending in failed:
+                del self._pending[request_id]
+                pending.replica.in_flight -= 1
+        for _, pending in failed:
+            pending.put(("error", reason))
+
+    def submit(self, kind: str, payload, loop: Optional[asyncio.AbstractEventLoop] = None,
+               replica: Optional[_Replica] = None):
+        """Send a request to `replica` (default: least loaded), returns (request_id, pending)"""
+        with self._lock:
+            if replica is None:
+                available = [r for r in self._replicas if not r.failed]
+                if not available:
+                    raise ReplicaError("No LLM replica is available")
+                replica = min(available, key=lambda r: r.in_flight)
+            request_id = next(self._ids)
+            pending = _Pending(replica, loop)
+            self._pending[request_id] = pending
+            replica.in_flight += 1
+        replica.requests.put((request_id, kind, payload))
+        return request_id, pending
+
+    def cancel(self, request_id: int, pending: _Pending):
+        """Stop generating for an abandoned request (checked by the replica before the prompt and after every token)"""
+        with self._lock:
+            if request_id in self._pending:
+                pending.replica.cancelled.put(request_id)
+
+    def build_prefix_snapshot(self, prompts: List[str], max_tokens: int) -> Optional[int]:
+        """Build the prompt prefix snapshot on every replica"""
+        submitted = [self.submit("prefix", (prompts, max_tokens), replica=replica) for replica in self._replicas]
+        prefix_tokens = None
+        for _, pending in submitted:
+            kind, payload = pending.queue.get()
+            if kind == "error":
+                raise ReplicaError(payload)
+            prefix_tokens = payload["prefix_tokens"]
+        return prefix_tokens
+
+    def prefix_stats(self) -> dict:
+        """Prompt prefix snapshot counters summed over replicas"""
+        stats = [replica.prefix_stats for replica in self._replicas if replica.prefix_stats]
+        if not stats:
+            return {"enabled": False}
+        totals = {"enabled": all(s.get("enabled") for s in stats), "prefix_tokens": stats[0].get("prefix_tokens", 0)}
+        for key in ("requests", "hits", "restores", "prefix_tokens_saved"):
+            totals[key] = sum(s.get(key, 0) for s in stats)
+        return totals
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [
+                {
+                    "index": replica.index,
+                    "pid": replica.process.pid,
+                    "cores": replica.cores,
+                    "alive": not replica.failed and replica.process.is_alive(),
+                    "in_flight": replica.in_flight,
+                    "completed": replica.completed,
+                }
+                for replica in self._replicas
+            ],
+        }
+
+
+class ReplicaLLM(CustomLLM):
+    """LlamaIndex LLM that dispatches completions to the least-loaded replica of a ReplicaPool"""
+
+    model_path: str = Field(description="Path of the GGUF model loaded by the replicas.")
+    temperature: float = Field(default=0.1, description="The temperature to use for sampling.")
+    max_new_tokens: int = Field(default=256, description="The maximum number of tokens to generate.")
+    context_window: int = Field(default=4096, description="Context window of each replica.")
+    generate_kwargs: Dict[str, Any] = Field(default_factory=dict, description="Kwargs used for generation.")
+
+    _pool: ReplicaPool = PrivateAttr()
+
+    def __init__(self, pool: ReplicaPool, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._pool = pool
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ReplicaLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_new_tokens,
+            model_name=self.model_path,
+        )
+
+    @property
+    def pool(self) -> ReplicaPool:
+        return self._pool
+
+    def build_prefix_snapshot(self, prompts: List[str]) -> Optional[int]:
+        return self._pool.build_prefix_snapshot(prompts, max_tokens=self.context_window - self.max_new_tokens)
+
+    def prefix_stats(self) -> dict:
+        return self._pool.prefix_stats()
+
+    def set_grammar(self, grammar: Optional[str]):
+        """Constrain every completion with a GBNF grammar (None removes it), the text is sent with each request"""
+        if grammar is None:
+            self.generate_kwargs.pop("grammar", None)
+        else:
+            self.generate_kwargs["grammar"] = grammar
+
+    def _payload(self, prompt: str, formatted: bool, stream: bool, kwargs: Dict[str, Any]):
+        if not formatted:
+            prompt = self.completion_to_prompt(prompt)
+        generate_kwargs = {**self.generate_kwargs, "temperature": self.temperature, "max_tokens": self.max_new_tokens}
+        for key in CALL_KWARGS:
+            if kwargs.get(key) is not None:
+                generate_kwargs[key] = kwargs[key]  # This call only
+        return prompt, generate_kwargs, stream
+
+    # ---- Blocking API (waits on the calling thread) ----
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        _, pending = self._pool.submit("complete", self._payload(prompt, formatted, False, kwargs))
+        kind, payload = pending.queue.get()
+        if kind == "error":
+            raise ReplicaError(payload)
+        return CompletionResponse(text=payload["text"])
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        request_id, pending = self._pool.submit("complete", self._payload(prompt, formatted, True, kwargs))
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            try:
+                while True:
+                    kind, payload = pending.queue.get()
+                    if kind == "error":
+                        raise ReplicaError(payload)
+                    if kind == "done":
+                        return
+                    text += payload
+                    yield CompletionResponse(delta=payload, text=text)
+            finally:
+                self._pool.cancel(request_id, pending)
+
+        return gen()
+
+    # ---- Async API (the agent's path, keeps the event loop free while replicas generate) ----
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        request_id, pending = self._pool.submit(
+            "complete", self._payload(prompt, formatted, False, kwargs), loop=asyncio.get_running_loop()
+        )
+        try:
+            kind, payload = await pending.queue.get()
+        finally:
+            self._pool.cancel(request_id, pending)
+        if kind == "error":
+            raise ReplicaError(payload)
+        return CompletionResponse(text=payload["text"])
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False,
+                               **kwargs: Any) -> CompletionResponseAsyncGen:
+        request_id, pending = self._pool.submit(
+            "complete", self._payload(prompt, formatted, True, kwargs), loop=asyncio.get_running_loop()
+        )
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            try:
+                while True:
+                    kind, payload = await pending.queue.get()
+                    if kind == "error":
+                        raise ReplicaError(payload)
+                    if kind == "done":
+                        return
+                    text += payload
+                    yield CompletionResponse(delta=payload, text=text)
+            finally:
+                self._pool.cancel(request_id, pending)
+
+        return gen()
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(
+            self.complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return stream_completion_response_to_chat_response(
+            self.stream_complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(
+            await self.acomplete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return astream_completion_response_to_chat_response(
+            await self.astream_complete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        )
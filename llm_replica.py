@@ -0,0 +1,74 @@
+"""
+LLM Replica - Worker process entry point for the replica pool (llm_pool.py)
+
+Kept free of LlamaIndex/FastAPI imports so each replica process only loads llama_cpp.
+Messages: requests are (request_id, kind, payload) tuples, None stops the worker; responses
+are (replica index, request_id, kind, payload) with kind ready/failed/delta/done/error.
+Abandoned request ids arrive on the cancelled queue; a cancelled request is skipped before
+its prompt is evaluated, or stopped at the next token, and answered with "done".
+"""
+import os
+import queue
+from typing import Any, Dict, List
+
+from kv_snapshot import PrefixSnapshot
+
+
+def replica_main(index: int, model_path: str, model_kwargs: Dict[str, Any], cores: List[int],
+                 requests, responses, cancelled):
+    """Worker process: load the model pinned to `cores`, then serve requests until None"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    from llama_cpp import Llama, LlamaGrammar
+
+    try:
+        # use_mmap (llama.cpp default) maps the GGUF file read-only, replicas share the page cache
+        model = Llama(model_path=model_path, n_threads=len(cores), use_mmap=True, **model_kwargs)
+    except Exception as e:
+        responses.put((index, None, "failed", f"{type(e).__name__}: {e}"))
+        return
+    responses.put((index, None, "ready", None))
+
+    snapshot = PrefixSnapshot()
+    cancelled_ids = set()
+
+    def is_cancelled(request_id: int) -> bool:
+        while True:
+            try:
+                cancelled_ids.add(cancelled.get_nowait())
+            except queue.Empty:
+                return request_id in cancelled_ids
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        request_id, kind, payload = item
+        # Requests are served in id order, lower ids have been answered already
+        cancelled_ids = {cancelled_id for cancelled_id in cancelled_ids if cancelled_id >= request_id}
+        try:
+            if kind == "prefix":
+                prompts, max_tokens = payload
+                prefix_tokens = snapshot.build_from_prompts(model, prompts, max_tokens=max_tokens)
+                responses.put((index, request_id, "done", {"prefix_tokens": prefix_tokens, "prefix": snapshot.stats()}))
+                continue
+            prompt, generate_kwargs, stream = payload
+            if is_cancelled(request_id):
+                # Abandoned while queued, skip the prompt evaluation
+                responses.put((index, request_id, "done", {"text": "", "prefix": snapshot.stats()}))
+                continue
+            if generate_kwargs.get("grammar") is not None:
+                generate_kwargs["grammar"] = LlamaGrammar.from_string(generate_kwargs["grammar"], verbose=False)
+            snapshot.prepare(model, prompt)
+            text = ""
+            # Always stream internally so a cancelled request stops at the next token
+            for chunk in model(prompt=prompt, **{**generate_kwargs, "stream": True}):
+                if is_cancelled(request_id):
+                    break
+                delta = chunk["choices"][0]["text"]
+                text += delta
+                if stream:
+                    responses.put((index, request_id, "delta", delta))
+            responses.put((index, request_id, "done", {"text": text, "prefix": snapshot.stats()}))
+        except Exception as e:
+            responses.put((index, request_id, "error", f"{type(e).__name__}: {e}"))
@@ -0,0 +1,249 @@
+"""
+MCP Logging - Asynchronous, structured logging for the FastMCP server
+
+Log calls on the request path only put the record on a queue; a listener thread formats and
+writes it. By default records are written as JSON lines (protocol payloads are kept raw in a
+`payload` field instead of being parsed and pretty-printed). MCP_LOG_DEBUG=1 restores the
+readable MCPProtocolFormatter output with every protocol message at DEBUG level.
+"""
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+from typing import Optional
+
+# Loggers that emit one record per JSON-RPC message / SSE chunk at DEBUG level
+PROTOCOL_LOGGERS = ['mcp.server.lowlevel.server', 'mcp.server.sse', 'sse_starlette.sse']
+
+# Attributes every LogRecord has, anything else was passed through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+# Create custom formatter for MCP protocol related logs
+class MCPProtocolFormatter(logging.Formatter):
+    """Format MCP protocol logs to make them more readable (Unicode-friendly, JSON formatted, using Python json)"""
+
+    def _format_json(self, json_str):
+        """Format JSON using Python json module"""
+        try:
+            json_obj = json.loads(json_str)
+            return json.dumps(json_obj, indent=2, ensure_ascii=False)
+        except (json.JSONDecodeError, ValueError):
+            return json_str
+
+    def format(self, record):
+        # First get formatted message (handle %s placeholders)
+        try:
+            message = record.getMessage()
+        except TypeError:
+            # If formatting fails, use original message and args directly
+            message = record.msg
+            if record.args:
+                try:
+                    message = message % record.args
+                except:
+                    message = str(record.msg) + ' ' + str(record.args)
+
+        original_message = message
+
+        # Format JSON-RPC messages (handle various possible formats)
+        if any(keyword in message for keyword in ['JSONRPCMessage', 'SessionMessage', 'Sending message', 'Dispatching request', 'Processing request']):
+            try:
+                json_match = re.search(r'\{.*\}', message, re.DOTALL)
+                if json_match:
+                    json_str = json_match.group(0)
+                    formatted_json = self._format_json(json_str)
+                    message = message.replace(json_str, '\n' + formatted_json)
+            except:
+                pass
+
+        # Format SSE chunks (handle binary strings)
+        if 'chunk:' in message:
+            try:
+                # Match chunk: %s format (handle placeholders)
+                # If record.args exists and contains data, process args directly
+                if record.args and len(record.args) > 0:
+                    chunk_data = record.args[0]
+                    if isinstance(chunk_data, bytes):
+                        try:
+                            chunk_str = chunk_data.decode('utf-8', errors='replace')
+                            # Find JSON (may be after data:)
+                            if 'data:' in chunk_str:
+                                data_part = chunk_str.split('data:', 1)[-1].strip()
+                                json_match = re.search(r'\{.*\}', data_part, re.DOTALL)
+                            else:
+                                json_match = re.search(r'\{.*\}', chunk_str, re.DOTALL)
+
+                            if json_match:
+                                json_str = json_match.group(0)
+                                formatted_json = self._format_json(json_str)
+                                message = f"[SSE Chunk - Formatted]\n{formatted_json}"
+                        except:
+                            pass
+                else:
+                    # Try to extract from message string
+                    chunk_patterns = [
+                        r"chunk: b'([^']+)'",
+                        r"chunk: b\"([^\"]+)\"",
+                        r"chunk: ([^\n]+)"
+                    ]
+                    for pattern in chunk_patterns:
+                        chunk_match = re.search(pattern, message)
+                        if chunk_match:
+                            chunk_data = chunk_match.group(1)
+                            try:
+                                decoded = bytes(chunk_data, 'utf-8').decode('unicode_escape').encode('latin1').decode('utf-8')
+                                if 'data:' in decoded:
+                                    data_part = decoded.split('data:', 1)[-1].strip()
+                                    json_match = re.search(r'\{.*\}', data_part, re.DOTALL)
+                                else:
+                                    json_match = re.search(r'\{.*\}', decoded, re.DOTALL)
+
+                                if json_match:
+                                    json_str = json_match.group(0)
+                                    formatted_json = self._format_json(json_str)
+                                    message = f"[SSE Chunk - Formatted]\n{formatted_json}"
+                                    break
+                            except:
+                                pass
+            except:
+                pass
+
+        # If there are Unicode escape sequences, try to decode and display
+        if '\\u' in message or '\\x' in message:
+            try:
+                decoded_message = message.encode('utf-8').decode('unicode_escape')
+                if decoded_message != message:
+                    message = decoded_message
+            except:
+                pass
+
+        # Update record message, clear args (avoid formatting errors)
+        if message != original_message:
+            record.msg = message
+            record.args = ()
+
+        return super().format(record)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """One JSON object per record; raw protocol payloads (bytes args) are kept as a `payload` field"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        args = record.args if isinstance(record.args, tuple) else ()
+        if any(isinstance(arg, (bytes, bytearray)) for arg in args):
+            # e.g. 'chunk: %s' / 'Received JSON: %s': keep the template and the payload undecoded as JSON
+            entry["msg"] = str(record.msg).replace(": %s", "").replace(": %r", "")
+            payloads = [arg.decode("utf-8", errors="replace") if isinstance(arg, (bytes, bytearray)) else str(arg)
+                        for arg in args]
+            entry["payload"] = payloads[0] if len(payloads) == 1 else payloads
+        else:
+            entry["msg"] = record.getMessage()
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ProtocolSampler(logging.Filter):
+    """Keep one in every N DEBUG records of a protocol logger (INFO and above always pass)"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._counter = itertools.count()
+
+    def filter(self, record) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        return self.every > 0 and next(self._counter) % self.every == 0
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that defers all formatting to the listener thread and never blocks"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # The default prepare() formats the message on the calling thread; only copy the record,
+        # args are formatted by the listener (exception tracebacks are rendered now, while alive)
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            AsyncQueueHandler.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging():
+    """Route all logging through a queue to a listener thread (JSON lines or debug text)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    debug = os.getenv("MCP_LOG_DEBUG", "0") == "1"
+    level = os.getenv("MCP_LOG_LEVEL", "INFO").upper()
+    # Fraction of protocol DEBUG records kept: all in debug mode, none by default
+    sample_rate = float(os.getenv("MCP_LOG_PROTOCOL_SAMPLE", "1.0" if debug else "0"))
+
+    output = logging.StreamHandler(sys.stderr)
+    text_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    if debug:
+        output.setFormatter(MCPProtocolFormatter(text_format))
+    else:
+        output.setFormatter(JSONLinesFormatter())
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("MCP_LOG_QUEUE_SIZE", "10000")))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(AsyncQueueHandler(log_queue))
+    root.setLevel(level)
+
+    for logger_name in PROTOCOL_LOGGERS:
+        protocol_log = logging.getLogger(logger_name)
+        for handler in protocol_log.handlers[:]:
+            protocol_log.removeHandler(handler)
+        protocol_log.filters = []
+        if sample_rate > 0:
+            # DEBUG records are only created when sampling is on (isEnabledFor short-circuits otherwise)
+            protocol_log.setLevel(logging.DEBUG)
+            if sample_rate < 1:
+                protocol_log.addFilter(ProtocolSampler(sample_rate))
+        else:
+            protocol_log.setLevel(logging.INFO)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,293 @@
+"""
+MCP Session Pool - Long-lived MCP client sessions with a cached tool catalog
+
+The pool keeps a small number of MCP sessions open for the lifetime of the chat server,
+so tool listing and tool calls no longer pay for a new SSE handshake every time.
+It exposes list_tools() / call_tool(), so it can be passed directly to McpToolSpec.
+Sessions use either the SSE transport or the streamable-HTTP transport (one POST per message).
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+import anyio
+from mcp import ClientSession, types
+from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared.exceptions import McpError
+
+from metrics import MCP_CONNECT_ATTEMPTS, MCP_TOOL_CALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+TRANSPORTS = ("sse", "streamable-http")
+
+
+def _open_transport(url: str, transport: str, timeout: float):
+    """Client transport context manager, yields (read, write, ...) streams"""
+    if transport == "streamable-http":
+        return streamablehttp_client(url, timeout=timeout)
+    return sse_client(url, timeout=timeout)
+
+
+class _PooledSession:
+    """A single MCP session owned by a background task (keeps SSE context in one task)"""
+
+    def __init__(self, url: str, transport: str, timeout: float, on_tools_changed):
+        self.url = url
+        self.transport = transport
+        self.timeout = timeout
+        self.on_tools_changed = on_tools_changed
+        self.session: Optional[ClientSession] = None
+        self.ready = asyncio.Event()
+        self.closing = asyncio.Event()
+        # Set when the connection stopped working (failed ping or transport error), run() reconnects
+        self.broken = asyncio.Event()
+        self.last_error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def _handle_message(self, message):
+        """Watch server notifications, refresh catalog when tool list changes"""
+        if isinstance(message, types.ServerNotification) and \
+                isinstance(message.root, types.ToolListChangedNotification):
+            logger.info("Received notifications/tools/list_changed, tool catalog invalidated")
+            self.on_tools_changed()
+
+    async def run(self, reconnect_delay: float, max_reconnect_delay: float):
+        """Open session and keep it alive until pool is closed, reconnect with exponential backoff"""
+        delay = reconnect_delay
+        while not self.closing.is_set():
+            established = False
+            try:
+                async with _open_transport(self.url, self.transport, self.timeout) as streams:
+                    read, write = streams[0], streams[1]
+                    async with ClientSession(read, write, message_handler=self._handle_message) as session:
+                        await session.initialize()
+                        established = True
+                        MCP_CONNECT_ATTEMPTS.labels(outcome="success").inc()
+                        self.session = session
+                        self.last_error = None
+                        self.ready.set()
+                        logger.info(f"MCP session established: {self.url}")
+                        # A dropped SSE stream does not end the session by itself, wait for close or a failure report
+                        waiters = [asyncio.create_task(self.closing.wait()), asyncio.create_task(self.broken.wait())]
+                        try:
+                            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                        finally:
+                            for waiter in waiters:
+                                waiter.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = _format_error(e)
+                logger.debug(f"MCP session error: {self.last_error}")
+            finally:
+                self.session = None
+                self.ready.clear()
+                self.broken.clear()
+            if established:
+                # Connection dropped after working, retry quickly
+                delay = reconnect_delay
+            else:
+                MCP_CONNECT_ATTEMPTS.labels(outcome="failure").inc()
+            if not self.closing.is_set():
+                logger.info(f"MCP server not reachable, retrying in {delay:.0f}s ({self.last_error})")
+                try:
+                    # Sleep, but wake up immediately when the pool is closed
+                    await asyncio.wait_for(self.closing.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, max_reconnect_delay)
+
+    def mark_broken(self, reason: str):
+        """Drop the session after a transport failure, run() opens a new one"""
+        if self.session is not None:
+            logger.info(f"MCP session to {self.url} failed, reconnecting ({reason})")
+            self.session = None
+            self.ready.clear()
+            self.last_error = reason
+            self.broken.set()
+
+
+class MCPSessionPool:
+    """Pool of persistent MCP sessions with TTL-based tool catalog cache"""
+
+    def __init__(self, url: str, size: int = 1, timeout: float = 10,
+                 catalog_ttl: float = 300, reconnect_delay: float = 1, max_reconnect_delay: float = 30,
+                 transport: str = "sse"):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown MCP transport: {transport} (expected one of {TRANSPORTS})")
+        self.url = url
+        self.transport = transport
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.catalog_ttl = catalog_ttl
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._sessions: List[_PooledSession] = []
+        self._round_robin = itertools.count()
+        self._catalog: Optional[types.ListToolsResult] = None
+        self._catalog_time = 0.0
+        self._catalog_lock = asyncio.Lock()
+        # Incremented each time the catalog content is replaced, consumers can compare versions
+        self.catalog_version = 0
+        # Content hash of the catalog (names, descriptions, schemas), stable across restarts
+        self.catalog_hash = ""
+
+    async def start(self):
+        """Start background session tasks (does not wait for connection)"""
+        if self._sessions:
+            return
+        for _ in range(self.size):
+            pooled = _PooledSession(self.url, self.transport, self.timeout, self.invalidate)
+            pooled.task = asyncio.create_task(pooled.run(self.reconnect_delay, self.max_reconnect_delay))
+            self._sessions.append(pooled)
+
+    async def close(self):
+        """Close all sessions"""
+        for pooled in self._sessions:
+            pooled.closing.set()
+        tasks = [pooled.task for pooled in self._sessions if pooled.task]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._sessions = []
+
+    @property
+    def connected(self) -> bool:
+        return any(pooled.session is not None for pooled in self._sessions)
+
+    @property
+    def last_error(self) -> Optional[str]:
+        for pooled in self._sessions:
+            if pooled.last_error:
+                return pooled.last_error
+        return None
+
+    async def wait_connected(self, timeout: float) -> bool:
+        """Wait until at least one session is connected"""
+        if self.connected:
+            return True
+        waiters = [asyncio.create_task(pooled.ready.wait()) for pooled in self._sessions]
+        if not waiters:
+            return False
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        return bool(done)
+
+    async def _acquire(self, wait: bool = True) -> _PooledSession:
+        """Pick a connected session (round-robin), wait briefly if none is ready (unless wait is False)"""
+        for _ in range(len(self._sessions)):
+            pooled = self._sessions[next(self._round_robin) % len(self._sessions)]
+            if pooled.session is not None:
+                return pooled
+        if wait and await self.wait_connected(self.timeout):
+            return await self._acquire()
+        raise ConnectionError(f"MCP server not reachable: {self.url} ({self.last_error})")
+
+    async def ping(self, timeout: float):
+        """MCP ping over a connected session (no waiting for a reconnect), a failed ping drops the session"""
+        pooled = await self._acquire(wait=False)
+        try:
+            await asyncio.wait_for(pooled.session.send_ping(), timeout)
+        except Exception as e:
+            pooled.mark_broken(f"ping: {_format_error(e)}")
+            raise
+
+    def invalidate(self):
+        """Drop cached tool catalog, next list_tools() will fetch it again"""
+        self._catalog_time = 0.0
+
+    def _catalog_fresh(self) -> bool:
+        return self._catalog is not None and \
+            (time.monotonic() - self._catalog_time) < self.catalog_ttl
+
+    async def list_tools(self) -> types.ListToolsResult:
+        """Return tool catalog, served from cache until TTL expires or server reports a change"""
+        if self._catalog_fresh():
+            return self._catalog
+        async with self._catalog_lock:
+            if self._catalog_fresh():
+                return self._catalog
+            if self._catalog is not None and not self.connected:
+                # Reconnect is in progress, don't block callers on it
+                return self._catalog
+            try:
+                pooled = await self._acquire()
+                result = await pooled.session.list_tools()
+            except Exception as e:
+                if self._catalog is None:
+                    raise
+                # Keep serving the stale catalog rather than failing callers
+                logger.warning(f"Tool catalog refresh failed, using cached catalog: {_format_error(e)}")
+                return self._catalog
+            if self._catalog is None or result.tools != self._catalog.tools:
+                self.catalog_version += 1
+                self.catalog_hash = hashlib.sha256(json.dumps(
+                    [tool.model_dump(mode="json") for tool in result.tools], sort_keys=True
+                ).encode("utf-8")).hexdigest()
+                logger.info(f"Tool catalog refreshed (version {self.catalog_version}): {[t.name for t in result.tools]}")
+            self._catalog = result
+            self._catalog_time = time.monotonic()
+            return result
+
+    async def call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None, wait: bool = True,
+                        timeout: Optional[float] = None) -> types.CallToolResult:
+        """Call a tool over a pooled session (timeout: seconds to wait for the result, None = no limit)"""
+        pooled = await self._acquire(wait)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await pooled.session.call_tool(
+                name, arguments or {},
+                read_timeout_seconds=timedelta(seconds=timeout) if timeout else None,
+            )
+            outcome = "error" if result.isError else "success"
+            return result
+        except McpError:
+            raise  # The server answered (or the read timed out), the connection itself works
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError) as e:
+            # The stream was already gone, the request was not sent
+            pooled.mark_broken(_format_error(e))
+            raise ConnectionError(f"MCP session to {self.url} closed") from e
+        except Exception as e:
+            pooled.mark_broken(_format_error(e))
+            raise
+        finally:
+            MCP_TOOL_CALL_SECONDS.labels(tool=name, outcome=outcome).observe(time.perf_counter() - started)
+
+    async def get_tool_names(self) -> List[str]:
+        """Return cached tool names, empty list if MCP server is unavailable"""
+        if not self.connected:
+            return self.cached_tool_names()
+        try:
+            result = await self.list_tools()
+            return [tool.name for tool in result.tools]
+        except Exception as e:
+            logger.warning(f"Failed to get tool list: {_format_error(e)}")
+            return []
+
+    @property
+    def catalog(self) -> Optional[types.ListToolsResult]:
+        """Last fetched tool catalog (None before the first fetch), without touching the network"""
+        return self._catalog
+
+    def cached_tool_names(self) -> List[str]:
+        """Return tool names from cache without touching the network"""
+        if self._catalog is None:
+            return []
+        return [tool.name for tool in self._catalog.tools]
+
+
+def _format_error(e: BaseException) -> str:
+    """Format exception (including ExceptionGroup) into a readable message"""
+    if hasattr(e, 'exceptions'):
+        return "; ".join(_format_error(exc) for exc in e.exceptions)
+    return f"{type(e).__name__}: {str(e)}"
@@ -0,0 +1,338 @@
+"""
+MCP Router - Several MCP servers behind one client, with health probing and circuit breakers
+
+Each configured server gets its own MCPSessionPool. The router merges their tool catalogs
+(the first server listing a tool defines it) and sends every call to the healthy server that
+offers the tool with the fewest calls in flight, so tool capacity scales past one process.
+
+A background prober pings every server at a fixed interval. Failed probes and failed calls
+(transport errors and timeouts, not tool errors or JSON-RPC error replies) feed a per-server
+circuit breaker:
+
+- closed: calls are routed to the server
+- open: after MCP_BREAKER_FAILURES consecutive failures; the server gets no calls, a call
+  whose tool is only offered by open servers fails at once instead of waiting for a timeout
+- half-open: MCP_BREAKER_RESET seconds later; one trial probe or call is sent while every
+  other call fails fast, its success closes the breaker, its failure opens it again
+
+Health state is only read from memory, so /health never starts a connection attempt.
+The router exposes the same list_tools() / call_tool() interface as MCPSessionPool.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+from mcp import types
+from mcp.shared.exceptions import McpError
+
+from mcp_pool import MCPSessionPool, _format_error
+from metrics import MCP_CIRCUIT_STATE, MCP_CIRCUIT_TRANSITIONS, MCP_ROUTED_CALLS, MCP_TOOL_CALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# McpError codes of calls the server did not answer: read timeout (mcp reports HTTP 408) and closed connection
+_UNANSWERED_CODES = {httpx.codes.REQUEST_TIMEOUT, types.CONNECTION_CLOSED}
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker (state changes are logged and exported per server)"""
+
+    def __init__(self, server: str, failure_threshold: int = 3, reset_timeout: float = 15):
+        self.server = server
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0  # Consecutive
+        self.opened_at = 0.0
+        self.trial_in_flight = False  # Half-open: the one call or probe that decides is running
+        MCP_CIRCUIT_STATE.labels(server=server).set(_STATE_VALUES[CLOSED])
+
+    def _set(self, state: str, reason: str = ""):
+        if state == self.state:
+            return
+        message = f"MCP server {self.server}: circuit {self.state} -> {state}{f' ({reason})' if reason else ''}"
+        if state == HALF_OPEN or self.state == HALF_OPEN and state == OPEN:
+            logger.debug(message)  # Every reset_timeout while the server stays down
+        elif state == OPEN:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        self.state = state
+        MCP_CIRCUIT_STATE.labels(server=self.server).set(_STATE_VALUES[state])
+        MCP_CIRCUIT_TRANSITIONS.labels(server=self.server, state=state).inc()
+
+    def allow(self) -> bool:
+        """Whether calls may be sent (open turns half-open once reset_timeout has passed)"""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set(HALF_OPEN)
+        return self.state == CLOSED or self.state == HALF_OPEN and not self.trial_in_flight
+
+    def acquire(self) -> bool:
+        """Admit one call or probe, half-open admits a single trial until end_trial()"""
+        if not self.allow():
+            return False
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = True
+        return True
+
+    def end_trial(self):
+        self.trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self._set(CLOSED)
+
+    def record_failure(self, reason: str):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set(OPEN, reason)
+
+
+class _Server:
+    def __init__(self, pool: MCPSessionPool, breaker: CircuitBreaker):
+        self.pool = pool
+        self.breaker = breaker
+        self.in_flight = 0
+        self.calls = 0
+        self.last_probe: Optional[float] = None  # Round trip of the last successful ping (seconds)
+
+    @property
+    def available(self) -> bool:
+        return self.pool.connected and self.breaker.allow()
+
+
+class MCPRouter:
+    """MCP servers with merged tool catalog, least-loaded routing and circuit breakers"""
+
+    def __init__(self, pools: Sequence[MCPSessionPool], probe_interval: float = 5, probe_timeout: float = 2,
+                 failure_threshold: int = 3, reset_timeout: float = 15, call_timeout: Optional[float] = 30):
+        if not pools:
+            raise ValueError("At least one MCP server is required")
+        self.servers = [_Server(pool, CircuitBreaker(pool.url, failure_threshold, reset_timeout)) for pool in pools]
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.call_timeout = call_timeout or None
+        self._round_robin = itertools.count()
+        self._prober: Optional[asyncio.Task] = None
+        self._catalog: Optional[types.ListToolsResult] = None
+        # Tool name -> servers offering it, in configuration order
+        self._routes: Dict[str, List[_Server]] = {}
+        # Incremented each time the merged catalog content changes, consumers can compare versions
+        self.catalog_version = 0
+        # Content hash of the merged catalog (names, descriptions, schemas), stable across restarts
+        self.catalog_hash = ""
+        self.rejected = 0
+
+    async def start(self):
+        """Start the session pools and the health prober (does not wait for connections)"""
+        for server in self.servers:
+            await server.pool.start()
+        if self._prober is None:
+            self._prober = asyncio.create_task(self._probe_loop())
+
+    async def close(self):
+        if self._prober is not None:
+            self._prober.cancel()
+            await asyncio.gather(self._prober, return_exceptions=True)
+            self._prober = None
+        await asyncio.gather(*(server.pool.close() for server in self.servers))
+
+    @property
+    def connected(self) -> bool:
+        """At least one server can take calls (no network access)"""
+        return any(server.available for server in self.servers)
+
+    @property
+    def last_error(self) -> Optional[str]:
+        for server in self.servers:
+            if server.pool.last_error:
+                return f"{server.pool.url}: {server.pool.last_error}"
+        return None
+
+    async def wait_connected(self, timeout: float) -> bool:
+        """Wait until at least one server is connected"""
+        if self.connected:
+            return True
+        return await self._wait_any(self.servers, timeout)
+
+    @staticmethod
+    async def _wait_any(servers: Sequence[_Server], timeout: float) -> bool:
+        waiters = [asyncio.create_task(server.pool.wait_connected(timeout)) for server in servers]
+        try:
+            for waiter in asyncio.as_completed(waiters):
+                if await waiter:
+                    return True
+            return False
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*(self._probe(server) for server in self.servers))
+            await asyncio.sleep(self.probe_interval)
+
+    async def _probe(self, server: _Server):
+        """Ping one server and feed the result to its breaker (reconnects are left to the pool)"""
+        if not server.breaker.acquire():
+            return  # Open (wait for the reset timeout before trying again) or a trial call is running
+        trial = server.breaker.state == HALF_OPEN
+        started = time.perf_counter()
+        try:
+            await server.pool.ping(self.probe_timeout)
+        except Exception as e:
+            server.last_probe = None
+            server.breaker.record_failure(f"probe: {_format_error(e)}")
+            return
+        finally:
+            if trial:
+                server.breaker.end_trial()
+        server.last_probe = time.perf_counter() - started
+        server.breaker.record_success()
+
+    def invalidate(self):
+        """Drop cached tool catalogs, next list_tools() fetches them again"""
+        for server in self.servers:
+            server.pool.invalidate()
+
+    async def _server_catalog(self, server: _Server) -> Optional[types.ListToolsResult]:
+        """Catalog of one server: refreshed when it is available, otherwise the last one it sent"""
+        if not server.available:
+            return server.pool.catalog
+        try:
+            return await server.pool.list_tools()
+        except Exception as e:
+            logger.warning(f"Tool catalog of {server.pool.url} not available: {_format_error(e)}")
+            return server.pool.catalog
+
+    async def list_tools(self) -> types.ListToolsResult:
+        """Merged tool catalog of all servers (each served from its pool's cache until TTL or a change)"""
+        catalogs = await asyncio.gather(*(self._server_catalog(server) for server in self.servers))
+        if all(catalog is None for catalog in catalogs):
+            raise ConnectionError(f"No MCP server reachable ({self.last_error})")
+        tools: Dict[str, types.Tool] = {}
+        routes: Dict[str, List[_Server]] = {}
+        for server, catalog in zip(self.servers, catalogs):
+            for tool in catalog.tools if catalog is not None else []:
+                if tool.name not in tools:
+                    tools[tool.name] = tool
+                elif tool != tools[tool.name]:
+                    logger.warning(f"Tool {tool.name} on {server.pool.url} differs from the first server's "
+                                   f"definition, using the first one")
+                routes.setdefault(tool.name, []).append(server)
+        self._routes = routes
+        if self._catalog is None or list(tools.values()) != self._catalog.tools:
+            self.catalog_version += 1
+            self.catalog_hash = hashlib.sha256(json.dumps(
+                [tool.model_dump(mode="json") for tool in tools.values()], sort_keys=True
+            ).encode("utf-8")).hexdigest()
+            logger.info(f"Merged tool catalog updated (version {self.catalog_version}): "
+                        + ", ".join(f"{name} x{len(servers)}" for name, servers in routes.items()))
+        self._catalog = types.ListToolsResult(tools=list(tools.values()))
+        return self._catalog
+
+    def _candidates(self, name: str) -> List[_Server]:
+        """Servers that may take a call of this tool, connected ones least loaded first"""
+        # Before the first catalog fetch every server is assumed to offer every tool
+        offering = self._routes.get(name, self.servers if self._catalog is None else [])
+        allowed = [server for server in offering if server.breaker.allow()]
+        # Rotate first, so servers with equal load take turns (sort is stable)
+        if allowed:
+            shift = next(self._round_robin) % len(allowed)
+            allowed = allowed[shift:] + allowed[:shift]
+        return sorted(allowed, key=lambda server: (not server.pool.connected, server.in_flight))
+
+    async def call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None) -> types.CallToolResult:
+        """Call a tool on the least loaded healthy server offering it, fail fast if there is none"""
+        candidates = self._candidates(name)
+        if not candidates:
+            self._reject(name)
+        if not any(server.pool.connected for server in candidates):
+            # Breakers still closed, e.g. a reconnect in progress: wait for it, at most one probe interval
+            await self._wait_any(candidates, self.probe_interval)
+            candidates.sort(key=lambda server: not server.pool.connected)
+        not_sent: Optional[ConnectionError] = None
+        for server in candidates:
+            if not server.breaker.acquire():
+                continue  # Half-open and another call took the trial meanwhile
+            trial = server.breaker.state == HALF_OPEN
+            server.in_flight += 1
+            server.calls += 1
+            MCP_ROUTED_CALLS.labels(server=server.pool.url).inc()
+            try:
+                result = await server.pool.call_tool(name, arguments, wait=False, timeout=self.call_timeout)
+            except ConnectionError as e:
+                # Nothing was sent, try the next server
+                server.breaker.record_failure(f"call: {_format_error(e)}")
+                not_sent = e
+                continue
+            except McpError as e:
+                # The call may have run, so it is not repeated elsewhere. A JSON-RPC error reply
+                # is still an answer, only a read timeout or a closed connection is a failure
+                if e.error.code in _UNANSWERED_CODES:
+                    server.breaker.record_failure(f"call {name}: {_format_error(e)}")
+                else:
+                    server.breaker.record_success()
+                raise
+            except Exception as e:
+                server.breaker.record_failure(f"call {name}: {_format_error(e)}")
+                raise
+            finally:
+                server.in_flight -= 1
+                if trial:
+                    server.breaker.end_trial()
+            # A tool error is still an answer, the server is healthy
+            server.breaker.record_success()
+            return result
+        if not_sent is not None:
+            raise not_sent
+        self._reject(name)
+
+    def _reject(self, name: str):
+        """Fail a call at once, no server can take it"""
+        self.rejected += 1
+        MCP_ROUTED_CALLS.labels(server="rejected").inc()
+        MCP_TOOL_CALL_SECONDS.labels(tool=name, outcome="unavailable").observe(0)
+        raise ConnectionError(f"No healthy MCP server offers tool {name} ({self.last_error})")
+
+    async def get_tool_names(self) -> List[str]:
+        """Return tool names, empty list if no MCP server is available"""
+        if not self.connected:
+            return self.cached_tool_names()
+        try:
+            result = await self.list_tools()
+            return [tool.name for tool in result.tools]
+        except Exception as e:
+            logger.warning(f"Failed to get tool list: {_format_error(e)}")
+            return []
+
+    def cached_tool_names(self) -> List[str]:
+        """Return tool names from the merged catalog without touching the network"""
+        if self._catalog is None:
+            return []
+        return [tool.name for tool in self._catalog.tools]
+
+    def health(self) -> List[dict]:
+        """Per-server state from the prober and breakers (no network access)"""
+        return [
+            {
+                "url": server.pool.url,
+                "connected": server.pool.connected,
+                "circuit": server.breaker.state,
+                "consecutive_failures": server.breaker.failures,
+                "last_probe_ms": round(server.last_probe * 1000, 1) if server.last_probe is not None else None,
+                "in_flight": server.in_flight,
+                "calls": server.calls,
+                "tools": [name for name, servers in self._routes.items() if server in servers],
+                "last_error": server.pool.last_error,
+            }
+            for server in self.servers
+        ]
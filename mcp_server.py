@@ -4,150 +4,91 @@ FastMCP automatically exposes tool lists through SSE endpoints, no manual implem
 """
 import json
 import logging
-import re
+import os
+from typing import Dict, List
+
+import numpy as np
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from expression_engine import (
+    ERROR_MESSAGES,
+    MAGNITUDE_LIMIT,
+    ExpressionError,
+    evaluate_batch,
+    evaluate_expression,
+    normalise_expression,
+)
+from mcp_logging import configure_logging
+from metrics import MCP_REGISTRY, render, timed_tool
+from tool_cache import ToolCache
+from tool_executor import ToolExecutor, parse_tool_settings
 
 try:
     from mcp.server.fastmcp import FastMCP
 except ImportError:
     from fastmcp import FastMCP
 
-# Configure logging - keep original level, but add formatter for clearer output
-logging.basicConfig(
-    level=logging.INFO,  # Base log level set to INFO
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging - records are queued and written by a listener thread (JSON lines by default,
+# MCP_LOG_DEBUG=1 for readable MCP protocol logs, MCP_LOG_PROTOCOL_SAMPLE to sample protocol messages)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Create custom formatter for MCP protocol related logs
-class MCPProtocolFormatter(logging.Formatter):
-    """Format MCP protocol logs to make them more readable (Unicode-friendly, JSON formatted, using Python json)"""
-    
-    def _format_json(self, json_str):
-        """Format JSON using Python json module"""
-        try:
-            json_obj = json.loads(json_str)
-            return json.dumps(json_obj, indent=2, ensure_ascii=False)
-        except (json.JSONDecodeError, ValueError):
-            return json_str
-    
-    def format(self, record):
-        # First get formatted message (handle %s placeholders)
-        try:
-            message = record.getMessage()
-        except TypeError:
-            # If formatting fails, use original message and args directly
-            message = record.msg
-            if record.args:
-                try:
-                    message = message % record.args
-                except:
-                    message = str(record.msg) + ' ' + str(record.args)
-        
-        original_message = message
-        
-        # Format JSON-RPC messages (handle various possible formats)
-        if any(keyword in message for keyword in ['JSONRPCMessage', 'SessionMessage', 'Sending message', 'Dispatching request', 'Processing request']):
-            try:
-                json_match = re.search(r'\{.*\}', message, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(0)
-                    formatted_json = self._format_json(json_str)
-                    message = message.replace(json_str, '\n' + formatted_json)
-            except:
-                pass
-        
-        # Format SSE chunks (handle binary strings)
-        if 'chunk:' in message:
-            try:
-                # Match chunk: %s format (handle placeholders)
-                # If record.args exists and contains data, process args directly
-                if record.args and len(record.args) > 0:
-                    chunk_data = record.args[0]
-                    if isinstance(chunk_data, bytes):
-                        try:
-                            chunk_str = chunk_data.decode('utf-8', errors='replace')
-                            # Find JSON (may be after data:)
-                            if 'data:' in chunk_str:
-                                data_part = chunk_str.split('data:', 1)[-1].strip()
-                                json_match = re.search(r'\{.*\}', data_part, re.DOTALL)
-                            else:
-                                json_match = re.search(r'\{.*\}', chunk_str, re.DOTALL)
-                            
-                            if json_match:
-                                json_str = json_match.group(0)
-                                formatted_json = self._format_json(json_str)
-                                message = f"[SSE Chunk - Formatted]\n{formatted_json}"
-                        except:
-                            pass
-                else:
-                    # Try to extract from message string
-                    chunk_patterns = [
-                        r"chunk: b'([^']+)'",
-                        r"chunk: b\"([^\"]+)\"",
-                        r"chunk: ([^\n]+)"
-                    ]
-                    for pattern in chunk_patterns:
-                        chunk_match = re.search(pattern, message)
-                        if chunk_match:
-                            chunk_data = chunk_match.group(1)
-                            try:
-                                decoded = bytes(chunk_data, 'utf-8').decode('unicode_escape').encode('latin1').decode('utf-8')
-                                if 'data:' in decoded:
-                                    data_part = decoded.split('data:', 1)[-1].strip()
-                                    json_match = re.search(r'\{.*\}', data_part, re.DOTALL)
-                                else:
-                                    json_match = re.search(r'\{.*\}', decoded, re.DOTALL)
-                                
-                                if json_match:
-                                    json_str = json_match.group(0)
-                                    formatted_json = self._format_json(json_str)
-                                    message = f"[SSE Chunk - Formatted]\n{formatted_json}"
-                                    break
-                            except:
-                                pass
-            except:
-                pass
-        
-        # If there are Unicode escape sequences, try to decode and display
-        if '\\u' in message or '\\x' in message:
-            try:
-                decoded_message = message.encode('utf-8').decode('unicode_escape')
-                if decoded_message != message:
-                    message = decoded_message
-            except:
-                pass
-        
-        # Update record message, clear args (avoid formatting errors)
-        if message != original_message:
-            record.msg = message
-            record.args = ()
-        
-        return super().format(record)
-
-# Set formatter and DEBUG level for MCP related logs (to view detailed information)
-mcp_formatter = MCPProtocolFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-for logger_name in ['mcp.server.lowlevel.server', 'mcp.server.sse', 'sse_starlette.sse']:
-    mcp_log = logging.getLogger(logger_name)
-    # Set to DEBUG level to view detailed information
-    mcp_log.setLevel(logging.DEBUG)
-    # Add formatter
-    for handler in mcp_log.handlers[:]:
-        handler.setFormatter(mcp_formatter)
-    # If no handler, add one
-    if not mcp_log.handlers:
-        handler = logging.StreamHandler()
-        handler.setFormatter(mcp_formatter)
-        mcp_log.addHandler(handler)
+# Transport: "sse" (one long-lived stream per client, single process) or "streamable-http"
+# (plain HTTP POST per message on /mcp; stateless by default so it can run under several workers)
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "sse")
+MCP_STATELESS_HTTP = os.getenv("MCP_STATELESS_HTTP", "1") == "1"
+MCP_JSON_RESPONSE = os.getenv("MCP_JSON_RESPONSE", "1") == "1"
+MCP_WORKERS = max(1, int(os.getenv("MCP_WORKERS", "1")))
+# Listening port (run several servers on one host and list them in the chat server's MCP_SERVER_URLS)
+MCP_PORT = int(os.getenv("MCP_PORT", "8100"))
 
 # Create FastMCP server instance (specify host and port in constructor)
 # host='0.0.0.0' allows access from outside container (inter-container communication)
-mcp = FastMCP("MathTools", host="0.0.0.0", port=8100)
+mcp = FastMCP(
+    "MathTools",
+    host="0.0.0.0",
+    port=MCP_PORT,
+    stateless_http=MCP_STATELESS_HTTP,
+    json_response=MCP_JSON_RESPONSE,
+)
+
+# Results of pure tools (marked with @tool_cache.cacheable) keyed on their canonical arguments,
+# per process; MCP_TOOL_CACHE_SIZE=0 disables the cache
+tool_cache = ToolCache(max_entries=int(os.getenv("MCP_TOOL_CACHE_SIZE", "4096")))
+# Register the tool_cache_admin tool (stats / clear); it is part of the tool list every client sees
+MCP_TOOL_CACHE_ADMIN = os.getenv("MCP_TOOL_CACHE_ADMIN", "1") == "1"
+# Where tool functions run: "inline" (on the event loop), "thread" (thread pool) or "process"
+# (worker processes, killed and replaced on timeout/cancellation); timeouts in seconds, 0 = none;
+# per-tool settings as "tool=value,tool=value"
+tool_executor = ToolExecutor(
+    mode=os.getenv("MCP_TOOL_EXECUTOR", "thread"),
+    workers=int(os.getenv("MCP_TOOL_WORKERS", "0")) or None,  # Default: CPU count
+    timeout=float(os.getenv("MCP_TOOL_TIMEOUT", "10")),
+    timeouts=parse_tool_settings(os.getenv("MCP_TOOL_TIMEOUTS", ""), float),
+    limits=parse_tool_settings(os.getenv("MCP_TOOL_CONCURRENCY", ""), int),
+)
 
-# Not using middleware approach, use log formatter to format existing log output
+# Not using middleware approach, protocol messages are logged by the MCP library loggers (see mcp_logging.py)
 
-# Register tools - implementation directly here, FastMCP automatically extracts tool info from function signatures and docstrings
+@mcp.custom_route("/metrics", methods=["GET"])
+async def prometheus_metrics(request: Request) -> Response:
+    """Prometheus metrics (tool execution time per tool and outcome)"""
+    body, content_type = render(MCP_REGISTRY)
+    return Response(content=body, media_type=content_type)
+
+@mcp.custom_route("/stats", methods=["GET"])
+async def stats(request: Request) -> Response:
+    """Runtime statistics of this process (tool executor and tool cache)"""
+    return JSONResponse({"executor": tool_executor.stats(), "tool_cache": tool_cache.stats()})
+
+# Register tools - implementation directly here (timed_tool records execution time per tool, cache hits included,
+# tool_executor runs them off the event loop), FastMCP automatically extracts tool info from function signatures and docstrings
 # Note: Tool descriptions need to clearly specify when to use, avoid calling in non-math scenarios
 @mcp.tool()
+@timed_tool
+@tool_cache.cacheable
+@tool_executor.offload
 def add_numbers(a: float, b: float) -> float:
     """
     Calculate the sum of two numbers.
@@ -161,12 +102,14 @@ def add_numbers(a: float, b: float) -> float:
     Returns:
         Sum of the two numbers
     """
-    logger.info(f"[FastMCP Tool] add_numbers(a={a}, b={b})")
     result = a + b
-    logger.info(f"[FastMCP Tool] add_numbers result: {result}")
+    logger.info("[FastMCP Tool] add_numbers(a=%s, b=%s) = %s", a, b, result, extra={"tool": "add_numbers"})
     return result
 
 @mcp.tool()
+@timed_tool
+@tool_cache.cacheable
+@tool_executor.offload
 def multiply_numbers(a: float, b: float) -> float:
     """
     Calculate the product of two numbers.
@@ -180,12 +123,14 @@ def multiply_numbers(a: float, b: float) -> float:
     Returns:
         Product of the two numbers
     """
-    logger.info(f"[FastMCP Tool] multiply_numbers(a={a}, b={b})")
     result = a * b
-    logger.info(f"[FastMCP Tool] multiply_numbers result: {result}")
+    logger.info("[FastMCP Tool] multiply_numbers(a=%s, b=%s) = %s", a, b, result, extra={"tool": "multiply_numbers"})
     return result
 
 @mcp.tool()
+@timed_tool
+@tool_cache.cacheable(canonical={"expression": normalise_expression})
+@tool_executor.offload
 def calculate_expression(expression: str) -> float:
     """
     Calculate a mathematical expression. The expression must only contain numbers and basic operators (+, -, *, /, parentheses).
@@ -198,29 +143,164 @@ def calculate_expression(expression: str) -> float:
     Returns:
         Floating point result of the calculation
     """
-    logger.info(f"[FastMCP Tool] calculate_expression(expression='{expression}')")
     try:
-        # Simple safe calculation, only allow numbers and basic operators
-        allowed_chars = set('0123456789+-*/.() ')
-        if not all(c in allowed_chars for c in expression):
-            raise ValueError("Expression contains invalid characters")
-        
-        result = eval(expression)
-        result_float = float(result)
-        logger.info(f"[FastMCP Tool] calculate_expression result: {result_float}")
+        # Restricted AST evaluation (compiled expressions are cached, cost limits enforced)
+        result_float = evaluate_expression(expression)
+        logger.info("[FastMCP Tool] calculate_expression(expression=%r) = %s", expression, result_float,
+                    extra={"tool": "calculate_expression"})
         return result_float
     except Exception as e:
-        logger.error(f"[FastMCP Tool] calculate_expression failed: {str(e)}")
+        logger.error("[FastMCP Tool] calculate_expression(expression=%r) failed: %s", expression, e,
+                     extra={"tool": "calculate_expression"})
+        raise ValueError(f"Calculation error: {str(e)}")
+
+# Batch tools: one JSON-RPC round trip for many operations, evaluated with NumPy kernels
+# Maximum number of items per batch call (documented in tool descriptions)
+MAX_BATCH_SIZE = int(os.getenv("MCP_MAX_BATCH_SIZE", "10000"))
+
+def _batch_operands(a: List[float], b: List[float]):
+    """Validate batch operands, a single-element list is broadcast to the other side's length"""
+    if not a or not b:
+        raise ValueError(f"Batch operands must not be empty: len(a)={len(a)}, len(b)={len(b)}")
+    size = max(len(a), len(b))
+    if size > MAX_BATCH_SIZE:
+        raise ValueError(f"Batch size {size} exceeds maximum of {MAX_BATCH_SIZE}")
+    if len(a) != len(b) and 1 not in (len(a), len(b)):
+        raise ValueError(f"Batch length mismatch: len(a)={len(a)}, len(b)={len(b)}")
+    return np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64), size
+
+def _batch_result(values: np.ndarray, errors: np.ndarray) -> str:
+    """Compact JSON batch response: results (null for failed items) plus per-item errors"""
+    results = values.tolist()
+    failed = np.flatnonzero(errors).tolist()
+    for index in failed:
+        results[index] = None
+    # Serialised without indentation: pretty-printed output would multiply payload size
+    return json.dumps({
+        "count": len(results),
+        "results": results,
+        "errors": [{"index": index, "error": ERROR_MESSAGES[int(errors[index])]} for index in failed],
+    }, separators=(",", ":"))
+
+def _elementwise_batch(ufunc, a: List[float], b: List[float]) -> str:
+    left, right, size = _batch_operands(a, b)
+    with np.errstate(all="ignore"):
+        values = np.broadcast_to(ufunc(left, right), (size,))
+    errors = np.zeros(size, dtype=np.int8)
+    # Non-finite results (overflow) are reported per item, NaN/Infinity are not valid JSON
+    errors[~np.isfinite(values)] = MAGNITUDE_LIMIT
+    return _batch_result(values, errors)
+
+@mcp.tool()
+@timed_tool
+@tool_executor.offload
+def add_numbers_batch(a: List[float], b: List[float]) -> str:
+    """
+    Calculate element-wise sums of two lists of numbers in one call (a[i] + b[i]).
+    
+    Important: Use this tool only for bulk addition of many number pairs. Maximum batch size is 10000 items (MCP_MAX_BATCH_SIZE). If one list has a single element it is applied to every element of the other list.
+    
+    Args:
+        a: First numbers
+        b: Second numbers (same length as a, or a single number)
+    
+    Returns:
+        Compact JSON: {"count": n, "results": [sum or null], "errors": [{"index": i, "error": message}]}
+    """
+    logger.info("[FastMCP Tool] add_numbers_batch(size=%d)", max(len(a), len(b)), extra={"tool": "add_numbers_batch"})
+    return _elementwise_batch(np.add, a, b)
+
+@mcp.tool()
+@timed_tool
+@tool_executor.offload
+def multiply_numbers_batch(a: List[float], b: List[float]) -> str:
+    """
+    Calculate element-wise products of two lists of numbers in one call (a[i] * b[i]).
+    
+    Important: Use this tool only for bulk multiplication of many number pairs. Maximum batch size is 10000 items (MCP_MAX_BATCH_SIZE). If one list has a single element it is applied to every element of the other list.
+    
+    Args:
+        a: First numbers
+        b: Second numbers (same length as a, or a single number)
+    
+    Returns:
+        Compact JSON: {"count": n, "results": [product or null], "errors": [{"index": i, "error": message}]}
+    """
+    logger.info("[FastMCP Tool] multiply_numbers_batch(size=%d)", max(len(a), len(b)), extra={"tool": "multiply_numbers_batch"})
+    return _elementwise_batch(np.multiply, a, b)
+
+@mcp.tool()
+@timed_tool
+@tool_executor.offload
+def evaluate_expression_batch(expression: str, variables: List[Dict[str, float]]) -> str:
+    """
+    Evaluate one mathematical expression with variables over many variable bindings in one call.
+    
+    Important: Use this tool only for bulk evaluation, e.g. expression 'x*y+2' with variables [{"x": 1, "y": 2}, {"x": 3, "y": 4}]. The expression may contain numbers, variable names, operators (+, -, *, /, //, **) and parentheses. Maximum batch size is 10000 bindings (MCP_MAX_BATCH_SIZE).
+    
+    Args:
+        expression: Mathematical expression string with variable names, e.g. 'x*y+2'
+        variables: List of variable bindings, one result is produced per binding
+    
+    Returns:
+        Compact JSON: {"count": n, "results": [value or null], "errors": [{"index": i, "error": message}]}
+        Division by zero and exceeded limits are reported per binding, also in constant parts of the
+        expression (e.g. 'x + 1/0'); only an invalid expression rejects the whole call.
+    """
+    logger.info("[FastMCP Tool] evaluate_expression_batch(expression=%r, size=%d)", expression, len(variables),
+                extra={"tool": "evaluate_expression_batch"})
+    if len(variables) > MAX_BATCH_SIZE:
+        raise ValueError(f"Batch size {len(variables)} exceeds maximum of {MAX_BATCH_SIZE}")
+    try:
+        values, errors = evaluate_batch(expression, variables)
+    except ExpressionError as e:
+        # Invalid expression fails the whole batch, evaluation errors are reported per item
         raise ValueError(f"Calculation error: {str(e)}")
+    return _batch_result(values, errors)
+
+def tool_cache_admin(action: str = "stats") -> str:
+    """
+    Inspect or clear the MCP server's tool result cache. Administrative tool, not for calculations.
+    
+    Args:
+        action: "stats" (entries, hits and misses per tool) or "clear" (drop all cached results)
+    
+    Returns:
+        Compact JSON with the cache statistics (after clearing for "clear")
+    """
+    if action == "clear":
+        tool_cache.clear()
+    elif action != "stats":
+        raise ValueError(f"Unknown action: {action} (expected stats or clear)")
+    return json.dumps(tool_cache.stats(), separators=(",", ":"))
+
+if MCP_TOOL_CACHE_ADMIN:
+    mcp.tool()(tool_cache_admin)
+
+# ASGI app for the streamable-HTTP transport, imported by each uvicorn worker ("mcp_server:app")
+app = mcp.streamable_http_app() if MCP_TRANSPORT == "streamable-http" else None
 
 if __name__ == "__main__":
     # FastMCP automatically exposes tool lists and call interfaces through SSE endpoints
     # No need to manually implement /tools endpoint, tool list is automatically extracted from @mcp.tool() decorated functions
-    logger.info("Starting FastMCP server, listening on: 0.0.0.0:8100")
-    logger.info("SSE endpoint: http://0.0.0.0:8100/sse")
-    logger.info("Tool list and call interfaces are automatically exposed through SSE endpoint")
-    logger.info("MCP protocol logging enabled, log output formatted for readability (JSON formatted, Unicode-friendly)")
-    
-    # Start FastMCP server (automatically provides SSE endpoint)
-    # Note: MCP protocol logs are automatically formatted through custom formatter, original log level unchanged
-    mcp.run(transport="sse")
+    logger.info(f"Starting FastMCP server, listening on: 0.0.0.0:{MCP_PORT}")
+    
+    if MCP_TRANSPORT == "streamable-http":
+        if MCP_WORKERS > 1 and not MCP_STATELESS_HTTP:
+            # Sessions live in one process, a follow-up request could reach another worker
+            logger.warning("MCP_STATELESS_HTTP=0 requires a single worker, MCP_WORKERS ignored")
+            MCP_WORKERS = 1
+        logger.info(f"Streamable HTTP endpoint: http://0.0.0.0:{MCP_PORT}/mcp (stateless={MCP_STATELESS_HTTP}, workers={MCP_WORKERS})")
+        import uvicorn
+        # log_config=None keeps the queue-based logging configured by mcp_logging
+        uvicorn.run("mcp_server:app", host="0.0.0.0", port=MCP_PORT, workers=MCP_WORKERS, log_config=None)
+    elif MCP_TRANSPORT == "sse":
+        if MCP_WORKERS > 1:
+            logger.warning("SSE transport keeps sessions in one process, MCP_WORKERS ignored")
+        logger.info(f"SSE endpoint: http://0.0.0.0:{MCP_PORT}/sse")
+        logger.info("Tool list and call interfaces are automatically exposed through SSE endpoint")
+        # Start FastMCP server (automatically provides SSE endpoint)
+        # Note: log output is written by the mcp_logging listener thread, not on the request path
+        mcp.run(transport="sse")
+    else:
+        raise ValueError(f"Unknown MCP_TRANSPORT: {MCP_TRANSPORT} (expected sse or streamable-http)")
@@ -0,0 +1,180 @@
+"""
+Metrics - Prometheus metrics for the chat server and the MCP server
+
+Each server exposes its own registry on GET /metrics. Latencies are histograms, so p50/p95/p99
+per stage can be computed in Prometheus (histogram_quantile) instead of only averages.
+"""
+import asyncio
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    PlatformCollector,
+    ProcessCollector,
+    generate_latest,
+)
+
+# Shared buckets (seconds): sub-millisecond tool calls up to multi-minute agent runs
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# ---- Chat server ----
+
+CHAT_REGISTRY = CollectorRegistry()
+ProcessCollector(registry=CHAT_REGISTRY)
+PlatformCollector(registry=CHAT_REGISTRY)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "chat_http_request_seconds", "HTTP request latency until the response starts",
+    ["path", "method", "status"], buckets=LATENCY_BUCKETS, registry=CHAT_REGISTRY,
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_seconds", "Time spent in each stage of the chat pipeline",
+    ["stage"], buckets=LATENCY_BUCKETS, registry=CHAT_REGISTRY,
+)
+CHAT_OUTCOMES = Counter(
+    "chat_requests_total", "Chat requests by endpoint and how they were answered",
+    ["endpoint", "outcome"], registry=CHAT_REGISTRY,
+)
+STARTUP_STAGE_SECONDS = Gauge(
+    "chat_startup_stage_seconds", "Duration of the last run of each startup stage",
+    ["stage"], registry=CHAT_REGISTRY,
+)
+MCP_CONNECT_ATTEMPTS = Counter(
+    "chat_mcp_connect_attempts_total", "MCP session connection attempts (startup and reconnects)",
+    ["outcome"], registry=CHAT_REGISTRY,
+)
+MCP_TOOL_CALL_SECONDS = Histogram(
+    "chat_mcp_tool_call_seconds", "MCP tools/call round trip seen by the chat server",
+    ["tool", "outcome"], buckets=LATENCY_BUCKETS, registry=CHAT_REGISTRY,
+)
+MCP_CIRCUIT_STATE = Gauge(
+    "chat_mcp_circuit_state", "Circuit breaker state per MCP server: 0 closed, 1 half-open, 2 open",
+    ["server"], registry=CHAT_REGISTRY,
+)
+MCP_CIRCUIT_TRANSITIONS = Counter(
+    "chat_mcp_circuit_transitions_total", "Circuit breaker state changes per MCP server",
+    ["server", "state"], registry=CHAT_REGISTRY,
+)
+MCP_ROUTED_CALLS = Counter(
+    "chat_mcp_routed_calls_total", "Tool calls sent to each MCP server, rejected when no healthy server offers the tool",
+    ["server"], registry=CHAT_REGISTRY,
+)
+AGENT_ITERATIONS = Histogram(
+    "chat_agent_iterations", "ReAct iterations (LLM calls) per agent run",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10), registry=CHAT_REGISTRY,
+)
+AGENT_TOOL_CALLS = Histogram(
+    "chat_agent_tool_calls", "Tool calls per agent run",
+    buckets=(0, 1, 2, 3, 4, 5, 8), registry=CHAT_REGISTRY,
+)
+AGENT_GENERATED_TOKENS = Histogram(
+    "chat_agent_generated_tokens", "Tokens generated over all LLM calls of an agent run",
+    buckets=(8, 16, 32, 64, 128, 256, 384, 512, 768, 1024), registry=CHAT_REGISTRY,
+)
+AGENT_PARSE_FAILURES = Counter(
+    "chat_agent_parse_failures_total", "ReAct steps whose output could not be parsed (the agent retries them)",
+    registry=CHAT_REGISTRY,
+)
+AGENT_STEP_ENDINGS = Counter(
+    "chat_agent_step_endings_total", "Budgeted ReAct steps by kind (action, answer, retry) and how generation ended: "
+    "line_complete (closed early or ended after the answer), max_tokens (budget used up) "
+    "or model (end of turn or stop sequence)",
+    ["step", "reason"], registry=CHAT_REGISTRY,
+)
+AGENT_PLANS = Counter(
+    "chat_agent_plans_total", "Plan agent runs (AGENT_MODE=plan) by outcome: executed, invalid or tool_error (ReAct fallback)",
+    ["outcome"], registry=CHAT_REGISTRY,
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds", "Time from LLM call to first streamed token (prompt evaluation)",
+    buckets=LATENCY_BUCKETS, registry=CHAT_REGISTRY,
+)
+LLM_GENERATION_SECONDS = Histogram(
+    "llm_generation_seconds", "Duration of one LLM call",
+    buckets=LATENCY_BUCKETS, registry=CHAT_REGISTRY,
+)
+LLM_TOKENS_GENERATED = Histogram(
+    "llm_generated_tokens", "Tokens generated per LLM call",
+    buckets=(1, 8, 16, 32, 64, 128, 192, 256, 512, 1024), registry=CHAT_REGISTRY,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second", "Generation speed per LLM call (after the first token)",
+    buckets=(1, 2, 4, 6, 8, 10, 15, 20, 30, 50, 100, 200), registry=CHAT_REGISTRY,
+)
+
+# ---- MCP server ----
+
+MCP_REGISTRY = CollectorRegistry()
+ProcessCollector(registry=MCP_REGISTRY)
+PlatformCollector(registry=MCP_REGISTRY)
+
+TOOL_SECONDS = Histogram(
+    "mcp_tool_seconds", "Tool execution time on the MCP server",
+    ["tool", "outcome"], buckets=LATENCY_BUCKETS, registry=MCP_REGISTRY,
+)
+TOOL_CACHE_REQUESTS = Counter(
+    "mcp_tool_cache_requests_total", "Calls of cacheable tools answered from the tool cache (hit) or executed (miss)",
+    ["tool", "result"], registry=MCP_REGISTRY,
+)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """Observe the duration of the with-block"""
+    metric = histogram.labels(**labels) if labels else histogram
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - started)
+
+
+def timed_tool(fn):
+    """Record execution time and outcome of an MCP tool function (signature is preserved for FastMCP)"""
+    name = fn.__name__
+
+    if inspect.iscoroutinefunction(fn):
+        # Offloaded tools (tool_executor.py): the time includes waiting for a worker
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "success"
+                return result
+            except TimeoutError:
+                outcome = "timeout"
+                raise
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                TOOL_SECONDS.labels(tool=name, outcome=outcome).observe(time.perf_counter() - started)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = fn(*args, **kwargs)
+            outcome = "success"
+            return result
+        finally:
+            TOOL_SECONDS.labels(tool=name, outcome=outcome).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+def render(registry: CollectorRegistry):
+    """Prometheus text exposition of a registry: (body, content type)"""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,296 @@
+"""
+Plan Agent - Single-pass plan-and-execute alternative to the ReAct loop
+
+The model is asked once for a JSON plan: the MCP tool calls needed to answer and a reply
+template, e.g.
+
+    {"calls": [{"tool": "add_numbers", "args": {"a": 2, "b": 3}},
+               {"tool": "multiply_numbers", "args": {"a": "$0", "b": 4}}],
+     "answer": "The answer is {1}"}
+
+An argument "$N" is the result of call N, "{N}" in the answer is replaced with it. Calls
+whose inputs are known run concurrently, and the reply is rendered from the template, so
+there is no second LLM pass to phrase the answer. Generation is constrained by a GBNF
+grammar built from the tool schemas; a plan that still fails validation (unknown result
+references, arguments the tool schema rejects, a template that uses no result) or whose
+tool call fails is handed back to the caller, which falls back to the ReActAgent.
+"""
+import asyncio
+import copy
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_cpp.llama_grammar import SchemaConverter
+from llama_index.core.agent.workflow import AgentOutput, AgentStream, ToolCall, ToolCallResult
+from llama_index.core.llms import ChatMessage
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.tools import BaseTool, ToolOutput
+from pydantic import ValidationError
+
+from intent_router import CallTool, result_text
+
+logger = logging.getLogger(__name__)
+
+# Most tool calls one plan may contain
+MAX_PLAN_CALLS = 8
+# Argument value referring to the result of an earlier call, and its placeholder in the answer
+_REFERENCE = re.compile(r"^\$(\d+)$")
+_PLACEHOLDER = re.compile(r"\{(\d+)\}")
+
+PLAN_SYSTEM_PROMPT = """You are a friendly math calculation assistant. Reply with one JSON plan and nothing else.
+
+The plan lists the tool calls needed to answer the user and the reply to send once they are done:
+{{"calls": [{{"tool": "<tool name>", "args": {{<arguments>}}}}, ...], "answer": "<reply>"}}
+
+Rules:
+- Use as few calls as possible, calls without "$N" arguments run at the same time
+- An argument "$N" is the result of call N (counting from 0), it may only refer to an earlier call
+- Write the result of call N as {{N}} in the answer, e.g. "The answer is {{0}}"
+- If no calculation is needed, use "calls": [] and reply directly in "answer"
+
+Available tools:
+{tools}
+
+Examples:
+User: 12 + 30
+{{"calls": [{{"tool": "add_numbers", "args": {{"a": 12, "b": 30}}}}], "answer": "The answer is {{0}}"}}
+User: add 2 and 3, then multiply the sum by 4
+{{"calls": [{{"tool": "add_numbers", "args": {{"a": 2, "b": 3}}}}, {{"tool": "multiply_numbers", "args": {{"a": "$0", "b": 4}}}}], "answer": "The answer is {{1}}"}}"""
+
+
+class PlanError(ValueError):
+    """The model's plan cannot be executed as written"""
+
+
+class PlannedCall:
+    """One tool call of a plan, references maps argument names to the call whose result they take"""
+
+    def __init__(self, index: int, tool: BaseTool, args: Dict[str, Any], references: Dict[str, int]):
+        self.index = index
+        self.tool = tool
+        self.args = args
+        self.references = references
+
+
+class Plan:
+    def __init__(self, calls: List[PlannedCall], answer: str):
+        self.calls = calls
+        self.answer = answer
+
+
+def _with_references(schema: dict) -> dict:
+    """Tool parameter schema where every top-level argument may also be a "$N" result reference"""
+    schema = copy.deepcopy(schema)
+    reference = {"type": "string", "pattern": "^[$][0-9]$"}
+    for name, prop in (schema.get("properties") or {}).items():
+        schema["properties"][name] = {"anyOf": [prop, reference]}
+    return schema
+
+
+def build_plan_grammar(tools: Sequence[BaseTool]) -> str:
+    """GBNF grammar for a plan object calling the given tools"""
+    converter = SchemaConverter(prop_order={}, allow_fetch=False, dotall=False, raw_pattern=False)
+    calls = []
+    for tool in tools:
+        try:
+            args = _with_references(converter.resolve_refs(tool.metadata.get_parameters_dict(), ""))
+        except Exception as e:
+            logger.warning(f"Tool {tool.metadata.name}: parameter schema not usable in the plan grammar ({e}), "
+                           f"accepting any JSON object")
+            args = {"type": "object"}
+        calls.append({
+            "type": "object",
+            "properties": {"tool": {"const": tool.metadata.name}, "args": args},
+            "required": ["tool", "args"],
+            "additionalProperties": False,
+        })
+    plan = {
+        "type": "object",
+        "properties": {
+            "calls": {"type": "array", "items": {"anyOf": calls}, "maxItems": MAX_PLAN_CALLS}
+            if calls else {"type": "array", "maxItems": 0},
+            "answer": {"type": "string"},
+        },
+        "required": ["calls", "answer"],
+        "additionalProperties": False,
+    }
+    converter.visit(plan, "")
+    return converter.format_grammar()
+
+
+def parse_plan(text: str, tools: Dict[str, BaseTool]) -> Plan:
+    """Parse and validate the model's plan, PlanError if it cannot be executed"""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise PlanError(f"not valid JSON: {e}")
+    if not isinstance(data, dict) or not isinstance(data.get("calls"), list) or not isinstance(data.get("answer"), str):
+        raise PlanError('expected {"calls": [...], "answer": "..."}')
+    if len(data["calls"]) > MAX_PLAN_CALLS:
+        raise PlanError(f"{len(data['calls'])} calls, at most {MAX_PLAN_CALLS} are allowed")
+
+    calls = []
+    for index, call in enumerate(data["calls"]):
+        if not isinstance(call, dict) or not isinstance(call.get("args"), dict):
+            raise PlanError(f"call {index}: expected {{\"tool\": ..., \"args\": {{...}}}}")
+        tool = tools.get(call.get("tool"))
+        if tool is None:
+            raise PlanError(f"call {index}: unknown tool {call.get('tool')!r}")
+        references = {}
+        for name, value in call["args"].items():
+            match = _REFERENCE.match(value) if isinstance(value, str) else None
+            if match is None:
+                continue
+            source = int(match.group(1))
+            if source >= index:
+                raise PlanError(f"call {index}: argument {name} refers to call {source}, which does not run before it")
+            references[name] = source
+        _validate_args(tool, call["args"], references, index)
+        calls.append(PlannedCall(index, tool, call["args"], references))
+
+    used = {int(n) for n in _PLACEHOLDER.findall(data["answer"])}
+    if any(n >= len(calls) for n in used):
+        raise PlanError(f"answer refers to call {max(used)}, the plan has {len(calls)}")
+    if calls and not used:
+        raise PlanError("answer does not use any call result")
+    return Plan(calls, data["answer"])
+
+
+def _validate_args(tool: BaseTool, args: Dict[str, Any], references: Dict[str, int], index: int):
+    """Check the arguments against the tool schema (referenced results are only known at run time)"""
+    fn_schema = tool.metadata.fn_schema
+    if fn_schema is None:
+        return
+    try:
+        fn_schema.model_validate(args)
+    except ValidationError as e:
+        errors = [error for error in e.errors() if not error["loc"] or error["loc"][0] not in references]
+        if errors:
+            raise PlanError(f"call {index} ({tool.metadata.name}): {errors[0]['msg']} ({'.'.join(map(str, errors[0]['loc']))})")
+
+
+def _reference_value(text: str) -> Any:
+    """A call result as argument value: numbers stay numbers"""
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        return text
+    return value if isinstance(value, (int, float)) else text
+
+
+class PlanAgent:
+    """Asks the LLM for one plan, runs its tool calls over MCP and renders the reply template"""
+
+    name = "plan"
+
+    def __init__(self, llm, tools: Sequence[BaseTool], call_tool: CallTool):
+        self.llm = llm
+        self.tools = {tool.metadata.name: tool for tool in tools}
+        self.call_tool = call_tool
+        descriptions = "\n".join(
+            f"- {tool.metadata.name}{json.dumps(tool.metadata.get_parameters_dict().get('properties', {}))}: "
+            f"{tool.metadata.description}"
+            for tool in tools
+        ) or "(none)"
+        self.system_prompt = PLAN_SYSTEM_PROMPT.format(tools=descriptions)
+        self.grammar = build_plan_grammar(tools)
+        # Counters
+        self.plans = 0
+        self.executed = 0
+        self.invalid = 0
+        self.tool_errors = 0
+        self.tool_calls = 0
+        self.concurrent_calls = 0  # Calls that ran alongside another call of the same plan
+
+    def format_messages(self, message: str, memory: Optional[ChatMemoryBuffer] = None) -> List[ChatMessage]:
+        history = memory.get() if memory is not None else []
+        return [ChatMessage(role="system", content=self.system_prompt), *history,
+                ChatMessage(role="user", content=message)]
+
+    async def run(self, message: str, memory: Optional[ChatMemoryBuffer] = None,
+                  on_event=None) -> Optional[AgentOutput]:
+        """Answer with one LLM pass, None if the plan failed (the caller falls back to the ReActAgent)"""
+        emit = on_event or (lambda event: None)
+        self.plans += 1
+        text = ""
+        stream = await self.llm.astream_chat(self.format_messages(message, memory), grammar=self.grammar)
+        async for chunk in stream:
+            if chunk.delta:
+                text += chunk.delta
+                emit(AgentStream(delta=chunk.delta, response=text, current_agent_name=self.name, raw=chunk.raw))
+
+        try:
+            plan = parse_plan(text.strip(), self.tools)
+        except PlanError as e:
+            self.invalid += 1
+            logger.info(f"Plan rejected ({e}): {text.strip()[:200]}")
+            return None
+        try:
+            results = await self._execute(plan, emit)
+        except PlanError as e:
+            self.tool_errors += 1
+            logger.info(f"Plan execution failed ({e})")
+            return None
+
+        answer = _PLACEHOLDER.sub(lambda m: results[int(m.group(1))], plan.answer)
+        self.executed += 1
+        if memory is not None:
+            memory.put(ChatMessage(role="user", content=message))
+            memory.put(ChatMessage(role="assistant", content=answer))
+        output = AgentOutput(
+            response=ChatMessage(role="assistant", content=answer),
+            current_agent_name=self.name,
+            raw=text,
+        )
+        emit(output)
+        return output
+
+    async def _execute(self, plan: Plan, emit) -> List[str]:
+        """Run the calls in waves, each wave holds every call whose referenced results are available"""
+        results: Dict[int, str] = {}
+        pending = list(plan.calls)
+        while pending:
+            wave = [call for call in pending if all(source in results for source in call.references.values())]
+            pending = [call for call in pending if call not in wave]
+            if len(wave) > 1:
+                self.concurrent_calls += len(wave)
+            outputs = await asyncio.gather(*(self._call(call, results, emit) for call in wave))
+            for call, output in zip(wave, outputs):
+                results[call.index] = output
+        return [results[index] for index in range(len(plan.calls))]
+
+    async def _call(self, call: PlannedCall, results: Dict[int, str], emit) -> str:
+        name = call.tool.metadata.name
+        args = {key: _reference_value(results[call.references[key]]) if key in call.references else value
+                for key, value in call.args.items()}
+        tool_id = f"plan-{call.index}"
+        emit(ToolCall(tool_name=name, tool_kwargs=args, tool_id=tool_id))
+        self.tool_calls += 1
+        try:
+            result = await self.call_tool(name, args)
+        except Exception as e:
+            raise PlanError(f"{name}({args}): {type(e).__name__}: {e}")
+        is_error = bool(getattr(result, "isError", False))
+        text = result_text(result)
+        emit(ToolCallResult(
+            tool_name=name,
+            tool_kwargs=args,
+            tool_id=tool_id,
+            tool_output=ToolOutput(content=text, tool_name=name, raw_input=args, raw_output=result, is_error=is_error),
+            return_direct=False,
+        ))
+        if is_error:
+            raise PlanError(f"{name}({args}) returned an error: {text}")
+        return text
+
+    def stats(self) -> dict:
+        return {
+            "plans": self.plans,
+            "executed": self.executed,
+            "invalid": self.invalid,
+            "tool_errors": self.tool_errors,
+            "tool_calls": self.tool_calls,
+            "concurrent_calls": self.concurrent_calls,
+        }
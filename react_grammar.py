@@ -0,0 +1,48 @@
+"""
+ReAct Grammar - GBNF grammar that constrains each agent step to a well-formed ReAct reply
+
+Built from the live tool catalog: a step is one "Thought:" line followed either by
+"Action:" with the name of an existing tool and "Action Input:" JSON matching that tool's
+parameter schema, or by a single "Answer:" line. llama.cpp only samples tokens the grammar
+allows and stops once the grammar is complete, so the model cannot produce unparseable
+output, unknown tools or invalid arguments, and does not continue with made-up
+"Observation:" lines after the tool call.
+"""
+import json
+import logging
+from typing import Sequence
+
+from llama_cpp.llama_grammar import SchemaConverter
+from llama_index.core.tools import BaseTool
+
+logger = logging.getLogger(__name__)
+
+# Fallback for tools without a usable parameter schema: any JSON object
+_ANY_OBJECT = {"type": "object"}
+# Longest Thought line; the model has to move on to the action or answer after it
+MAX_THOUGHT_CHARS = 256
+
+
+def build_react_grammar(tools: Sequence[BaseTool]) -> str:
+    """GBNF grammar for one ReAct step with the given tools (answer only when there are none)"""
+    converter = SchemaConverter(prop_order={}, allow_fetch=False, dotall=False, raw_pattern=False)
+    calls = []
+    for index, tool in enumerate(tools):
+        name = f"tool-{index}-args"
+        try:
+            schema = converter.resolve_refs(tool.metadata.get_parameters_dict(), "")
+            converter.visit(schema, name)
+        except Exception as e:
+            logger.warning(f"Tool {tool.metadata.name}: parameter schema not usable in the grammar ({e}), "
+                           f"accepting any JSON object")
+            converter.visit(_ANY_OBJECT, name)
+        calls.append(f'{json.dumps(tool.metadata.name)} "\\nAction Input: " {name}')
+
+    rules = [
+        'root ::= "Thought: " thought "\\n" (' + ("action | " if calls else "") + "answer)",
+        f'thought ::= [^\\n]{{1,{MAX_THOUGHT_CHARS}}}',
+        'answer ::= "Answer: " [^\\n]+',
+    ]
+    if calls:
+        rules.append('action ::= "Action: " (' + " | ".join(calls) + ")")
+    return "\n".join(rules) + "\n" + converter.format_grammar()
@@ -0,0 +1,184 @@
+"""
+Response Cache - Reuse agent answers for repeated questions
+
+Answers are keyed on a normalised message plus a fingerprint of everything that can change
+the answer (model, generation parameters, system prompt, tool catalog). Entries live in a
+bounded in-memory LRU with TTL and can optionally be written through to a SQLite file so
+they survive restarts. When the fingerprint changes, old entries are dropped.
+
+The in-memory path is synchronous. SQLite never runs on the event loop: writes are queued
+to a writer thread that commits them in batches, reads after a memory miss (aget) run in a
+worker thread.
+"""
+import asyncio
+import hashlib
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalise_message(message: str) -> str:
+    """Fold case, full-width characters and insignificant whitespace/punctuation"""
+    text = unicodedata.normalize("NFKC", message).lower().strip()
+    text = text.rstrip("?!.。？！ ")
+    # Spaces around operators/punctuation don't change the question ('5 + 3' == '5+3')
+    text = re.sub(r"\s*([^\w\s])\s*", r"\1", text)
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """Bounded LRU with TTL and optional SQLite write-through store"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.path = path
+        self.fingerprint = ""
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, value)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()  # The writer thread and readers share the connection
+        self._writes: "queue.Queue[Optional[tuple]]" = queue.Queue()  # (sql, params), None stops the writer
+        self._writer: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, fingerprint TEXT NOT NULL)"
+            )
+            self._db.commit()
+            self._writer = threading.Thread(target=self._write_loop, name="response-cache-writer", daemon=True)
+            self._writer.start()
+            logger.info(f"Response cache backed by: {path}")
+
+    def set_fingerprint(self, fingerprint: str):
+        """Invalidate all entries created under a different model/prompt/tool fingerprint"""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            if self.fingerprint:
+                logger.info("Model, system prompt or tool catalog changed, response cache invalidated")
+            self.fingerprint = fingerprint
+            self._entries.clear()
+            self._write("DELETE FROM responses WHERE fingerprint != ?", (fingerprint,))
+            self._write("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+
+    def make_key(self, message: str) -> str:
+        return hashlib.sha256(f"{self.fingerprint}\0{normalise_message(message)}".encode("utf-8")).hexdigest()
+
+    def get(self, message: str) -> Optional[str]:
+        """Cached answer from memory only (use aget to fall back to the SQLite store)"""
+        return self._lookup(self.make_key(message))
+
+    async def aget(self, message: str) -> Optional[str]:
+        """Cached answer from memory, after a miss from the SQLite store (read in a worker thread)"""
+        key = self.make_key(message)
+        with self._lock:
+            in_memory = key in self._entries
+        stored = None
+        if not in_memory and self._db is not None:
+            stored = await asyncio.to_thread(self._load, key)
+        return self._lookup(key, stored)
+
+    def _lookup(self, key: str, stored: Optional[tuple] = None) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and stored is not None:
+                entry = stored
+                self._store_memory(key, entry)
+            if entry is None or now - entry[0] > self.ttl:
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, message: str, value: str):
+        key = self.make_key(message)
+        entry = (time.time(), value)
+        with self._lock:
+            self._store_memory(key, entry)
+            self._write(
+                "INSERT OR REPLACE INTO responses (key, value, created, fingerprint) VALUES (?, ?, ?, ?)",
+                (key, value, entry[0], self.fingerprint),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._write("DELETE FROM responses", ())
+
+    def close(self):
+        """Commit the queued writes and close the SQLite store"""
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _store_memory(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key: str):
+        self._entries.pop(key, None)
+        self._write("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _load(self, key: str) -> Optional[tuple]:
+        """(created, value) of a stored entry, blocking"""
+        with self._db_lock:
+            return self._db.execute("SELECT created, value FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def _write(self, sql: str, params: tuple):
+        """Queue a statement for the writer thread (no-op without SQLite store)"""
+        if self._writer is not None:
+            self._writes.put((sql, params))
+
+    def _write_loop(self):
+        """Execute queued statements, one commit for everything queued meanwhile"""
+        stop = False
+        while not stop:
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            with self._db_lock:
+                try:
+                    for statement in batch:
+                        if statement is not None:
+                            self._db.execute(*statement)
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"Response cache write failed: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "persistent": self._db is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
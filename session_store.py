@@ -0,0 +1,200 @@
+"""
+Session Store - Multi-turn conversations with bounded memory
+
+A request with a session_id continues that session's conversation: its ChatMemoryBuffer
+keeps the chat history, and the llama.cpp KV cells of its last prompt are saved after each
+completion. When the next turn's prompt starts with those tokens and the live context has
+moved on to another session, the saved cells are loaded back, so only the new tokens are
+evaluated. KV state is by far the largest part of a session: when the total size exceeds
+the budget, the KV state of the least recently used sessions is dropped first (their
+history is kept and evaluated again on the next turn), then whole sessions. Sessions idle
+for longer than the TTL are removed.
+"""
+import asyncio
+import ctypes
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import List, Optional
+
+import llama_cpp
+from llama_index.core.memory import ChatMemoryBuffer
+
+logger = logging.getLogger(__name__)
+
+# Session of the agent run in progress, read by LocalLlamaCPP around each completion
+current_session: ContextVar[Optional["Session"]] = ContextVar("current_session", default=None)
+
+
+class Session:
+    """Chat history and saved KV cells of one conversation"""
+
+    def __init__(self, session_id: str, store: "SessionStore"):
+        self.session_id = session_id
+        self.store = store
+        self.memory = ChatMemoryBuffer(token_limit=store.token_limit)
+        self.kv_tokens: List[int] = []
+        self.kv_state: Optional[bytes] = None
+        self.created = time.time()
+        self.last_used = self.created
+        self.turns = 0
+        # One turn at a time per session, concurrent requests for the same session queue up
+        self.lock = asyncio.Lock()
+
+    @property
+    def kv_bytes(self) -> int:
+        return len(self.kv_state) if self.kv_state is not None else 0
+
+    @property
+    def size(self) -> int:
+        """Approximate bytes held by the session (KV state + history text)"""
+        history = sum(len(str(message.content or "")) for message in self.memory.get_all())
+        return self.kv_bytes + history
+
+    def save_kv(self, model):
+        """Save the KV cells of the model's live context (sequence 0) after a completion"""
+        ctx = model._ctx.ctx
+        size = llama_cpp.llama_state_seq_get_size(ctx, 0)
+        buf = (ctypes.c_uint8 * size)()
+        written = llama_cpp.llama_state_seq_get_data(ctx, buf, size, 0)
+        if written <= 0:
+            return
+        self.store.replace_kv(self, model.input_ids[:model.n_tokens].tolist(), bytes(buf)[:written])
+
+    def restore_kv(self, model, prompt_tokens: List[int], min_tokens: int = 0) -> bool:
+        """Load the saved KV cells if they cover more of the prompt than the live context does
+
+        min_tokens: only restore when the saved state covers more than this many prompt tokens
+        (e.g. the shared prefix snapshot, which is cheaper to restore).
+        """
+        with self.store.lock:
+            tokens, state = self.kv_tokens, self.kv_state
+        if state is None:
+            return False
+        shared = model.longest_token_prefix(tokens, prompt_tokens)
+        live = model.longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), prompt_tokens)
+        if shared <= max(live, min_tokens):
+            return False
+        model._ctx.kv_cache_seq_rm(0, -1, -1)
+        buf = (ctypes.c_uint8 * len(state)).from_buffer_copy(state)
+        if llama_cpp.llama_state_seq_set_data(model._ctx.ctx, buf, len(state), 0) != len(state):
+            logger.warning(f"Session {self.session_id}: failed to restore KV state")
+            model.reset()
+            return False
+        model.input_ids[:len(tokens)] = tokens
+        model.n_tokens = len(tokens)
+        self.store.record_restore(shared)
+        return True
+
+
+class SessionStore:
+    """LRU of sessions with idle TTL, a session count limit and a memory budget"""
+
+    def __init__(self, max_sessions: int = 1000, max_bytes: int = 1024 * 1024 * 1024, ttl: float = 1800,
+                 token_limit: int = 3000):
+        self.max_sessions = max(1, max_sessions)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.token_limit = token_limit
+        self.lock = threading.Lock()
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._kv_bytes = 0
+        # Counters
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.kv_evicted = 0
+        self.kv_restores = 0
+        self.kv_tokens_restored = 0
+
+    def get(self, session_id: str) -> Session:
+        """Session for an id (created if unknown or expired), marked as most recently used"""
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, self)
+                self._sessions[session_id] = session
+                self.created += 1
+                while len(self._sessions) > self.max_sessions and self._evict_session(keep=session):
+                    pass
+            self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self.lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return False
+            self._kv_bytes -= session.kv_bytes
+            return True
+
+    def replace_kv(self, session: Session, tokens: List[int], state: bytes):
+        with self.lock:
+            if self._sessions.get(session.session_id) is not session:
+                return  # Evicted while the turn was running
+            self._kv_bytes += len(state) - session.kv_bytes
+            session.kv_tokens, session.kv_state = tokens, state
+            self._enforce_budget(keep=session)
+
+    def record_restore(self, tokens: int):
+        with self.lock:
+            self.kv_restores += 1
+            self.kv_tokens_restored += tokens
+
+    def _expire(self, now: float):
+        for session_id in [s.session_id for s in self._sessions.values() if now - s.last_used > self.ttl]:
+            session = self._sessions[session_id]
+            if session.lock.locked():
+                continue
+            del self._sessions[session_id]
+            self._kv_bytes -= session.kv_bytes
+            self.expired += 1
+
+    def _enforce_budget(self, keep: Session):
+        # KV states first: losing one only costs prompt evaluation on the session's next turn
+        for session in list(self._sessions.values()):
+            if self._kv_bytes <= self.max_bytes:
+                return
+            if session is keep or session.kv_state is None:
+                continue
+            self._kv_bytes -= session.kv_bytes
+            session.kv_tokens, session.kv_state = [], None
+            self.kv_evicted += 1
+        if self._kv_bytes > self.max_bytes:
+            # A single session larger than the budget does not keep its KV state either
+            self._kv_bytes -= keep.kv_bytes
+            keep.kv_tokens, keep.kv_state = [], None
+            self.kv_evicted += 1
+
+    def _evict_session(self, keep: Session) -> bool:
+        for session in self._sessions.values():
+            if session is keep or session.lock.locked():
+                continue
+            del self._sessions[session.session_id]
+            self._kv_bytes -= session.kv_bytes
+            self.evicted += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            history_bytes = sum(session.size - session.kv_bytes for session in self._sessions.values())
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl": self.ttl,
+                "kv_bytes": self._kv_bytes,
+                "history_bytes": history_bytes,
+                "max_bytes": self.max_bytes,
+                "created": self.created,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "kv_evicted": self.kv_evicted,
+                "kv_restores": self.kv_restores,
+                "kv_tokens_restored": self.kv_tokens_restored,
+            }
@@ -0,0 +1,96 @@
+import pytest
+
+from expression_engine import (
+    DIVISION_BY_ZERO,
+    EXPONENT_LIMIT,
+    MAGNITUDE_LIMIT,
+    MAX_EXPRESSION_LENGTH,
+    MAX_NODES,
+    MISSING_VARIABLE,
+    NOT_REAL,
+    ExpressionError,
+    evaluate_batch,
+    evaluate_expression,
+)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("1 + 2 * 3", 7.0),
+    ("(1 + 2) * 3", 9.0),
+    ("7 // 2", 3.0),
+    ("-2 ** 2", -4.0),
+    ("2 ** -1", 0.5),
+    ("1.5 * 4", 6.0),
+])
+def test_evaluates_like_python(expression, expected):
+    assert evaluate_expression(expression) == expected
+
+
+def test_integers_stay_exact():
+    assert evaluate_expression("9007199254740993 - 9007199254740992") == 1.0
+    assert evaluate_expression("2**53 + 1") == float(2**53 + 1)
+
+
+@pytest.mark.parametrize("expression", [
+    "__import__('os')",
+    "x + 1",
+    "abs(-1)",
+    "(1).real",
+    "[1, 2]",
+    "'a' * 3",
+    "1 if 1 else 2",
+    "1 < 2",
+    "True + 1",
+])
+def test_rejects_anything_but_arithmetic(expression):
+    with pytest.raises(ExpressionError):
+        evaluate_expression(expression)
+
+
+@pytest.mark.parametrize("expression, message", [
+    ("1/0", "Division by zero"),
+    ("1 // (2 - 2)", "Division by zero"),
+    ("0 ** -1", "Division by zero"),
+    ("2**64**2", "Exponent"),
+    ("2 ** 65", "Exponent"),
+    ("10**50 * 10**51", "magnitude"),
+    ("(-8) ** 0.5", "not a real number"),
+    ("", "empty"),
+    ("1 +", "syntax"),
+])
+def test_rejects_errors_and_exceeded_limits(expression, message):
+    with pytest.raises(ExpressionError, match=message):
+        evaluate_expression(expression)
+
+
+def test_rejects_long_and_large_expressions():
+    with pytest.raises(ExpressionError, match="longer"):
+        evaluate_expression("1+" * MAX_EXPRESSION_LENGTH + "1")
+    with pytest.raises(ExpressionError, match="nodes"):
+        evaluate_expression("+".join(["1"] * (MAX_NODES // 2 + 1)))
+
+
+def test_batch_reports_errors_per_item():
+    values, errors = evaluate_batch("1 / x + y ** 2", [{"x": 2, "y": 3}, {"x": 0, "y": 1}, {"x": 1}])
+    assert values[0] == 9.5
+    assert list(errors) == [0, DIVISION_BY_ZERO, MISSING_VARIABLE]
+
+
+@pytest.mark.parametrize("expression, code", [
+    ("x + 1/0", DIVISION_BY_ZERO),
+    ("x / (1 - 1)", DIVISION_BY_ZERO),
+    ("x + 10**70 * 10**70", EXPONENT_LIMIT),
+    ("x ** 100", EXPONENT_LIMIT),
+    ("x * 1e60 * 1e60", MAGNITUDE_LIMIT),
+    ("(x - 5) ** 0.5", NOT_REAL),
+])
+def test_batch_reports_constant_and_variable_errors_alike(expression, code):
+    values, errors = evaluate_batch(expression, [{"x": 1}, {"x": 2}])
+    assert list(errors) == [code, code]
+
+
+def test_batch_rejects_invalid_expression():
+    with pytest.raises(ExpressionError):
+        evaluate_batch("f(x)", [{"x": 1}])
+    with pytest.raises(ExpressionError):
+        evaluate_batch("_x + 1", [{"_x": 1}])
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+from llama_index.core.tools import FunctionTool
+
+from plan_agent import MAX_PLAN_CALLS, PlanError, parse_plan
+
+
+def add_numbers(a: float, b: float) -> float:
+    """Add two numbers"""
+    return a + b
+
+
+def multiply_numbers(a: float, b: float) -> float:
+    """Multiply two numbers"""
+    return a * b
+
+
+TOOLS = {fn.__name__: FunctionTool.from_defaults(fn) for fn in (add_numbers, multiply_numbers)}
+
+
+def plan(calls, answer="The answer is {0}") -> str:
+    return json.dumps({"calls": calls, "answer": answer})
+
+
+def test_parses_calls_and_references():
+    parsed = parse_plan(plan([
+        {"tool": "add_numbers", "args": {"a": 2, "b": 3}},
+        {"tool": "multiply_numbers", "args": {"a": "$0", "b": 4}},
+    ], "The answer is {1}"), TOOLS)
+    assert [call.tool.metadata.name for call in parsed.calls] == ["add_numbers", "multiply_numbers"]
+    assert parsed.calls[0].references == {}
+    assert parsed.calls[1].references == {"a": 0}
+    assert parsed.answer == "The answer is {1}"
+
+
+def test_direct_answer_without_calls():
+    parsed = parse_plan(plan([], "Hello!"), TOOLS)
+    assert parsed.calls == [] and parsed.answer == "Hello!"
+
+
+@pytest.mark.parametrize("text, message", [
+    ("not json", "not valid JSON"),
+    ('{"calls": {}, "answer": "x"}', "expected"),
+    ('{"calls": [], "answer": 1}', "expected"),
+    (plan([{"tool": "add_numbers"}]), "call 0: expected"),
+    (plan([{"tool": "subtract_numbers", "args": {"a": 1, "b": 2}}]), "unknown tool"),
+    (plan([{"tool": "add_numbers", "args": {"a": "$0", "b": 2}}]), "does not run before it"),
+    (plan([{"tool": "add_numbers", "args": {"a": "two", "b": 2}}]), r"call 0 \(add_numbers\)"),
+    (plan([{"tool": "add_numbers", "args": {"a": 1}}]), r"call 0 \(add_numbers\)"),
+    (plan([{"tool": "add_numbers", "args": {"a": 1, "b": 2}}], "The answer is {1}"), "refers to call 1"),
+    (plan([{"tool": "add_numbers", "args": {"a": 1, "b": 2}}], "Done"), "does not use any call result"),
+    (plan([{"tool": "add_numbers", "args": {"a": 1, "b": 2}}] * (MAX_PLAN_CALLS + 1)), "at most"),
+])
+def test_rejects_plans_that_cannot_run(text, message):
+    with pytest.raises(PlanError, match=message):
+        parse_plan(text, TOOLS)
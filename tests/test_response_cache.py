@@ -0,0 +1,53 @@
+import asyncio
+
+from response_cache import ResponseCache, normalise_message
+
+
+def test_normalise_message():
+    assert normalise_message("  What is 5 + 3? ") == normalise_message("what is 5+3")
+    assert normalise_message("ＡＢＣ") == "abc"
+
+
+def test_memory_lru_and_fingerprint():
+    cache = ResponseCache(max_entries=2)
+    cache.set_fingerprint("a")
+    cache.set("one", "1")
+    cache.set("two", "2")
+    cache.set("three", "3")
+    assert cache.get("one") is None
+    assert cache.get("Three?") == "3"
+    cache.set_fingerprint("b")
+    assert cache.get("three") is None
+
+
+def test_sqlite_store_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path=path)
+    cache.set_fingerprint("a")
+    cache.set("5 + 3", "8")
+    cache.close()
+
+    cache = ResponseCache(path=path)
+    cache.set_fingerprint("a")
+    assert cache.get("5+3") is None  # Memory only
+    assert asyncio.run(cache.aget("5+3")) == "8"
+    assert cache.get("5+3") == "8"
+    cache.close()
+
+    cache = ResponseCache(path=path)
+    cache.set_fingerprint("b")
+    assert asyncio.run(cache.aget("5+3")) is None
+    cache.close()
+
+
+def test_sqlite_expired_entry_is_deleted(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(ttl=0, path=path)
+    cache.set_fingerprint("a")
+    cache.set("5 + 3", "8")
+    assert asyncio.run(cache.aget("5 + 3")) is None
+    cache.close()
+    cache = ResponseCache(ttl=3600, path=path)
+    cache.set_fingerprint("a")
+    assert asyncio.run(cache.aget("5 + 3")) is None
+    cache.close()
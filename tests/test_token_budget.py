@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, List
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from llama_index.core.tools import FunctionTool
+
+from token_budget import (
+    ACTION,
+    ANSWER,
+    RETRY,
+    BudgetedReActAgent,
+    BudgetUsage,
+    classify_step,
+    complete_length,
+    current_usage,
+)
+
+MULTI_LINE_ANSWER = "Thought: I can answer.\nAnswer: Steps:\n1. 3*4=12\n2. 12+1=13"
+
+
+class ScriptedLLM(CustomLLM):
+    """Streams one scripted step per call, chunk by chunk, then ends like the end-of-turn token"""
+
+    steps: List[List[str]]
+    calls: int = 0
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(num_output=256)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text="".join(self._next_step()))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        chunks = self._next_step()
+
+        def gen():
+            text = ""
+            for chunk in chunks:
+                text += chunk
+                yield CompletionResponse(delta=chunk, text=text)
+        return gen()
+
+    def _next_step(self) -> List[str]:
+        self.calls += 1
+        return self.steps[min(self.calls, len(self.steps)) - 1]
+
+
+def add(a: int, b: int) -> int:
+    """Add two numbers"""
+    return a + b
+
+
+def run_agent(steps: List[List[str]], single_line_answers: bool = False):
+    agent = BudgetedReActAgent(
+        tools=[FunctionTool.from_defaults(add)],
+        llm=ScriptedLLM(steps=steps),
+        system_prompt="x",
+        single_line_answers=single_line_answers,
+    )
+    usage = BudgetUsage()
+
+    async def run():
+        current_usage.set(usage)
+        return await agent.run(user_msg="What is 3*4+1? Show the steps")
+
+    return str(asyncio.run(run())), usage
+
+
+def test_classify_step():
+    assert classify_step([]) == ACTION
+    assert classify_step([ChatMessage(role="user", content="1 + 1")]) == ACTION
+    assert classify_step([ChatMessage(role="user", content="Observation: 2")]) == ANSWER
+    assert classify_step([ChatMessage(role="user", content="Error while parsing the output: x")]) == RETRY
+
+
+def test_action_input_complete_at_closing_brace():
+    text = 'Thought: add\nAction: add\nAction Input: {"a": 1, "b": {"c": "}"}}\nObservation: made up'
+    assert complete_length(text) == text.index("\nObservation")
+    assert complete_length('Thought: add\nAction: add\nAction Input: {"a": 1, "b"') is None
+    escaped = 'Action Input: {"expression": "\\"}\\" + 1"}'
+    assert complete_length(escaped + " trailing") == len(escaped)
+    assert complete_length("Thought: no action yet") is None
+
+
+def test_multi_line_answer_not_cut_while_streaming():
+    assert complete_length("Thought: x\nAnswer: Steps:\n1. 3*4=12\n") is None
+    assert complete_length(MULTI_LINE_ANSWER, finished=True) == len(MULTI_LINE_ANSWER)
+    # Only an empty answer is not complete
+    assert complete_length("Thought: x\nAnswer: ", finished=True) is None
+
+
+def test_single_line_answer_complete_at_newline():
+    text = "Thought: x\nAnswer: 13\nmore text"
+    assert complete_length(text, single_line_answer=True) == text.index("\nmore")
+    assert complete_length("Thought: x\nAnswer: 13", single_line_answer=True) is None
+
+
+def test_agent_keeps_multi_line_answer():
+    answer, usage = run_agent([[chunk + "\n" for chunk in MULTI_LINE_ANSWER.split("\n")[:-1]] + ["2. 12+1=13"]])
+    assert answer == "Steps:\n1. 3*4=12\n2. 12+1=13"
+    assert usage.steps == 1 and usage.early_stops == 1
+
+
+def test_agent_stops_action_step_early():
+    action = ["Thought: add\n", "Action: add\n", 'Action Input: {"a": 12, ', '"b": 1}', "\nObservation: 99"]
+    answer, usage = run_agent([action, ["Thought: done\n", "Answer: 13"]])
+    assert answer == "13"
+    assert usage.steps == 2 and usage.early_stops == 2
+
+
+def test_agent_single_line_answers_end_with_their_line():
+    answer, usage = run_agent([["Thought: x\n", "Answer: 13\n", "Thought: chatter"]], single_line_answers=True)
+    assert answer == "13"
+    assert usage.early_stops == 1
@@ -0,0 +1,208 @@
+"""
+Token Budget - Per-step generation limits, stop sequences and early termination for the ReActAgent
+
+A ReAct step either selects a tool ("Thought:", "Action:", "Action Input:" JSON) or answers
+("Thought:" and an "Answer:"), both far shorter than the model's max_new_tokens, and
+CPU generation time grows with every token. Each step gets a limit chosen from its prompt:
+
+- action: the first step of a request (any step not following an observation or an error):
+  AGENT_ACTION_MAX_TOKENS plus an estimate of the user message, which the Action Input repeats
+- answer: the step after a tool observation: AGENT_ANSWER_MAX_TOKENS plus an estimate of
+  the observation, which the answer repeats
+- retry: the step after an unparseable or empty one keeps the full max_new_tokens
+
+Every step stops at "\\nObservation:" (tool results come from the tool, not the model). A
+streamed step is closed as soon as its Action Input object is complete, which cancels the rest
+of the generation in every backend instead of decoding up to the end-of-turn token. An answer
+may span several lines, so an answer step runs to the end-of-turn token or its budget, unless
+the ReAct grammar limits answers to one line (single_line_answers): then it is closed at the
+end of its Answer line too. A step whose generation ends after a non-empty answer counts as
+complete as well.
+Budgets and early stops of a run are collected in the BudgetUsage set in current_usage,
+chat_server.py reports them with the "Agent run finished" log line.
+"""
+import re
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from llama_index.core.agent import ReActAgent
+from llama_index.core.agent.workflow import AgentStream
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+from llama_index.core.workflow import Context
+from pydantic import BaseModel, Field
+
+from metrics import AGENT_STEP_ENDINGS
+
+ACTION, ANSWER, RETRY = "action", "answer", "retry"
+# Why a step's generation ended
+LINE_COMPLETE, MAX_TOKENS, MODEL = "line_complete", "max_tokens", "model"
+
+# Stop sequences of every step: the model must not make up the tool result
+STOP = ["\nObservation:"]
+# Messages the ReActAgent adds after an unparseable or an empty step
+_RETRY_PREFIXES = ("Error while parsing the output", "FAILURE:")
+_ANSWER = re.compile(r"^Answer:\s*\S", re.MULTILINE)
+_ACTION_INPUT = re.compile(r"^Action Input:\s*(?=\{)", re.MULTILINE)
+
+
+class BudgetUsage:
+    """Token budgets and step endings of one agent run"""
+
+    def __init__(self):
+        self.steps = 0
+        self.budget = 0  # Sum of the steps' max_tokens
+        self.unbudgeted = 0  # Sum of max_new_tokens, the limit of every step without budgets
+        self.early_stops = 0  # Steps that ended once their line was complete
+        self.truncated = 0  # Steps that used their whole budget
+
+    def add(self, max_tokens: int, max_new_tokens: int, reason: str):
+        self.steps += 1
+        self.budget += max_tokens
+        self.unbudgeted += max_new_tokens
+        self.early_stops += reason == LINE_COMPLETE
+        self.truncated += reason == MAX_TOKENS
+
+
+# Usage of the run in progress, set by run_agent (the workflow's tasks inherit it)
+current_usage: ContextVar[Optional[BudgetUsage]] = ContextVar("current_usage", default=None)
+
+
+def estimate_tokens(text: str) -> int:
+    """Generous token estimate of a text (numbers and operators tokenize into short pieces)"""
+    return len(text) // 3 + 1
+
+
+def classify_step(messages: List[ChatMessage]) -> str:
+    """Kind of step the formatted ReAct input asks for, decided by its last message"""
+    last = (messages[-1].content or "") if messages else ""
+    if last.startswith(_RETRY_PREFIXES):
+        return RETRY
+    if last.startswith("Observation:"):
+        return ANSWER
+    return ACTION
+
+
+def complete_length(text: str, finished: bool = False, single_line_answer: bool = False) -> Optional[int]:
+    """Length of text up to the end of its answer or Action Input object, None while neither is complete
+
+    An answer is complete once the generation finished (not at the token limit), with
+    single_line_answer (the ReAct grammar allows one Answer line) already at the end of its line.
+    """
+    answer = _ANSWER.search(text)
+    if answer is not None:
+        if finished:
+            return len(text.rstrip())
+        newline = text.find("\n", answer.end()) if single_line_answer else -1
+        if newline != -1:
+            return newline
+    action = _ACTION_INPUT.search(text)
+    if action is not None:
+        return _object_end(text, action.end())
+    return None
+
+
+def _object_end(text: str, start: int) -> Optional[int]:
+    """Index after the JSON object that starts at text[start], None while it is incomplete"""
+    depth = 0
+    in_string = escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
+
+def _finish_reason(raw) -> Optional[str]:
+    """finish_reason of a llama-cpp-python completion chunk (other backends send no raw chunks)"""
+    if isinstance(raw, dict) and raw.get("choices"):
+        return raw["choices"][0].get("finish_reason")
+    return None
+
+
+class BudgetedReActAgent(ReActAgent):
+    """ReActAgent whose LLM calls get the step's token budget and stop sequences, streamed steps end early"""
+
+    action_max_tokens: int = Field(default=96, description="Base token budget of a tool-selection step.")
+    answer_max_tokens: int = Field(default=64, description="Base token budget of a final-answer step.")
+    single_line_answers: bool = Field(
+        default=False, description="Answers are one line (ReAct grammar), a streamed answer ends with its line."
+    )
+
+    def step_budget(self, messages: List[ChatMessage]) -> Tuple[str, int]:
+        """(step kind, max_tokens) for one formatted ReAct input"""
+        step = classify_step(messages)
+        max_new_tokens = self.llm.metadata.num_output
+        if step == RETRY:
+            return step, max_new_tokens
+        base = self.action_max_tokens if step == ACTION else self.answer_max_tokens
+        return step, min(max_new_tokens, base + estimate_tokens(messages[-1].content or ""))
+
+    def _record(self, step: str, max_tokens: int, reason: str):
+        AGENT_STEP_ENDINGS.labels(step=step, reason=reason).inc()
+        usage = current_usage.get()
+        if usage is not None:
+            usage.add(max_tokens, self.llm.metadata.num_output, reason)
+
+    async def _get_response(self, current_llm_input: List[ChatMessage]) -> ChatResponse:
+        step, max_tokens = self.step_budget(current_llm_input)
+        response = await self.llm.achat(current_llm_input, max_tokens=max_tokens, stop=STOP)
+        self._record(step, max_tokens, MODEL)
+        return response
+
+    async def _get_streaming_response(self, ctx: Context, current_llm_input: List[ChatMessage]) -> ChatResponse:
+        step, max_tokens = self.step_budget(current_llm_input)
+        response = await self.llm.astream_chat(current_llm_input, max_tokens=max_tokens, stop=STOP)
+
+        # Same events as ReActAgent._get_streaming_response
+        last_chat_response = ChatResponse(message=ChatMessage())
+        raw = None
+        tokens = 0
+        end = None
+        async for last_chat_response in response:
+            if last_chat_response.delta:
+                tokens += 1  # llama.cpp streams one token per chunk
+            raw = (
+                last_chat_response.raw.model_dump()
+                if isinstance(last_chat_response.raw, BaseModel)
+                else last_chat_response.raw
+            )
+            if ctx.is_running:
+                ctx.write_event_to_stream(
+                    AgentStream(
+                        delta=last_chat_response.delta or "",
+                        response=last_chat_response.message.content or "",
+                        raw=raw,
+                        current_agent_name=self.name,
+                        thinking_delta=last_chat_response.additional_kwargs.get("thinking_delta", None),
+                    )
+                )
+            end = complete_length(last_chat_response.message.content or "", single_line_answer=self.single_line_answers)
+            if end is not None:
+                break
+
+        if end is not None:
+            # Closing the stream cancels the generation (replicas and batch engine stop at the next token)
+            await response.aclose()
+            last_chat_response.message.content = last_chat_response.message.content[:end]
+            reason = LINE_COMPLETE
+        elif tokens >= max_tokens or _finish_reason(raw) == "length":
+            reason = MAX_TOKENS  # llama.cpp may merge tokens into one chunk, its finish reason tells
+        elif complete_length(last_chat_response.message.content or "", finished=True) is not None:
+            reason = LINE_COMPLETE  # The answer ended with the end-of-turn token
+        else:
+            reason = MODEL
+        self._record(step, max_tokens, reason)
+        return last_chat_response
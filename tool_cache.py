@@ -0,0 +1,123 @@
+"""
+Tool Cache - Memoisation of pure MCP tools
+
+A tool function decorated with ToolCache.cacheable is only executed on a miss: its result
+is stored in a bounded LRU keyed on the tool name and the canonical JSON form of its bound
+arguments (defaults applied, keys sorted, optional per-argument normalisation such as
+whitespace-free expressions). Exceptions are not cached, so invalid input is reported on
+every call. Only decorate tools whose result depends on nothing but their arguments.
+"""
+import functools
+import inspect
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from metrics import TOOL_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+class ToolCache:
+    """Bounded LRU of tool results shared by all cacheable tools, with per-tool hit/miss counters"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries  # 0 disables caching
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tools: Dict[str, Dict[str, int]] = {}  # tool name -> {"hits": n, "misses": n}
+
+    def cacheable(self, fn: Optional[Callable] = None, *, canonical: Optional[Dict[str, Callable[[Any], Any]]] = None):
+        """Decorator marking a pure tool function as cacheable (signature is preserved for FastMCP)
+
+        canonical: per-argument functions mapping equivalent values to the same key,
+        e.g. {"expression": normalise_expression}.
+        """
+        if fn is None:
+            return lambda f: self.cacheable(f, canonical=canonical)
+        name = fn.__name__
+        signature = inspect.signature(fn)
+        canonical = canonical or {}
+        self._tools.setdefault(name, {"hits": 0, "misses": 0})
+
+        def make_key(args, kwargs) -> Optional[str]:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {key: canonical[key](value) if key in canonical else value
+                         for key, value in bound.arguments.items()}
+            try:
+                return name + json.dumps(arguments, sort_keys=True, separators=(",", ":"))
+            except (TypeError, ValueError):
+                return None  # Arguments without a JSON form are not cached
+
+        if inspect.iscoroutinefunction(fn):
+            # Offloaded tools (tool_executor.py): hits are answered without dispatching to a worker
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                key = make_key(args, kwargs) if self.max_entries > 0 else None
+                if key is None:
+                    return await fn(*args, **kwargs)
+                found, result = self._lookup(name, key)
+                if not found:
+                    result = await fn(*args, **kwargs)
+                    self._store(key, result)
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs) if self.max_entries > 0 else None
+            if key is None:
+                return fn(*args, **kwargs)
+            found, result = self._lookup(name, key)
+            if not found:
+                result = fn(*args, **kwargs)
+                self._store(key, result)
+            return result
+
+        return wrapper
+
+    def _lookup(self, name: str, key: str):
+        """(True, result) on a hit, (False, None) on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._tools[name]["hits"] += 1
+                result = (True, self._entries[key])
+            else:
+                self._tools[name]["misses"] += 1
+                result = (False, None)
+        TOOL_CACHE_REQUESTS.labels(tool=name, result="hit" if result[0] else "miss").inc()
+        return result
+
+    def _store(self, key: str, result: Any):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> int:
+        """Drop all entries (counters are kept), returns the number of entries removed"""
+        with self._lock:
+            removed = len(self._entries)
+            self._entries.clear()
+        logger.info(f"Tool cache cleared ({removed} entries)")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(tool["hits"] for tool in self._tools.values())
+            misses = sum(tool["misses"] for tool in self._tools.values())
+            total = hits + misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+                "tools": {name: dict(counters) for name, counters in self._tools.items()},
+            }
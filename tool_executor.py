@@ -0,0 +1,230 @@
+"""
+Tool Executor - Run synchronous MCP tool functions off the event loop
+
+FastMCP calls a synchronous tool function directly on the event loop that serves every SSE
+stream and HTTP request, so one CPU-heavy call stalls all clients. Functions decorated with
+ToolExecutor.offload become coroutines that run the call according to the configured mode:
+
+- inline: on the event loop (no timeouts, previous behaviour)
+- thread: in a thread pool; a timed-out or cancelled call is answered immediately, but a call
+  that already started keeps its thread (and its concurrency slot) until it returns
+- process: in spawned worker processes; a timed-out or cancelled call kills its worker,
+  which is replaced, so runaway computations are really stopped
+
+Each tool can have its own timeout and concurrency limit; waiting for a slot counts towards
+the timeout. Cancellation (client disconnect, MCP notifications/cancelled) propagates to
+the waiting coroutine like a timeout.
+"""
+import asyncio
+import functools
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODES = ("inline", "thread", "process")
+
+# Undecorated tool functions by name, filled at import time in the server and in every worker
+_FUNCTIONS: Dict[str, Callable] = {}
+# Set in worker processes, so importing the server module there does not start another pool
+_IN_WORKER = False
+
+
+class ToolTimeoutError(TimeoutError):
+    """A tool call did not finish within its timeout"""
+
+
+def parse_tool_settings(value: str, cast: Callable[[str], Any]) -> Dict[str, Any]:
+    """Parse "tool=value,tool=value" environment settings"""
+    settings = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            settings[name.strip()] = cast(setting.strip())
+    return settings
+
+
+def _worker_main(module_name: str, conn):
+    """Worker process: import the tool module (registers its functions), then run calls until None"""
+    global _IN_WORKER
+    _IN_WORKER = True
+    # Ctrl-C is handled by the server, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        importlib.import_module(module_name)
+    except Exception as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        name, kwargs = item
+        try:
+            conn.send(("done", _FUNCTIONS[name](**kwargs)))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+class _Worker:
+    def __init__(self, index: int, module_name: str):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(module_name, child_conn),
+            name=f"mcp-tool-worker-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class ToolExecutor:
+    """Runs offloaded tool functions inline, in a thread pool or in worker processes"""
+
+    def __init__(self, mode: str = "thread", workers: Optional[int] = None, timeout: float = 10,
+                 timeouts: Optional[Dict[str, float]] = None, limits: Optional[Dict[str, int]] = None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown tool executor mode: {mode} (expected one of {', '.join(MODES)})")
+        self.mode = mode
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.timeout = timeout  # Default per call, 0 = no timeout
+        self.timeouts = timeouts or {}
+        self.limits = limits or {}
+        self._module_name: Optional[str] = None
+        self._threads: Optional[ThreadPoolExecutor] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._processes: List[_Worker] = []
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        # Counters
+        self.calls = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.restarts = 0
+
+    def offload(self, fn: Callable) -> Callable:
+        """Decorator: run the tool function according to the executor mode (signature is preserved for FastMCP)"""
+        name = fn.__name__
+        _FUNCTIONS[name] = fn
+        self._module_name = fn.__module__
+        if self.mode == "inline":
+            return fn
+
+        @functools.wraps(fn)
+        async def wrapper(**kwargs):
+            return await self.run(name, kwargs)
+
+        return wrapper
+
+    async def run(self, name: str, kwargs: Dict[str, Any]) -> Any:
+        """Call a registered tool function with its timeout and concurrency limit"""
+        self.calls += 1
+        timeout = self.timeouts.get(name, self.timeout) or None
+        try:
+            return await asyncio.wait_for(self._run_limited(name, kwargs), timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logger.warning(f"Tool {name} exceeded its {timeout:g}s timeout", extra={"tool": name})
+            raise ToolTimeoutError(f"Tool {name} exceeded its {timeout:g}s timeout")
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+    async def _run_limited(self, name: str, kwargs: Dict[str, Any]) -> Any:
+        semaphore = self._semaphores.get(name)
+        if semaphore is None and name in self.limits:
+            semaphore = self._semaphores[name] = asyncio.Semaphore(max(1, self.limits[name]))
+        if semaphore is not None:
+            await semaphore.acquire()
+        release = semaphore.release if semaphore is not None else None
+        try:
+            if self.mode == "thread":
+                # Released by the thread when it finishes
+                handed_over, release = release, None
+                return await self._run_thread(name, kwargs, handed_over)
+            return await self._run_process(name, kwargs)
+        finally:
+            if release is not None:
+                release()
+
+    async def _run_thread(self, name: str, kwargs: Dict[str, Any], release: Optional[Callable]) -> Any:
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mcp-tool")
+        future = self._threads.submit(functools.partial(_FUNCTIONS[name], **kwargs))
+        if release is not None:
+            # The concurrency slot is held until the call really ends, not until it is abandoned
+            loop = asyncio.get_running_loop()
+            future.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(release))
+        # Cancelling the wrapper cancels the call if it has not started yet
+        return await asyncio.wrap_future(future)
+
+    def start(self):
+        """Start the worker processes (process mode, otherwise no-op; called on first use)"""
+        if self.mode != "process" or _IN_WORKER or self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for index in range(self.workers):
+            self._processes.append(_Worker(index, self._module_name))
+            self._idle.put_nowait(self._processes[-1])
+        logger.info(f"Started {self.workers} tool worker processes")
+
+    async def _run_process(self, name: str, kwargs: Dict[str, Any]) -> Any:
+        self.start()
+        worker = await self._idle.get()
+        try:
+            if not worker.ready:
+                kind, payload = await asyncio.to_thread(worker.conn.recv)
+                if kind == "failed":
+                    raise RuntimeError(f"Tool worker failed to start: {payload}")
+                worker.ready = True
+            worker.conn.send((name, kwargs))
+            kind, payload = await asyncio.to_thread(worker.conn.recv)
+        except BaseException:
+            # Timed out, cancelled or crashed: the worker may still be computing, replace it
+            worker = self._replace(worker)
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+        if kind == "error":
+            raise payload
+        return payload
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        index = self._processes.index(worker)
+        worker.kill()
+        self.restarts += 1
+        self._processes[index] = _Worker(index, self._module_name)
+        return self._processes[index]
+
+    def close(self):
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+        for worker in self._processes:
+            worker.kill()
+        self._processes = []
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "calls": self.calls,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "worker_restarts": self.restarts,
+        }